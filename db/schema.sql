@@ -95,6 +95,9 @@ CREATE TABLE IF NOT EXISTS ordens_servico (
         REFERENCES formas_pagamento (id)
 );
 
+-- Keyset pagination of /api/orders walks (data_emissao, id)
+CREATE INDEX IF NOT EXISTS idx_ordens_servico_emissao_id ON ordens_servico (data_emissao, id);
+
 -- Future Table for Markers
 CREATE TABLE IF NOT EXISTS marcadores (
     id SERIAL PRIMARY KEY,
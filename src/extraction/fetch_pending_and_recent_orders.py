@@ -1,7 +1,9 @@
 import requests
 import json
 import time
-from db_utils import get_db_connection, close_db_connection
+from db_utils import get_db_connection, close_db_connection, upsert_ordem_servico
+from kpi_rollup import refresh_kpi_rollups
+from order_payloads import payload_column
 from datetime import datetime, timedelta
 import os
 import logging
@@ -193,59 +195,39 @@ def process_and_save_order(cursor, order_data):
         
         # Nota: Campos 'orcar' e 'orcado' são ignorados por serem incompatíveis com o banco
         
-        # Upsert (INSERT ... ON CONFLICT) na tabela correta "ordens_servico"
-        upsert_sql = """
-            INSERT INTO ordens_servico (
-                id, numero_ordem_servico, situacao, data_emissao, data_prevista,
-                data_conclusao, total_servicos, total_ordem_servico, total_pecas,
-                equipamento, equipamento_serie, descricao_problema, observacoes,
-                observacoes_internas, alq_comissao, vlr_comissao,
-                desconto, id_lista_preco, tecnico, id_contato, id_vendedor,
-                id_categoria_os, id_forma_pagamento, id_conta_contabil,
-                linha_dispositivo, tipo_servico, origem_cliente, data_extracao
-            ) VALUES (
-                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP
-            )
-            ON CONFLICT (id) DO UPDATE SET
-                numero_ordem_servico = EXCLUDED.numero_ordem_servico,
-                situacao = EXCLUDED.situacao,
-                data_emissao = EXCLUDED.data_emissao,
-                data_prevista = EXCLUDED.data_prevista,
-                data_conclusao = EXCLUDED.data_conclusao,
-                total_servicos = EXCLUDED.total_servicos,
-                total_ordem_servico = EXCLUDED.total_ordem_servico,
-                total_pecas = EXCLUDED.total_pecas,
-                equipamento = EXCLUDED.equipamento,
-                equipamento_serie = EXCLUDED.equipamento_serie,
-                descricao_problema = EXCLUDED.descricao_problema,
-                observacoes = EXCLUDED.observacoes,
-                observacoes_internas = EXCLUDED.observacoes_internas,
-                alq_comissao = EXCLUDED.alq_comissao,
-                vlr_comissao = EXCLUDED.vlr_comissao,
-                desconto = EXCLUDED.desconto,
-                id_lista_preco = EXCLUDED.id_lista_preco,
-                tecnico = EXCLUDED.tecnico,
-                id_contato = EXCLUDED.id_contato,
-                id_vendedor = EXCLUDED.id_vendedor,
-                id_categoria_os = EXCLUDED.id_categoria_os,
-                id_forma_pagamento = EXCLUDED.id_forma_pagamento,
-                id_conta_contabil = EXCLUDED.id_conta_contabil,
-                linha_dispositivo = EXCLUDED.linha_dispositivo,
-                tipo_servico = EXCLUDED.tipo_servico,
-                origem_cliente = EXCLUDED.origem_cliente,
-                data_extracao = CURRENT_TIMESTAMP;
-        """
+        # Atualiza pela id (movendo a linha de partição se data_emissao mudou) ou insere
+        upsert_ordem_servico(cursor, {
+            "id": order_id,
+            "numero_ordem_servico": numero_ordem_servico,
+            "situacao": situacao,
+            "data_emissao": data_emissao,
+            "data_prevista": data_prevista,
+            "data_conclusao": data_conclusao,
+            "total_servicos": total_servicos,
+            "total_ordem_servico": total_ordem_servico,
+            "total_pecas": total_pecas,
+            "equipamento": equipamento,
+            "equipamento_serie": equipamento_serie,
+            "descricao_problema": descricao_problema,
+            "observacoes": observacoes,
+            "observacoes_internas": observacoes_internas,
+            "alq_comissao": alq_comissao,
+            "vlr_comissao": vlr_comissao,
+            "desconto": desconto,
+            "id_lista_preco": id_lista_preco,
+            "tecnico": tecnico,
+            "id_contato": id_contato,
+            "id_vendedor": id_vendedor,
+            "id_categoria_os": id_categoria_os,
+            "id_forma_pagamento": id_forma_pagamento,
+            "id_conta_contabil": id_conta_contabil,
+            "linha_dispositivo": linha_dispositivo,
+            "tipo_servico": tipo_servico,
+            "origem_cliente": origem_cliente,
+            # Payload bruto (inclusive orcar/orcado) para re-derivação sem chamar a API
+            **payload_column(cursor.connection, order_data),
+        })
         
-        cursor.execute(upsert_sql, (
-            order_id, numero_ordem_servico, situacao, data_emissao, data_prevista,
-            data_conclusao, total_servicos, total_ordem_servico, total_pecas,
-            equipamento, equipamento_serie, descricao_problema, observacoes,
-            observacoes_internas, alq_comissao, vlr_comissao,
-            desconto, id_lista_preco, tecnico, id_contato, id_vendedor,
-            id_categoria_os, id_forma_pagamento, id_conta_contabil,
-            linha_dispositivo, tipo_servico, origem_cliente
-        ))
         
         return True
     except Exception as e:
@@ -492,6 +474,9 @@ def process_batch_with_params(headers, params, token, conn, cursor, failed_order
                 failed_orders.append([order_id, str(e)])
                 continue
         
+        # Recalcula apenas os meses de KPI afetados por este lote
+        refresh_kpi_rollups(conn)
+        
         # Pausa entre lotes
         time.sleep(random.uniform(1.0, 3.0))
 
@@ -1,5 +1,6 @@
 import json
-from db_utils import get_db_connection, close_db_connection
+from db_utils import get_db_connection, close_db_connection, upsert_ordem_servico
+from order_payloads import payload_column
 from datetime import datetime
 
 def process_order_data(json_file_path):
@@ -213,60 +214,39 @@ def process_order_data(json_file_path):
                 origem_cliente = None # This will be handled later when processing markers
 
                 # --- Database Insertion/Update for ordens_servico ---
-                upsert_sql = """
-                    INSERT INTO ordens_servico (
-                        id, numero_ordem_servico, situacao, data_emissao, data_prevista,
-                        data_conclusao, total_servicos, total_ordem_servico, total_pecas,
-                        equipamento, equipamento_serie, descricao_problema, observacoes,
-                        observacoes_internas, orcar, orcado, alq_comissao, vlr_comissao,
-                        desconto, id_lista_preco, tecnico, id_contato, id_vendedor,
-                        id_categoria_os, id_forma_pagamento, id_conta_contabil,
-                        linha_dispositivo, tipo_servico, origem_cliente
-                    ) VALUES (
-                        %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                        %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-                    )
-                    ON CONFLICT (id) DO UPDATE SET
-                        numero_ordem_servico = EXCLUDED.numero_ordem_servico,
-                        situacao = EXCLUDED.situacao,
-                        data_emissao = EXCLUDED.data_emissao,
-                        data_prevista = EXCLUDED.data_prevista,
-                        data_conclusao = EXCLUDED.data_conclusao,
-                        total_servicos = EXCLUDED.total_servicos,
-                        total_ordem_servico = EXCLUDED.total_ordem_servico,
-                        total_pecas = EXCLUDED.total_pecas,
-                        equipamento = EXCLUDED.equipamento,
-                        equipamento_serie = EXCLUDED.equipamento_serie,
-                        descricao_problema = EXCLUDED.descricao_problema,
-                        observacoes = EXCLUDED.observacoes,
-                        observacoes_internas = EXCLUDED.observacoes_internas,
-                        orcar = EXCLUDED.orcar,
-                        orcado = EXCLUDED.orcado,
-                        alq_comissao = EXCLUDED.alq_comissao,
-                        vlr_comissao = EXCLUDED.vlr_comissao,
-                        desconto = EXCLUDED.desconto,
-                        id_lista_preco = EXCLUDED.id_lista_preco,
-                        tecnico = EXCLUDED.tecnico,
-                        id_contato = EXCLUDED.id_contato,
-                        id_vendedor = EXCLUDED.id_vendedor,
-                        id_categoria_os = EXCLUDED.id_categoria_os,
-                        id_forma_pagamento = EXCLUDED.id_forma_pagamento,
-                        id_conta_contabil = EXCLUDED.id_conta_contabil,
-                        linha_dispositivo = EXCLUDED.linha_dispositivo,
-                        tipo_servico = EXCLUDED.tipo_servico,
-                        origem_cliente = EXCLUDED.origem_cliente,
-                        data_extracao = CURRENT_TIMESTAMP;
-
-                """
-                cur.execute(upsert_sql, (
-                    order_id, numero_ordem_servico, situacao, data_emissao, data_prevista,
-                    data_conclusao, total_servicos, total_ordem_servico, total_pecas,
-                    equipamento, equipamento_serie, descricao_problema, observacoes,
-                    observacoes_internas, orcar, orcado, alq_comissao, vlr_comissao,
-                    desconto, id_lista_preco, tecnico, contact_id, id_vendedor,
-                    id_categoria_os, id_forma_pagamento, id_conta_contabil,
-                    linha_dispositivo, tipo_servico, origem_cliente
-                ))
+                upsert_ordem_servico(cur, {
+                    "id": order_id,
+                    "numero_ordem_servico": numero_ordem_servico,
+                    "situacao": situacao,
+                    "data_emissao": data_emissao,
+                    "data_prevista": data_prevista,
+                    "data_conclusao": data_conclusao,
+                    "total_servicos": total_servicos,
+                    "total_ordem_servico": total_ordem_servico,
+                    "total_pecas": total_pecas,
+                    "equipamento": equipamento,
+                    "equipamento_serie": equipamento_serie,
+                    "descricao_problema": descricao_problema,
+                    "observacoes": observacoes,
+                    "observacoes_internas": observacoes_internas,
+                    "orcar": orcar,
+                    "orcado": orcado,
+                    "alq_comissao": alq_comissao,
+                    "vlr_comissao": vlr_comissao,
+                    "desconto": desconto,
+                    "id_lista_preco": id_lista_preco,
+                    "tecnico": tecnico,
+                    "id_contato": contact_id,
+                    "id_vendedor": id_vendedor,
+                    "id_categoria_os": id_categoria_os,
+                    "id_forma_pagamento": id_forma_pagamento,
+                    "id_conta_contabil": id_conta_contabil,
+                    "linha_dispositivo": linha_dispositivo,
+                    "tipo_servico": tipo_servico,
+                    "origem_cliente": origem_cliente,
+                    # Payload bruto (inclusive orcar/orcado) para re-derivação sem chamar a API
+                    **payload_column(conn, order),
+                })
                 conn.commit()
                 print(f"Processed and saved Order ID: {order_id}")
 
@@ -1,7 +1,9 @@
 import json
 import sys
 import os
-from db_utils import get_db_connection, close_db_connection
+from db_utils import get_db_connection, close_db_connection, is_partitioned_table, insert_ordem_servico, upsert_ordem_servico
+from kpi_rollup import refresh_kpi_rollups
+from order_payloads import payload_column
 from datetime import datetime
 import logging
 
@@ -240,6 +242,37 @@ def process_order_data(json_file_path, update_mode="safe", dry_run=False):
                     continue
 
                 # --- Inserção/Atualização no banco de dados para ordens_servico ---
+                # O payload bruto vai no mesmo comando, para re-derivar colunas sem chamar a API
+                order_values = {
+                    "id": order_id,
+                    "numero_ordem_servico": numero_ordem_servico,
+                    "situacao": situacao,
+                    "data_emissao": data_emissao,
+                    "data_prevista": data_prevista,
+                    "data_conclusao": data_conclusao,
+                    "total_servicos": total_servicos,
+                    "total_ordem_servico": total_ordem_servico,
+                    "total_pecas": total_pecas,
+                    "equipamento": equipamento,
+                    "equipamento_serie": equipamento_serie,
+                    "descricao_problema": descricao_problema,
+                    "observacoes": observacoes,
+                    "observacoes_internas": observacoes_internas,
+                    "alq_comissao": alq_comissao,
+                    "vlr_comissao": vlr_comissao,
+                    "desconto": desconto,
+                    "id_lista_preco": id_lista_preco,
+                    "tecnico": tecnico,
+                    "id_contato": contact_id,
+                    "id_vendedor": id_vendedor,
+                    "id_categoria_os": id_categoria_os,
+                    "id_forma_pagamento": id_forma_pagamento,
+                    "id_conta_contabil": id_conta_contabil,
+                    "linha_dispositivo": linha_dispositivo,
+                    "tipo_servico": tipo_servico,
+                    "origem_cliente": origem_cliente,
+                    **({} if dry_run else payload_column(conn, order)),
+                }
                 if update_mode == "append":
                     # No modo append, só insere se não existir
                     cur.execute("SELECT id FROM ordens_servico WHERE id = %s", (order_id,))
@@ -247,88 +280,16 @@ def process_order_data(json_file_path, update_mode="safe", dry_run=False):
                         log_json("INFO", "Ordem já existe no banco, pulando no modo append", order_id=order_id)
                         skipped_count += 1
                         continue
-                    insert_sql = """
-                        INSERT INTO ordens_servico (
-                            id, numero_ordem_servico, situacao, data_emissao, data_prevista,
-                            data_conclusao, total_servicos, total_ordem_servico, total_pecas,
-                            equipamento, equipamento_serie, descricao_problema, observacoes,
-                            observacoes_internas, alq_comissao, vlr_comissao,
-                            desconto, id_lista_preco, tecnico, id_contato, id_vendedor,
-                            id_categoria_os, id_forma_pagamento, id_conta_contabil,
-                            linha_dispositivo, tipo_servico, origem_cliente, data_extracao
-                        ) VALUES (
-                            %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                            %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP
-                        )
-                    """
                     if not dry_run:
-                        cur.execute(insert_sql, (
-                            order_id, numero_ordem_servico, situacao, data_emissao, data_prevista,
-                            data_conclusao, total_servicos, total_ordem_servico, total_pecas,
-                            equipamento, equipamento_serie, descricao_problema, observacoes,
-                            observacoes_internas, alq_comissao, vlr_comissao,
-                            desconto, id_lista_preco, tecnico, contact_id, id_vendedor,
-                            id_categoria_os, id_forma_pagamento, id_conta_contabil,
-                            linha_dispositivo, tipo_servico, origem_cliente
-                        ))
+                        insert_ordem_servico(cur, order_values)
                         inserted_count += 1
                     else:
                         log_json("INFO", "[DRY RUN] Ordem seria inserida", order_id=order_id)
                 
                 elif update_mode == "complete":
                     # Modo complete: substitui todos os valores, incluindo NULL (usar com cuidado)
-                    upsert_sql = """
-                        INSERT INTO ordens_servico (
-                            id, numero_ordem_servico, situacao, data_emissao, data_prevista,
-                            data_conclusao, total_servicos, total_ordem_servico, total_pecas,
-                            equipamento, equipamento_serie, descricao_problema, observacoes,
-                            observacoes_internas, alq_comissao, vlr_comissao,
-                            desconto, id_lista_preco, tecnico, id_contato, id_vendedor,
-                            id_categoria_os, id_forma_pagamento, id_conta_contabil,
-                            linha_dispositivo, tipo_servico, origem_cliente, data_extracao
-                        ) VALUES (
-                            %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                            %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP
-                        )
-                        ON CONFLICT (id) DO UPDATE SET
-                            numero_ordem_servico = EXCLUDED.numero_ordem_servico,
-                            situacao = EXCLUDED.situacao,
-                            data_emissao = EXCLUDED.data_emissao,
-                            data_prevista = EXCLUDED.data_prevista,
-                            data_conclusao = EXCLUDED.data_conclusao,
-                            total_servicos = EXCLUDED.total_servicos,
-                            total_ordem_servico = EXCLUDED.total_ordem_servico,
-                            total_pecas = EXCLUDED.total_pecas,
-                            equipamento = EXCLUDED.equipamento,
-                            equipamento_serie = EXCLUDED.equipamento_serie,
-                            descricao_problema = EXCLUDED.descricao_problema,
-                            observacoes = EXCLUDED.observacoes,
-                            observacoes_internas = EXCLUDED.observacoes_internas,
-                            alq_comissao = EXCLUDED.alq_comissao,
-                            vlr_comissao = EXCLUDED.vlr_comissao,
-                            desconto = EXCLUDED.desconto,
-                            id_lista_preco = EXCLUDED.id_lista_preco,
-                            tecnico = EXCLUDED.tecnico,
-                            id_contato = EXCLUDED.id_contato,
-                            id_vendedor = EXCLUDED.id_vendedor,
-                            id_categoria_os = EXCLUDED.id_categoria_os,
-                            id_forma_pagamento = EXCLUDED.id_forma_pagamento,
-                            id_conta_contabil = EXCLUDED.id_conta_contabil,
-                            linha_dispositivo = EXCLUDED.linha_dispositivo,
-                            tipo_servico = EXCLUDED.tipo_servico,
-                            origem_cliente = EXCLUDED.origem_cliente,
-                            data_extracao = CURRENT_TIMESTAMP;
-                    """
                     if not dry_run:
-                        cur.execute(upsert_sql, (
-                            order_id, numero_ordem_servico, situacao, data_emissao, data_prevista,
-                            data_conclusao, total_servicos, total_ordem_servico, total_pecas,
-                            equipamento, equipamento_serie, descricao_problema, observacoes,
-                            observacoes_internas, alq_comissao, vlr_comissao,
-                            desconto, id_lista_preco, tecnico, contact_id, id_vendedor,
-                            id_categoria_os, id_forma_pagamento, id_conta_contabil,
-                            linha_dispositivo, tipo_servico, origem_cliente
-                        ))
+                        upsert_ordem_servico(cur, order_values)
                         updated_count += 1
                     else:
                         log_json("INFO", "[DRY RUN] Ordem seria atualizada", order_id=order_id)
@@ -345,35 +306,8 @@ def process_order_data(json_file_path, update_mode="safe", dry_run=False):
                     update_fields = []
                     update_values = []
                     
-                    # Mapear campos para atualização
-                    fields_to_update = [
-                        ("numero_ordem_servico", numero_ordem_servico),
-                        ("situacao", situacao),
-                        ("data_emissao", data_emissao),
-                        ("data_prevista", data_prevista),
-                        ("data_conclusao", data_conclusao),
-                        ("total_servicos", total_servicos),
-                        ("total_ordem_servico", total_ordem_servico),
-                        ("total_pecas", total_pecas),
-                        ("equipamento", equipamento),
-                        ("equipamento_serie", equipamento_serie),
-                        ("descricao_problema", descricao_problema),
-                        ("observacoes", observacoes),
-                        ("observacoes_internas", observacoes_internas),
-                        ("alq_comissao", alq_comissao),
-                        ("vlr_comissao", vlr_comissao),
-                        ("desconto", desconto),
-                        ("id_lista_preco", id_lista_preco),
-                        ("tecnico", tecnico),
-                        ("id_contato", contact_id),
-                        ("id_vendedor", id_vendedor),
-                        ("id_categoria_os", id_categoria_os),
-                        ("id_forma_pagamento", id_forma_pagamento),
-                        ("id_conta_contabil", id_conta_contabil),
-                        ("linha_dispositivo", linha_dispositivo),
-                        ("tipo_servico", tipo_servico),
-                        ("origem_cliente", origem_cliente)
-                    ]
+                    # Mapear campos para atualização (o payload bruto é sempre substituído)
+                    fields_to_update = [(field, value) for field, value in order_values.items() if field != "id"]
                     
                     # Adicionar apenas campos não nulos
                     for field, value in fields_to_update:
@@ -414,10 +348,17 @@ def process_order_data(json_file_path, update_mode="safe", dry_run=False):
                             if isinstance(marcador, dict) and 'marcador' in marcador:
                                 marcador_desc = marcador['marcador'].get('descricao')
                                 if marcador_desc:
-                                    cur.execute("""
-                                        INSERT INTO marcadores_ordem_servico (id_ordem_servico, descricao)
-                                        VALUES (%s, %s)
-                                    """, (order_id, marcador_desc))
+                                    if is_partitioned_table(conn):
+                                        # No layout particionado o marcador carrega a data_emissao da ordem
+                                        cur.execute("""
+                                            INSERT INTO marcadores_ordem_servico (id_ordem_servico, descricao, data_emissao)
+                                            SELECT id, %s, data_emissao FROM ordens_servico WHERE id = %s
+                                        """, (marcador_desc, order_id))
+                                    else:
+                                        cur.execute("""
+                                            INSERT INTO marcadores_ordem_servico (id_ordem_servico, descricao)
+                                            VALUES (%s, %s)
+                                        """, (order_id, marcador_desc))
                         
                         log_json("DEBUG", f"Marcadores atualizados para a ordem {order_id}")
                     except Exception as e:
@@ -473,6 +414,8 @@ def process_order_data(json_file_path, update_mode="safe", dry_run=False):
         # Fazer commit final
         if not dry_run:
             conn.commit()
+            # Recalcular apenas os meses de KPI afetados por este lote
+            refresh_kpi_rollups(conn)
         
         # Log de resumo
         log_json("INFO", "Processamento concluído", 
@@ -4,7 +4,7 @@ import time
 import os
 from datetime import datetime
 from dotenv import load_dotenv
-from db_utils import get_db_connection, close_db_connection
+from db_utils import get_db_connection, close_db_connection, is_partitioned_table
 
 # Carregar variáveis de ambiente
 load_dotenv()
@@ -152,11 +152,23 @@ def process_markers_for_order(os_id, markers):
                 marker_id = cursor.fetchone()[0]
             
             # Inserir na tabela de junção
-            cursor.execute(
-                """INSERT INTO ordem_servico_marcadores (id_ordem_servico, id_marcador) 
-                   VALUES (%s, %s) ON CONFLICT DO NOTHING""",
-                (os_id, marker_id)
-            )
+            if is_partitioned_table(conn):
+                # No layout particionado a junção carrega a data_emissao da ordem;
+                # sem data (partição default) a chave única não barra duplicatas
+                cursor.execute(
+                    """INSERT INTO ordem_servico_marcadores (id_ordem_servico, id_marcador, data_emissao)
+                       SELECT o.id, %s, o.data_emissao FROM ordens_servico o
+                       WHERE o.id = %s
+                         AND NOT EXISTS (SELECT 1 FROM ordem_servico_marcadores m
+                                         WHERE m.id_ordem_servico = o.id AND m.id_marcador = %s)""",
+                    (marker_id, os_id, marker_id)
+                )
+            else:
+                cursor.execute(
+                    """INSERT INTO ordem_servico_marcadores (id_ordem_servico, id_marcador) 
+                       VALUES (%s, %s) ON CONFLICT DO NOTHING""",
+                    (os_id, marker_id)
+                )
             markers_inserted += 1
         
         conn.commit()
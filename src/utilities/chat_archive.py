@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Packed per-month archives of the WhatsApp transcripts, and the reader used by
+index_chat_files.py and load_chat_messages.py.
+
+organized_whatsapp_chats/<year>/<month>.chatpack holds the transcripts of the
+<year>/<month> directory (written by pack_chat_archives.py):
+
+    MAGIC
+    zstd dictionary trained on the month's transcripts (optional)
+    one zstd frame per transcript, in filename (chronological) order
+    index: zstd-compressed JSON with the offset, length, size, mtime, SHA-256
+           and canonical phone of every transcript
+    footer: index offset, index length, MAGIC
+
+Opening an archive reads the footer and the index once. After that, reading one
+transcript is a single positioned read (os.pread, so forked workers can share
+the handle), and scan() reads the blocks front to back with sequential I/O.
+
+Transcripts keep their logical path <year>/<month>/<name>, so chat_files rows
+do not change when a month is packed. A file present in the directory takes
+precedence over the archived copy of the same name.
+"""
+
+import io
+import os
+import json
+import struct
+import hashlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_SUFFIX = ".chatpack"
+MAGIC = b"CHATPK01"
+FOOTER = struct.Struct("<QQ8s")   # index offset, index length, magic
+
+ZSTD_LEVEL = 12
+DICTIONARY_SIZE = 112 * 1024      # Small transcripts compress far better with a shared dictionary
+DICTIONARY_MIN_SAMPLES = 20
+DICTIONARY_MAX_SAMPLES = 2000
+
+def require_zstandard():
+    if zstandard is None:
+        raise RuntimeError("Chat archives need the zstandard package: pip install zstandard")
+
+def archive_path(shard_dir):
+    """Path of the packed archive of a <year>/<month> directory."""
+    return os.path.normpath(shard_dir) + ARCHIVE_SUFFIX
+
+class ChatArchive:
+    """Read-only access to one .chatpack file."""
+    def __init__(self, path):
+        require_zstandard()
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(self.fd).st_size
+            if size < len(MAGIC) + FOOTER.size:
+                raise ValueError(f"{path} is not a chat archive")
+            index_offset, index_length, magic = FOOTER.unpack(os.pread(self.fd, FOOTER.size, size - FOOTER.size))
+            if magic != MAGIC or os.pread(self.fd, len(MAGIC), 0) != MAGIC:
+                raise ValueError(f"{path} is not a chat archive")
+            index = json.loads(zstandard.ZstdDecompressor().decompress(
+                os.pread(self.fd, index_length, index_offset)
+            ))
+        except Exception:
+            os.close(self.fd)
+            raise
+
+        dictionary = None
+        if index["dictionary"]:
+            offset, length = index["dictionary"]
+            dictionary = zstandard.ZstdCompressionDict(os.pread(self.fd, length, offset))
+        self.decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+
+        self.entries = {}
+        self.phones = {}
+        for name, offset, length, size, mtime_ns, sha256, phone in index["files"]:
+            self.entries[name] = {"offset": offset, "length": length, "size": size,
+                                  "mtime_ns": mtime_ns, "sha256": sha256, "phone": phone}
+            if phone:
+                self.phones.setdefault(phone, []).append(name)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def names(self):
+        """Transcript names, in archive order."""
+        return list(self.entries)
+
+    def names_for_phone(self, phone):
+        """Transcript names of one canonical phone, oldest first."""
+        return self.phones.get(phone, [])
+
+    def read(self, name):
+        """Content of one transcript, read with a single positioned read."""
+        entry = self.entries[name]
+        return self.decompressor.decompress(
+            os.pread(self.fd, entry["length"], entry["offset"]), max_output_size=entry["size"]
+        )
+
+    def scan(self):
+        """Yield (name, content) of every transcript, reading the file front to back."""
+        ordered = sorted(self.entries.items(), key=lambda item: item[1]["offset"])
+        with open(self.path, "rb", buffering=1024 * 1024) as handle:
+            position = None
+            for name, entry in ordered:
+                if position != entry["offset"]:
+                    handle.seek(entry["offset"])
+                data = handle.read(entry["length"])
+                position = entry["offset"] + entry["length"]
+                yield name, self.decompressor.decompress(data, max_output_size=entry["size"])
+
+def write_archive(path, transcripts):
+    """
+    Write an archive from (name, content, mtime_ns, canonical phone) tuples,
+    atomically replacing any previous archive at path. Returns
+    (files, raw bytes, archive bytes).
+    """
+    require_zstandard()
+    transcripts = sorted(transcripts, key=lambda item: item[0])
+    dictionary = None
+    if len(transcripts) >= DICTIONARY_MIN_SAMPLES:
+        step = max(1, len(transcripts) // DICTIONARY_MAX_SAMPLES)
+        try:
+            dictionary = zstandard.train_dictionary(
+                DICTIONARY_SIZE, [content for _, content, _, _ in transcripts[::step]], level=ZSTD_LEVEL
+            )
+        except zstandard.ZstdError:
+            dictionary = None   # Too little data to train on; plain frames still work
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dictionary, write_content_size=True)
+
+    temp_path = path + ".tmp"
+    raw_bytes = 0
+    files = []
+    with open(temp_path, "wb") as handle:
+        handle.write(MAGIC)
+        dictionary_ref = None
+        if dictionary is not None:
+            data = dictionary.as_bytes()
+            dictionary_ref = [handle.tell(), len(data)]
+            handle.write(data)
+        for name, content, mtime_ns, phone in transcripts:
+            frame = compressor.compress(content)
+            files.append([name, handle.tell(), len(frame), len(content), mtime_ns,
+                          hashlib.sha256(content).hexdigest(), phone])
+            handle.write(frame)
+            raw_bytes += len(content)
+        index = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(
+            json.dumps({"dictionary": dictionary_ref, "files": files}, ensure_ascii=False).encode()
+        )
+        index_offset = handle.tell()
+        handle.write(index)
+        handle.write(FOOTER.pack(index_offset, len(index), MAGIC))
+        handle.flush()
+        os.fsync(handle.fileno())
+        archive_bytes = handle.tell()
+    os.replace(temp_path, path)
+    return len(files), raw_bytes, archive_bytes
+
+# Open archives of this process, by path, with the (size, mtime) they were opened at
+_archives = {}
+
+def shard_archive(shard_dir):
+    """Open ChatArchive of a <year>/<month> directory, or None if it is not packed."""
+    path = archive_path(shard_dir)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    cached = _archives.get(path)
+    if cached and cached[0] == (stat.st_size, stat.st_mtime_ns):
+        return cached[1]
+    if cached:
+        cached[1].close()
+    archive = ChatArchive(path)
+    _archives[path] = ((stat.st_size, stat.st_mtime_ns), archive)
+    return archive
+
+def archived_entry(file_path):
+    """Index entry of a transcript that exists only in its month's archive, or None."""
+    if os.path.exists(file_path):
+        return None
+    archive = shard_archive(os.path.dirname(file_path))
+    if archive is None:
+        return None
+    return archive.entries.get(os.path.basename(file_path))
+
+def open_transcript(file_path):
+    """Binary file object of a transcript, from its directory or its month's archive."""
+    if archived_entry(file_path) is None:
+        return open(file_path, "rb")
+    return io.BytesIO(shard_archive(os.path.dirname(file_path)).read(os.path.basename(file_path)))
+
+def transcript_stat(file_path):
+    """(size, mtime_ns) of a transcript; archived ones report the values they were packed with."""
+    entry = archived_entry(file_path)
+    if entry is None:
+        stat = os.stat(file_path)
+        return stat.st_size, stat.st_mtime_ns
+    return entry["size"], entry["mtime_ns"]
+
+def transcript_sha256(file_path):
+    """Hex SHA-256 of a transcript; archived ones use the hash stored at packing time."""
+    entry = archived_entry(file_path)
+    if entry is not None:
+        return entry["sha256"]
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as handle:
+        for block in iter(lambda: handle.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
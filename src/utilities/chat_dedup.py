@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Deduplication of re-exported WhatsApp transcripts, used by load_chat_messages.py.
+
+The same conversation is often exported several times, each file a superset of
+the previous one. Messages are therefore stored per conversation (the customer's
+canonical phone, or the file itself when the name has no phone), each with a
+position and a content hash. A transcript only adds the messages its
+conversation does not have yet. chat_file_trechos records which position ranges
+of the conversation each file covers, so every file's full transcript can still
+be read back (see the mensagens_por_arquivo view). Anything that reads the
+messages of a file goes through that view, not chat_messages.id_chat_file,
+which is only the file that stored the message first.
+"""
+
+import os
+import zlib
+import hashlib
+from match_chat_contacts import canonical_phone
+from index_chat_files import extract_filename_data
+
+SETUP_STATEMENTS = [
+    "ALTER TABLE chat_messages ADD COLUMN IF NOT EXISTS conversa VARCHAR(40)",
+    "ALTER TABLE chat_messages ADD COLUMN IF NOT EXISTS posicao INTEGER",
+    "ALTER TABLE chat_messages ADD COLUMN IF NOT EXISTS message_hash CHAR(32)",
+    # Rows loaded before deduplication have no conversa and stay out of both indexes
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_chat_messages_conversa_hash
+    ON chat_messages (conversa, message_hash) WHERE conversa IS NOT NULL
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_chat_messages_conversa_posicao
+    ON chat_messages (conversa, posicao) WHERE conversa IS NOT NULL
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS chat_file_trechos (
+        id_chat_file INTEGER NOT NULL REFERENCES chat_files (id),
+        conversa VARCHAR(40) NOT NULL,
+        posicao_inicio INTEGER NOT NULL,
+        posicao_fim INTEGER NOT NULL,
+        PRIMARY KEY (id_chat_file, posicao_inicio)
+    )
+    """,
+    """
+    CREATE OR REPLACE VIEW mensagens_por_arquivo AS
+    SELECT t.id_chat_file, cm.id AS id_mensagem, cm.id_chat_file AS id_chat_file_origem,
+           cm.conversa, cm.posicao, cm.message_timestamp, cm.is_from_customer,
+           cm.message_text, cm.responding_to
+    FROM chat_file_trechos t
+    JOIN chat_messages cm
+      ON cm.conversa = t.conversa
+     AND cm.posicao BETWEEN t.posicao_inicio AND t.posicao_fim
+    -- Rows loaded before deduplication belong to their own file only
+    UNION ALL
+    SELECT cm.id_chat_file, cm.id, cm.id_chat_file,
+           cm.conversa, cm.posicao, cm.message_timestamp, cm.is_from_customer,
+           cm.message_text, cm.responding_to
+    FROM chat_messages cm
+    WHERE cm.conversa IS NULL
+    """,
+]
+
+def conversation_key(file_path, phone_number):
+    """Conversation a transcript belongs to: its canonical phone, else the file itself."""
+    digits = canonical_phone(phone_number)
+    if digits:
+        return digits
+    return "arquivo:" + hashlib.sha1(file_path.encode()).hexdigest()[:24]
+
+def conversation_bucket(key, buckets):
+    """Stable bucket of a conversation, so one conversation is always handled by one worker."""
+    return zlib.crc32(key.encode()) % buckets
+
+def message_hashes(messages):
+    """
+    Content hash of each message. A message repeated verbatim within the same
+    second also gets its occurrence number, so it is not merged with the first one.
+    """
+    hashes = []
+    occurrences = {}
+    for message in messages:
+        identity = "\x1f".join(str(message[field]) for field in ("timestamp", "is_from_customer", "text", "responding_to"))
+        occurrence = occurrences.get(identity, 0)
+        occurrences[identity] = occurrence + 1
+        hashes.append(hashlib.blake2b(f"{identity}\x1f{occurrence}".encode(), digest_size=16).hexdigest())
+    return hashes
+
+class Conversation:
+    """Positions of the messages a conversation already stores, by content hash."""
+    def __init__(self):
+        self.positions = {}
+        self.next_position = 1
+
+    def add_stored(self, message_hash, position):
+        self.positions[message_hash] = position
+        self.next_position = max(self.next_position, position + 1)
+
+    def place(self, hashes):
+        """
+        Place a transcript's messages in the conversation. Returns the indexes and
+        positions of the messages not stored yet, plus the position ranges the
+        transcript covers, in file order.
+        """
+        new_messages = []
+        ranges = []
+        for index, message_hash in enumerate(hashes):
+            position = self.positions.get(message_hash)
+            if position is None:
+                position = self.next_position
+                self.next_position += 1
+                self.positions[message_hash] = position
+                new_messages.append((index, position))
+            if ranges and ranges[-1][1] + 1 == position:
+                ranges[-1][1] = position
+            else:
+                ranges.append([position, position])
+        return new_messages, [tuple(item) for item in ranges]
+
+def file_conversation(file_path):
+    """Conversation key of a transcript path, from the phone in its filename."""
+    file_data = extract_filename_data(os.path.basename(file_path)) or {}
+    return conversation_key(file_path, file_data.get("phone_number"))
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Per-customer WhatsApp aggregates in customer_chat_summaries.
+
+Each contact with chats gets one row: chat and message counts, first and last
+interaction, average shop response time (seconds between a customer message and
+the next shop message in the same chat) and the ids of the linked orders. The
+view crm_clientes_chat joins it to contatos, so CRM screens read precomputed
+numbers and never scan chat_messages.
+
+Statement-level triggers on chat_files record in resumos_chat_pendentes the
+contacts whose chats were inserted, deleted or updated. The message loader, the
+contact matcher and the order linker all update chat_files, so every change is
+seen. refresh recomputes only those contacts.
+
+Usage:
+    python chat_summaries.py setup [--dry-run]   # columns, triggers, view and initial backfill
+    python chat_summaries.py refresh             # recompute pending contacts
+    python chat_summaries.py rebuild             # mark every contact and recompute
+"""
+
+import json
+import argparse
+from datetime import datetime
+from db_utils import get_db_connection, close_db_connection
+from chat_dedup import SETUP_STATEMENTS as DEDUP_SETUP_STATEMENTS
+
+SETUP_STATEMENTS = [
+    "ALTER TABLE customer_chat_summaries ADD COLUMN IF NOT EXISTS chat_count INTEGER",
+    "ALTER TABLE customer_chat_summaries ADD COLUMN IF NOT EXISTS message_count INTEGER",
+    "ALTER TABLE customer_chat_summaries ADD COLUMN IF NOT EXISTS customer_message_count INTEGER",
+    "ALTER TABLE customer_chat_summaries ADD COLUMN IF NOT EXISTS first_interaction_date TIMESTAMP",
+    "ALTER TABLE customer_chat_summaries ADD COLUMN IF NOT EXISTS avg_response_seconds INTEGER",
+    "ALTER TABLE customer_chat_summaries ADD COLUMN IF NOT EXISTS linked_orders INTEGER[]",
+    "ALTER TABLE customer_chat_summaries ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP",
+    # One summary per contact, maintained with INSERT ... ON CONFLICT
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_customer_chat_summaries_contato ON customer_chat_summaries (id_contato)",
+    """
+    CREATE TABLE IF NOT EXISTS resumos_chat_pendentes (
+        id_contato INTEGER PRIMARY KEY,
+        marcado_em TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE OR REPLACE FUNCTION resumos_chat_marcar_contatos() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO resumos_chat_pendentes (id_contato)
+            SELECT DISTINCT id_contato FROM novas WHERE id_contato IS NOT NULL
+            ON CONFLICT DO NOTHING;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            INSERT INTO resumos_chat_pendentes (id_contato)
+            SELECT DISTINCT id_contato FROM antigas WHERE id_contato IS NOT NULL
+            ON CONFLICT DO NOTHING;
+        END IF;
+        RETURN NULL;
+    END;
+    $$
+    """,
+    # Transition tables allow a single event per trigger, hence three triggers
+    "DROP TRIGGER IF EXISTS trg_resumos_chat_insert ON chat_files",
+    """
+    CREATE TRIGGER trg_resumos_chat_insert AFTER INSERT ON chat_files
+    REFERENCING NEW TABLE AS novas
+    FOR EACH STATEMENT EXECUTE FUNCTION resumos_chat_marcar_contatos()
+    """,
+    "DROP TRIGGER IF EXISTS trg_resumos_chat_update ON chat_files",
+    """
+    CREATE TRIGGER trg_resumos_chat_update AFTER UPDATE ON chat_files
+    REFERENCING OLD TABLE AS antigas NEW TABLE AS novas
+    FOR EACH STATEMENT EXECUTE FUNCTION resumos_chat_marcar_contatos()
+    """,
+    "DROP TRIGGER IF EXISTS trg_resumos_chat_delete ON chat_files",
+    """
+    CREATE TRIGGER trg_resumos_chat_delete AFTER DELETE ON chat_files
+    REFERENCING OLD TABLE AS antigas
+    FOR EACH STATEMENT EXECUTE FUNCTION resumos_chat_marcar_contatos()
+    """,
+    """
+    CREATE OR REPLACE VIEW crm_clientes_chat AS
+    SELECT c.id AS id_contato, c.nome, c.celular, c.telefone, c.email,
+           s.chat_count, s.message_count, s.customer_message_count,
+           s.first_interaction_date, s.last_interaction_date,
+           s.avg_response_seconds, s.linked_orders, s.updated_at
+    FROM customer_chat_summaries s
+    JOIN contatos c ON c.id = s.id_contato
+    """,
+]
+
+MARK_ALL_CONTACTS_SQL = """
+    INSERT INTO resumos_chat_pendentes (id_contato)
+    SELECT DISTINCT id_contato FROM chat_files WHERE id_contato IS NOT NULL
+    ON CONFLICT DO NOTHING
+"""
+
+# Chats marked deleted by index_chat_files.py no longer count
+RECOMPUTE_CONTACTS_SQL = """
+    WITH chats AS (
+        SELECT id, id_contato, id_ordem_servico, file_date
+        FROM chat_files
+        WHERE id_contato = ANY(%(contatos)s) AND processing_status IS DISTINCT FROM 'deleted'
+    ),
+    -- Each message once per contact, through the live files that cover it; a message
+    -- first stored by a file now marked deleted still counts if a later export has it
+    mensagens_chats AS (
+        SELECT DISTINCT c.id_contato, m.id_mensagem, m.id_chat_file_origem, m.conversa,
+               m.message_timestamp, m.is_from_customer
+        FROM chats c
+        JOIN mensagens_por_arquivo m ON m.id_chat_file = c.id
+        WHERE m.is_from_customer IS NOT NULL
+    ),
+    mensagens AS (
+        SELECT id_contato, message_timestamp, is_from_customer,
+               lag(is_from_customer) OVER w AS anterior_do_cliente,
+               lag(message_timestamp) OVER w AS anterior_em
+        FROM mensagens_chats
+        WINDOW w AS (PARTITION BY id_contato, COALESCE(conversa, id_chat_file_origem::text)
+                     ORDER BY message_timestamp, id_mensagem)
+    ),
+    por_mensagens AS (
+        SELECT id_contato,
+               count(*) AS message_count,
+               count(*) FILTER (WHERE is_from_customer) AS customer_message_count,
+               min(message_timestamp) AS primeira,
+               max(message_timestamp) AS ultima,
+               avg(extract(epoch FROM message_timestamp - anterior_em))
+                   FILTER (WHERE NOT is_from_customer AND anterior_do_cliente) AS resposta_media
+        FROM mensagens
+        GROUP BY id_contato
+    ),
+    por_chats AS (
+        SELECT id_contato,
+               count(*) AS chat_count,
+               min(file_date)::timestamp AS primeira,
+               max(file_date)::timestamp AS ultima,
+               array_agg(DISTINCT id_ordem_servico ORDER BY id_ordem_servico)
+                   FILTER (WHERE id_ordem_servico IS NOT NULL) AS linked_orders
+        FROM chats
+        GROUP BY id_contato
+    )
+    INSERT INTO customer_chat_summaries (
+        id_contato, chat_count, message_count, customer_message_count,
+        first_interaction_date, last_interaction_date, avg_response_seconds,
+        linked_orders, updated_at
+    )
+    SELECT pc.id_contato, pc.chat_count,
+           COALESCE(pm.message_count, 0), COALESCE(pm.customer_message_count, 0),
+           COALESCE(pm.primeira, pc.primeira), COALESCE(pm.ultima, pc.ultima),
+           round(pm.resposta_media)::integer,
+           COALESCE(pc.linked_orders, '{}'), CURRENT_TIMESTAMP
+    FROM por_chats pc
+    LEFT JOIN por_mensagens pm ON pm.id_contato = pc.id_contato
+    ON CONFLICT (id_contato) DO UPDATE
+    SET chat_count = EXCLUDED.chat_count,
+        message_count = EXCLUDED.message_count,
+        customer_message_count = EXCLUDED.customer_message_count,
+        first_interaction_date = EXCLUDED.first_interaction_date,
+        last_interaction_date = EXCLUDED.last_interaction_date,
+        avg_response_seconds = EXCLUDED.avg_response_seconds,
+        linked_orders = EXCLUDED.linked_orders,
+        updated_at = EXCLUDED.updated_at
+"""
+
+# Contacts left without chats (moved to another contact or deleted)
+DELETE_EMPTY_SQL = """
+    DELETE FROM customer_chat_summaries s
+    WHERE s.id_contato = ANY(%(contatos)s)
+      AND NOT EXISTS (
+          SELECT 1 FROM chat_files cf
+          WHERE cf.id_contato = s.id_contato AND cf.processing_status IS DISTINCT FROM 'deleted'
+      )
+"""
+
+def log_json(level, message, **kwargs):
+    """Structured JSON logging function."""
+    log_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "level": level,
+        "message": message,
+        **kwargs
+    }
+    print(json.dumps(log_entry, ensure_ascii=False, default=str))
+
+def summaries_installed(conn):
+    """True if the pending-contacts table exists (setup has been run)."""
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('public.resumos_chat_pendentes') IS NOT NULL")
+    installed = cur.fetchone()[0]
+    cur.close()
+    return installed
+
+def refresh_chat_summaries(conn):
+    """
+    Recompute the summaries of every contact marked as pending.
+    A no-op when nothing changed or when setup was never run. Returns the number
+    of refreshed contacts.
+    """
+    if not summaries_installed(conn):
+        return 0
+
+    previous_autocommit = conn.autocommit
+    conn.autocommit = False
+    try:
+        cur = conn.cursor()
+        # SKIP LOCKED lets concurrent refreshes take disjoint contacts
+        cur.execute("""
+            DELETE FROM resumos_chat_pendentes
+            WHERE id_contato IN (SELECT id_contato FROM resumos_chat_pendentes FOR UPDATE SKIP LOCKED)
+            RETURNING id_contato
+        """)
+        contacts = [row[0] for row in cur.fetchall()]
+        if contacts:
+            cur.execute(RECOMPUTE_CONTACTS_SQL, {"contatos": contacts})
+            cur.execute(DELETE_EMPTY_SQL, {"contatos": contacts})
+        conn.commit()
+        if contacts:
+            log_json("INFO", "Customer chat summaries refreshed", contacts=len(contacts))
+        return len(contacts)
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error refreshing customer chat summaries: {e}")
+        return 0
+    finally:
+        conn.autocommit = previous_autocommit
+
+def setup_summaries(dry_run=False):
+    """Add the aggregate columns, triggers and view, then backfill every contact."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        cur = conn.cursor()
+        for sql in DEDUP_SETUP_STATEMENTS + SETUP_STATEMENTS + [MARK_ALL_CONTACTS_SQL]:
+            if dry_run:
+                print(sql.strip() + ";")
+            else:
+                cur.execute(sql)
+        if dry_run:
+            log_json("INFO", "[DRY RUN] No changes were made to the database")
+            return
+        conn.commit()
+        log_json("INFO", "Customer chat summary schema created, backfilling all contacts")
+        refresh_chat_summaries(conn)
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error setting up customer chat summaries: {e}")
+    finally:
+        close_db_connection(conn)
+
+def run_refresh(rebuild=False):
+    """Refresh pending contacts, optionally marking every contact first."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        if not summaries_installed(conn):
+            log_json("ERROR", "Chat summary tables not found, run 'setup' first")
+            return
+        if rebuild:
+            cur = conn.cursor()
+            cur.execute(MARK_ALL_CONTACTS_SQL)
+            conn.commit()
+        refreshed = refresh_chat_summaries(conn)
+        log_json("INFO", "Customer chat summary refresh complete", contacts_refreshed=refreshed)
+    finally:
+        close_db_connection(conn)
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Maintain per-customer WhatsApp chat summaries')
+    parser.add_argument('command', choices=['setup', 'refresh', 'rebuild'], help='Action to run')
+    parser.add_argument('--dry-run', action='store_true', help='Print setup SQL without executing it')
+    args = parser.parse_args()
+
+    if args.command == 'setup':
+        setup_summaries(dry_run=args.dry_run)
+    else:
+        run_refresh(rebuild=args.command == 'rebuild')
+
+if __name__ == "__main__":
+    main()
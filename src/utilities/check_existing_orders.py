@@ -37,18 +37,55 @@ def check_existing_orders():
     try:
         cur = conn.cursor()
         
+        # Usa as tabelas de KPI pré-calculadas (kpi_rollup.py) quando existirem e estiverem
+        # em dia; com meses pendentes de refresh, as contagens vêm direto de ordens_servico
+        cur.execute("""
+            SELECT to_regclass('public.kpi_ordens_mensal') IS NOT NULL
+               AND to_regclass('public.kpi_meses_pendentes') IS NOT NULL;
+        """)
+        use_rollup = cur.fetchone()[0]
+        if use_rollup:
+            cur.execute("SELECT NOT EXISTS (SELECT 1 FROM kpi_meses_pendentes);")
+            use_rollup = cur.fetchone()[0]
+            if not use_rollup:
+                print("\nkpi_ordens_mensal tem meses pendentes de refresh; contando em ordens_servico.")
+        if use_rollup:
+            print("\nUsando contagens pré-calculadas de kpi_ordens_mensal.")
+        
         # Contagem total de ordens
-        cur.execute("SELECT COUNT(*) FROM ordens_servico;")
+        if use_rollup:
+            cur.execute("""
+                SELECT COALESCE((SELECT SUM(qtd_ordens) FROM kpi_ordens_mensal), 0)
+                     + (SELECT COUNT(*) FROM ordens_servico WHERE data_emissao IS NULL);
+            """)
+        else:
+            cur.execute("SELECT COUNT(*) FROM ordens_servico;")
         total_orders = cur.fetchone()[0]
         print(f"\nTotal de ordens no banco de dados: {total_orders}")
         
-        # Contagem por situação
-        cur.execute("""
-            SELECT situacao, COUNT(*) 
-            FROM ordens_servico 
-            GROUP BY situacao 
-            ORDER BY COUNT(*) DESC;
-        """)
+        # Contagem por situação (ordens sem data_emissao não entram no rollup)
+        if use_rollup:
+            cur.execute("""
+                SELECT situacao, SUM(qtd)
+                FROM (
+                    SELECT NULLIF(situacao, '') AS situacao, qtd_ordens AS qtd
+                    FROM kpi_ordens_mensal
+                    UNION ALL
+                    SELECT NULLIF(situacao, ''), COUNT(*)
+                    FROM ordens_servico
+                    WHERE data_emissao IS NULL
+                    GROUP BY 1
+                ) AS contagens
+                GROUP BY situacao
+                ORDER BY SUM(qtd) DESC;
+            """)
+        else:
+            cur.execute("""
+                SELECT situacao, COUNT(*) 
+                FROM ordens_servico 
+                GROUP BY situacao 
+                ORDER BY COUNT(*) DESC;
+            """)
         situation_counts = cur.fetchall()
         
         print("\nQuantidade de ordens por situação:")
@@ -68,33 +105,39 @@ def check_existing_orders():
             print(f"  {situation_desc}: {count}")
         
         # Contagem por ano/mês
-        cur.execute("""
-            SELECT 
-                EXTRACT(YEAR FROM data_emissao) AS ano,
-                EXTRACT(MONTH FROM data_emissao) AS mes,
-                COUNT(*) 
-            FROM ordens_servico 
-            WHERE data_emissao IS NOT NULL
-            GROUP BY ano, mes 
-            ORDER BY ano DESC, mes DESC;
-        """)
+        if use_rollup:
+            cur.execute("""
+                SELECT 
+                    EXTRACT(YEAR FROM mes) AS ano,
+                    EXTRACT(MONTH FROM mes) AS mes,
+                    SUM(qtd_ordens) 
+                FROM kpi_ordens_mensal 
+                GROUP BY 1, 2 
+                ORDER BY ano DESC, mes DESC;
+            """)
+        else:
+            cur.execute("""
+                SELECT 
+                    EXTRACT(YEAR FROM data_emissao) AS ano,
+                    EXTRACT(MONTH FROM data_emissao) AS mes,
+                    COUNT(*) 
+                FROM ordens_servico 
+                WHERE data_emissao IS NOT NULL
+                GROUP BY ano, mes 
+                ORDER BY ano DESC, mes DESC;
+            """)
         date_counts = cur.fetchall()
         
         print("\nQuantidade de ordens por ano/mês:")
         for year, month, count in date_counts:
             print(f"  {int(year)}/{int(month):02d}: {count}")
         
-        # Verificar ordens de 2024 e 2025
-        cur.execute("""
-            SELECT 
-                EXTRACT(YEAR FROM data_emissao) AS ano,
-                COUNT(*) 
-            FROM ordens_servico 
-            WHERE EXTRACT(YEAR FROM data_emissao) IN (2024, 2025)
-            GROUP BY ano 
-            ORDER BY ano;
-        """)
-        year_counts = cur.fetchall()
+        # Verificar ordens de 2024 e 2025 (derivado da contagem por ano/mês)
+        year_totals = {}
+        for year, month, count in date_counts:
+            if int(year) in (2024, 2025):
+                year_totals[int(year)] = year_totals.get(int(year), 0) + count
+        year_counts = sorted(year_totals.items())
         
         print("\nOrdens de 2024 e 2025:")
         for year, count in year_counts:
@@ -120,39 +163,13 @@ def check_existing_orders():
             situation_desc = situation_map.get(situation, f"Desconhecido ({situation})")
             print(f"  ID: {order_id}, Número OS: {order_number}, Data: {emission_date}, Situação: {situation_desc}, Extraído em: {extraction_date}")
         
-        # Verificar ordens por mês em 2024
-        if any(int(year) == 2024 for year, _ in year_counts):
-            cur.execute("""
-                SELECT 
-                    EXTRACT(MONTH FROM data_emissao) AS mes,
-                    COUNT(*) 
-                FROM ordens_servico 
-                WHERE EXTRACT(YEAR FROM data_emissao) = 2024
-                GROUP BY mes 
-                ORDER BY mes;
-            """)
-            month_counts_2024 = cur.fetchall()
-            
-            print("\nOrdens de 2024 por mês:")
-            for month, count in month_counts_2024:
-                print(f"  Mês {int(month)}: {count}")
-        
-        # Verificar ordens por mês em 2025
-        if any(int(year) == 2025 for year, _ in year_counts):
-            cur.execute("""
-                SELECT 
-                    EXTRACT(MONTH FROM data_emissao) AS mes,
-                    COUNT(*) 
-                FROM ordens_servico 
-                WHERE EXTRACT(YEAR FROM data_emissao) = 2025
-                GROUP BY mes 
-                ORDER BY mes;
-            """)
-            month_counts_2025 = cur.fetchall()
-            
-            print("\nOrdens de 2025 por mês:")
-            for month, count in month_counts_2025:
-                print(f"  Mês {int(month)}: {count}")
+        # Verificar ordens por mês em 2024 e 2025 (sem nova varredura da tabela)
+        for target_year in (2024, 2025):
+            if any(int(year) == target_year for year, _ in year_counts):
+                print(f"\nOrdens de {target_year} por mês:")
+                for year, month, count in sorted(date_counts, key=lambda row: row[1]):
+                    if int(year) == target_year:
+                        print(f"  Mês {int(month)}: {count}")
         
     except Exception as e:
         print(f"Erro ao consultar o banco de dados: {e}")
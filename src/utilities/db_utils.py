@@ -37,6 +37,69 @@ def close_db_connection(conn):
         conn.close()
         print("Database connection closed.")
 
+# Partitioning status per table; it only changes when partition_ordens_servico.py migrates
+_partitioned_tables = {}
+
+def is_partitioned_table(conn, table_name="ordens_servico"):
+    """Returns True if the table is declaratively partitioned (cached per process)."""
+    if table_name not in _partitioned_tables:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM pg_partitioned_table pt
+                JOIN pg_class c ON c.oid = pt.partrelid
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname = 'public' AND c.relname = %s
+            )
+        """, (table_name,))
+        _partitioned_tables[table_name] = cur.fetchone()[0]
+        cur.close()
+    return _partitioned_tables[table_name]
+
+def upsert_ordem_servico(cur, values):
+    """
+    Inserts or updates one row of ordens_servico from a {column: value} dict
+    that includes "id"; data_extracao is set to CURRENT_TIMESTAMP.
+
+    The heap layout uses INSERT ... ON CONFLICT (id). In the partitioned one the
+    unique key is (id, data_emissao), so ON CONFLICT could not see an order whose
+    data_emissao changed: the row is updated by id first (which moves it to its new
+    partition) and only inserted when no row has that id. A transaction-level
+    advisory lock on the id keeps concurrent loaders from both inserting it.
+    Returns "updated" or "inserted".
+    """
+    columns = list(values)
+    if not is_partitioned_table(cur.connection):
+        placeholders = ", ".join(f"%({column})s" for column in columns)
+        assignments = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns if column != "id")
+        cur.execute(
+            f"INSERT INTO ordens_servico ({', '.join(columns)}, data_extracao) "
+            f"VALUES ({placeholders}, CURRENT_TIMESTAMP) "
+            f"ON CONFLICT (id) DO UPDATE SET {assignments}, data_extracao = CURRENT_TIMESTAMP "
+            f"RETURNING xmax = 0",
+            values
+        )
+        return "inserted" if cur.fetchone()[0] else "updated"
+
+    cur.execute("SELECT pg_advisory_xact_lock('ordens_servico'::regclass::oid::integer, %(id)s)", values)
+    assignments = ", ".join(f"{column} = %({column})s" for column in columns if column != "id")
+    cur.execute(
+        f"UPDATE ordens_servico SET {assignments}, data_extracao = CURRENT_TIMESTAMP WHERE id = %(id)s",
+        values
+    )
+    if cur.rowcount:
+        return "updated"
+    insert_ordem_servico(cur, values)
+    return "inserted"
+
+def insert_ordem_servico(cur, values):
+    """Inserts one row of ordens_servico from a {column: value} dict, with data_extracao = CURRENT_TIMESTAMP."""
+    placeholders = ", ".join(f"%({column})s" for column in values)
+    cur.execute(
+        f"INSERT INTO ordens_servico ({', '.join(values)}, data_extracao) VALUES ({placeholders}, CURRENT_TIMESTAMP)",
+        values
+    )
+
 if __name__ == '__main__':
     # Example usage (for testing the connection)
     conn = get_db_connection()
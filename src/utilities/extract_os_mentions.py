@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Extract the service order numbers mentioned in WhatsApp messages into
+chat_mencoes_os (message, chat, numero_ordem_servico), so the chat/order linker
+and the order detail document join on an indexed column instead of running
+regular expressions over chat_messages.
+
+Recognized mentions: "OS 1234", "O.S. 1234", "OS nº 1234", "os #1234",
+"ordem de serviço 1234" (3 to 7 digits), and lists such as "OS 1298 e 1299".
+A lowercase "os" only counts with a nº/#/: marker, since it is also the
+Portuguese article.
+
+Messages are read per batch of chat files, with a SQL prefilter so only
+candidate messages leave the database: a word starting with "os"/"o.s"/"ordem"
+followed by a digit within 20 characters. A partial index on chat_messages (id_chat_file)
+holds just the messages matching that filter, so the regex runs once per
+message at load time instead of on every scan. One precompiled pattern runs
+over the batch, and the mentions are written with one multi-row INSERT per batch. Runs
+are incremental: a file is rescanned when its messages were loaded after its
+last scan (mentions_checked_at).
+
+Usage:
+    python extract_os_mentions.py setup [--dry-run]
+    python extract_os_mentions.py extract [--rescan] [--dry-run]
+"""
+
+import re
+import json
+import time
+import argparse
+from datetime import datetime
+from psycopg2.extras import execute_values
+from db_utils import get_db_connection, close_db_connection
+
+# Configuration
+BATCH_FILES = 500   # Chat files per read/insert transaction
+
+# Cheap server-side filter that every MENTION_RE match passes ("OS1234" included, so no
+# word end after the prefix). The partial index and the candidate query must use the
+# same text, so the planner can match the index predicate.
+CANDIDATE_FILTER = r"message_text ~* '\m(o\.?\s*s|ordem)\D{0,20}\d'"
+
+SETUP_STATEMENTS = [
+    "ALTER TABLE chat_files ADD COLUMN IF NOT EXISTS mentions_checked_at TIMESTAMP",
+    # Also added by load_chat_messages.py setup
+    "ALTER TABLE chat_files ADD COLUMN IF NOT EXISTS messages_loaded_at TIMESTAMP",
+    # Mentions go away with their message when a transcript is reloaded
+    """
+    CREATE TABLE IF NOT EXISTS chat_mencoes_os (
+        id_mensagem INTEGER NOT NULL REFERENCES chat_messages (id) ON DELETE CASCADE,
+        id_chat_file INTEGER NOT NULL REFERENCES chat_files (id),
+        numero_ordem_servico VARCHAR(50) NOT NULL,
+        message_timestamp TIMESTAMP,
+        PRIMARY KEY (id_mensagem, numero_ordem_servico)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_chat_mencoes_os_numero ON chat_mencoes_os (numero_ordem_servico)",
+    "CREATE INDEX IF NOT EXISTS idx_chat_mencoes_os_chat ON chat_mencoes_os (id_chat_file)",
+    # Recreated so an index built with an older filter text picks up the current one
+    "DROP INDEX IF EXISTS idx_chat_messages_candidatas_os",
+    "CREATE INDEX idx_chat_messages_candidatas_os ON chat_messages (id_chat_file) WHERE "
+    + CANDIDATE_FILTER,
+]
+
+MENTION_RE = re.compile(
+    r"(?:\b(?:OS|O\.S\.?|[Oo]rdem\s+de\s+[Ss]ervi[çc]o)\s*(?:n[º°o.]?\s*)?[:#]?"
+    r"|\b[Oo][Ss]\s*(?:n[º°o.]\s*[:#]?|[:#]))"
+    r"\s*(\d{3,7}(?:\s*(?:,|/|\be\b)\s*\d{3,7})*)\b"
+)
+NUMBER_RE = re.compile(r"\d{3,7}")
+
+CANDIDATE_MESSAGES_SQL = """
+    SELECT id, id_chat_file, message_timestamp, message_text
+    FROM chat_messages
+    WHERE id_chat_file = ANY(%s) AND """ + CANDIDATE_FILTER
+
+PENDING_FILES_SQL = """
+    SELECT id FROM chat_files
+    WHERE messages_loaded_at IS NOT NULL
+      AND (%(rescan)s OR mentions_checked_at IS NULL OR messages_loaded_at > mentions_checked_at)
+    ORDER BY id
+"""
+
+INSERT_MENTIONS_SQL = """
+    INSERT INTO chat_mencoes_os (id_mensagem, id_chat_file, numero_ordem_servico, message_timestamp)
+    VALUES %s
+    ON CONFLICT DO NOTHING
+"""
+
+def log_json(level, message, **kwargs):
+    """Structured JSON logging function."""
+    log_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "level": level,
+        "message": message,
+        **kwargs
+    }
+    print(json.dumps(log_entry, ensure_ascii=False, default=str))
+
+def batch_mentions(rows):
+    """(message id, chat file id, order number, timestamp) of every distinct mention in the rows."""
+    mentions = []
+    for message_id, file_id, timestamp, text in rows:
+        # "OS 1234 ... OS 1234" is one mention of that order
+        numbers = dict.fromkeys(
+            number for match in MENTION_RE.finditer(text) for number in NUMBER_RE.findall(match.group(1))
+        )
+        mentions.extend((message_id, file_id, number, timestamp) for number in numbers)
+    return mentions
+
+def setup_mentions(dry_run=False):
+    """Create the mentions table, its indexes and the scan column on chat_files."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        cur = conn.cursor()
+        for sql in SETUP_STATEMENTS:
+            if dry_run:
+                print(sql.strip() + ";")
+            else:
+                cur.execute(sql)
+        if dry_run:
+            log_json("INFO", "[DRY RUN] No changes were made to the database")
+        else:
+            conn.commit()
+            log_json("INFO", "Chat order mention table ready")
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error setting up chat order mentions: {e}")
+    finally:
+        close_db_connection(conn)
+
+def extract_mentions(rescan=False, dry_run=False):
+    """Scan the pending chat files batch by batch, replacing their mentions."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    started = time.monotonic()
+    counts = {"files": 0, "candidate_messages": 0, "mentions": 0}
+    try:
+        cur = conn.cursor()
+        cur.execute(PENDING_FILES_SQL, {"rescan": rescan})
+        file_ids = [row[0] for row in cur.fetchall()]
+        log_json("INFO", "Starting order mention extraction", pending_files=len(file_ids), dry_run=dry_run)
+
+        for start in range(0, len(file_ids), BATCH_FILES):
+            batch = file_ids[start:start + BATCH_FILES]
+            cur.execute(CANDIDATE_MESSAGES_SQL, (batch,))
+            rows = cur.fetchall()
+            mentions = batch_mentions(rows)
+            counts["files"] += len(batch)
+            counts["candidate_messages"] += len(rows)
+            counts["mentions"] += len(mentions)
+            if dry_run:
+                continue
+
+            cur.execute("DELETE FROM chat_mencoes_os WHERE id_chat_file = ANY(%s)", (batch,))
+            if mentions:
+                execute_values(cur, INSERT_MENTIONS_SQL, mentions, page_size=1000)
+            cur.execute("UPDATE chat_files SET mentions_checked_at = CURRENT_TIMESTAMP WHERE id = ANY(%s)", (batch,))
+            conn.commit()
+
+        if dry_run:
+            log_json("INFO", "[DRY RUN] No changes were made to the database", **counts)
+            return
+        log_json("INFO", "Order mention extraction complete",
+                 elapsed_seconds=round(time.monotonic() - started, 1), **counts)
+
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error extracting order mentions: {e}")
+    finally:
+        close_db_connection(conn)
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Extract service order numbers mentioned in WhatsApp messages')
+    parser.add_argument('command', choices=['setup', 'extract'], help='Action to run')
+    parser.add_argument('--rescan', action='store_true', help='Scan every loaded chat file again')
+    parser.add_argument('--dry-run', action='store_true', help='Count the mentions without writing them')
+    args = parser.parse_args()
+
+    if args.command == 'setup':
+        setup_mentions(dry_run=args.dry_run)
+    else:
+        extract_mentions(rescan=args.rescan, dry_run=args.dry_run)
+
+if __name__ == "__main__":
+    main()
@@ -3,21 +3,67 @@
 
 """
 Script to index WhatsApp chat files in the database.
-This script scans the organized_whatsapp_chats directory and indexes files in the chat_files table.
+This script scans the organized_whatsapp_chats/<year>/<month> directories (all of
+them, one year, or one month) and indexes files in the chat_files table.
+Known files are compared against a manifest (size, mtime, content hash) loaded
+once per run, so only new, changed and deleted files reach the database.
+Run with --setup once to add the manifest columns and the unique path index.
+Months packed with pack_chat_archives.py are read from their .chatpack archive
+(see chat_archive.py) under the same paths, sizes and hashes.
+For parallel indexing plus message parsing, use load_chat_messages.py load --workers N.
 """
 
 import os
 import sys
 import json
 import re
+import time
 from datetime import datetime
 import psycopg2
+from psycopg2.extras import execute_values
 from db_utils import get_db_connection, close_db_connection
+from chat_archive import ARCHIVE_SUFFIX, shard_archive, transcript_stat, transcript_sha256
 
 # Configuration
 CHATS_DIR = "organized_whatsapp_chats"
-YEAR_FILTER = "2025"  # Initial focus on 2025 data
-BATCH_SIZE = 100
+BATCH_SIZE = 1000   # Rows per multi-row INSERT/UPDATE
+
+MANIFEST_SETUP_STATEMENTS = [
+    "ALTER TABLE chat_files ADD COLUMN IF NOT EXISTS file_size BIGINT",
+    "ALTER TABLE chat_files ADD COLUMN IF NOT EXISTS file_mtime_ns BIGINT",
+    "ALTER TABLE chat_files ADD COLUMN IF NOT EXISTS file_hash CHAR(64)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_chat_files_path_unique ON chat_files (file_path)",
+]
+
+# New files; a path indexed meanwhile (e.g. by load_chat_messages.py) only gets its manifest entry
+INSERT_FILES_SQL = """
+    INSERT INTO chat_files
+    (filename, file_path, file_date, phone_number, customer_name, reference_os,
+     file_size, file_mtime_ns, file_hash, processing_status)
+    VALUES %s
+    ON CONFLICT (file_path) DO UPDATE
+    SET file_size = EXCLUDED.file_size,
+        file_mtime_ns = EXCLUDED.file_mtime_ns,
+        file_hash = EXCLUDED.file_hash
+"""
+INSERT_FILES_TEMPLATE = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, 'pending')"
+
+# Content changed (or a deleted file came back): back to pending for the loaders
+UPDATE_CHANGED_SQL = """
+    UPDATE chat_files AS cf
+    SET file_size = v.file_size, file_mtime_ns = v.file_mtime_ns, file_hash = v.file_hash,
+        processing_status = 'pending'
+    FROM (VALUES %s) AS v(id, file_size, file_mtime_ns, file_hash)
+    WHERE cf.id = v.id
+"""
+
+# Same content under a new size/mtime (e.g. copied back): only the manifest moves
+UPDATE_TOUCHED_SQL = """
+    UPDATE chat_files AS cf
+    SET file_size = v.file_size, file_mtime_ns = v.file_mtime_ns, file_hash = v.file_hash
+    FROM (VALUES %s) AS v(id, file_size, file_mtime_ns, file_hash)
+    WHERE cf.id = v.id
+"""
 
 def log_json(level, message, **kwargs):
     """Structured JSON logging function."""
@@ -65,137 +111,224 @@ def extract_filename_data(filename):
         log_json("WARNING", f"Error parsing filename {filename}: {e}")
         return None
 
-def file_already_indexed(conn, file_path):
-    """Check if a file is already indexed in the database."""
+def chat_shards(year=None, month=None):
+    """
+    The <year>/<month> directories of CHATS_DIR to process, in chronological order,
+    optionally restricted to one year and/or one month. A packed month counts even
+    when its directory is gone.
+    """
+    def subdirs(path):
+        return sorted(d for d in os.listdir(path) if d.isdigit() and os.path.isdir(os.path.join(path, d)))
+
+    def months_of(year_dir):
+        names = set(subdirs(year_dir))
+        names.update(
+            entry[:-len(ARCHIVE_SUFFIX)] for entry in os.listdir(year_dir)
+            if entry.endswith(ARCHIVE_SUFFIX) and entry[:-len(ARCHIVE_SUFFIX)].isdigit()
+        )
+        return sorted(names)
+
+    shards = []
+    years = [str(year)] if year else subdirs(CHATS_DIR)
+    for year_name in years:
+        year_dir = os.path.join(CHATS_DIR, year_name)
+        if not os.path.isdir(year_dir):
+            continue
+        months = [str(month).zfill(2)] if month else months_of(year_dir)
+        for month_name in months:
+            month_dir = os.path.join(year_dir, month_name)
+            if os.path.isdir(month_dir) or os.path.exists(month_dir + ARCHIVE_SUFFIX):
+                shards.append(month_dir)
+    return shards
+
+def chat_file_names(shard_dir):
+    """Transcript file names of one <year>/<month> directory and its archive, sorted."""
+    names = set()
+    if os.path.isdir(shard_dir):
+        names.update(
+            file for file in os.listdir(shard_dir)
+            if file.startswith("WhatsApp") and file.endswith(".txt")
+        )
+    archive = shard_archive(shard_dir)
+    if archive is not None:
+        names.update(archive.names())
+    return sorted(names)
+
+def setup_manifest(dry_run=False):
+    """
+    Add the manifest columns (size, mtime, hash) to chat_files and make file_path
+    unique, which the multi-row INSERT ... ON CONFLICT of the indexer relies on.
+    """
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT count(*) FROM (
+                SELECT file_path FROM chat_files GROUP BY file_path HAVING count(*) > 1
+            ) AS d
+        """)
+        duplicates = cur.fetchone()[0]
+        if duplicates:
+            log_json("ERROR", "chat_files has duplicated file_path values; remove them before setup",
+                    duplicated_paths=duplicates)
+            return
+
+        for sql in MANIFEST_SETUP_STATEMENTS:
+            if dry_run:
+                print(sql + ";")
+            else:
+                cur.execute(sql)
+        if dry_run:
+            log_json("INFO", "[DRY RUN] No changes were made to the database")
+        else:
+            conn.commit()
+            log_json("INFO", "chat_files manifest columns and unique path index ready")
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error setting up chat file manifest: {e}")
+    finally:
+        close_db_connection(conn)
+
+def manifest_installed(conn):
+    """True if the unique path index that INSERT_FILES_SQL's ON CONFLICT needs exists (--setup has been run)."""
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('public.idx_chat_files_path_unique') IS NOT NULL")
+    installed = cur.fetchone()[0]
+    cur.close()
+    return installed
+
+def load_manifest(conn, shards):
+    """{file_path: (id, size, mtime_ns, hash, status)} of the indexed files under the given shards."""
     cur = conn.cursor()
-    cur.execute("SELECT id FROM chat_files WHERE file_path = %s", (file_path,))
-    result = cur.fetchone()
-    return result is not None
+    cur.execute("""
+        SELECT file_path, id, file_size, file_mtime_ns, file_hash, processing_status
+        FROM chat_files
+        WHERE file_path LIKE ANY(%s)
+    """, ([os.path.join(shard_dir, "%") for shard_dir in shards],))
+    manifest = {row[0]: row[1:] for row in cur.fetchall()}
+    cur.close()
+    return manifest
 
-def index_chat_files(start_year=YEAR_FILTER, dry_run=False):
+def index_chat_files(year=None, month=None, dry_run=False):
     """
-    Scan directory recursively for chat files and index them in the database.
+    Reconcile chat_files with the year/month directories (optionally one year
+    and/or month) in a single pass against the in-memory manifest:
+    - new files are inserted in multi-row batches;
+    - files whose size or mtime moved are re-hashed and, if the content changed,
+      set back to 'pending' with their new manifest entry;
+    - indexed files no longer on disk are marked 'deleted'.
+    Unchanged files cost one stat() call and no query.
     If dry_run is True, no changes will be made to the database.
     """
+    if not os.path.exists(CHATS_DIR):
+        log_json("ERROR", f"Chat directory {CHATS_DIR} does not exist")
+        return
+
     conn = get_db_connection()
     if not conn:
         log_json("ERROR", "Failed to connect to database")
         return
     
+    started = time.monotonic()
     try:
-        indexed_count = 0
-        skipped_count = 0
+        if not manifest_installed(conn):
+            log_json("ERROR", "Unique file_path index not found, run with '--setup' first")
+            return
+        shards = chat_shards(year, month)
+        manifest = load_manifest(conn, shards)
+        log_json("INFO", f"Starting chat file indexing (dry_run={dry_run})",
+                year=year or "all", month=month or "all", directories=len(shards), known_files=len(manifest))
+
+        new_files = []
+        changed_files = []   # (id, size, mtime_ns, hash)
+        touched_files = []   # Same content, new size/mtime
+        seen = set()
         error_count = 0
         
-        if not os.path.exists(CHATS_DIR):
-            log_json("ERROR", f"Chat directory {CHATS_DIR} does not exist")
-            return
-            
-        # Use batch processing to avoid large transactions
-        batch_files = []
+        for shard_dir in shards:
+            for file in chat_file_names(shard_dir):
+                file_path = os.path.join(shard_dir, file)
+                seen.add(file_path)
+                file_size, file_mtime_ns = transcript_stat(file_path)
+                entry = manifest.get(file_path)
+                if entry:
+                    file_id, size, mtime_ns, file_hash, status = entry
+                    if size == file_size and mtime_ns == file_mtime_ns and status != "deleted":
+                        continue
+                    content_hash = transcript_sha256(file_path)
+                    # Rows indexed before the manifest existed only get their entry filled in
+                    if file_hash is None or (content_hash == file_hash and status != "deleted"):
+                        touched_files.append((file_id, file_size, file_mtime_ns, content_hash))
+                    else:
+                        changed_files.append((file_id, file_size, file_mtime_ns, content_hash))
+                    continue
+                
+                # Parse filename components
+                file_data = extract_filename_data(file)
+                if not file_data:
+                    log_json("WARNING", f"Could not parse filename, skipping: {file}")
+                    error_count += 1
+                    continue
+                new_files.append((
+                    file, file_path, file_data["file_date"], file_data["phone_number"],
+                    file_data["name_or_phone"], file_data["reference_os"],
+                    file_size, file_mtime_ns, transcript_sha256(file_path)
+                ))
         
-        log_json("INFO", f"Starting chat file indexing for year {start_year} (dry_run={dry_run})")
+        deleted_ids = [entry[0] for path, entry in manifest.items() if path not in seen and entry[4] != "deleted"]
+        counts = {
+            "new": len(new_files), "changed": len(changed_files), "touched": len(touched_files),
+            "deleted": len(deleted_ids), "unchanged": len(seen) - len(new_files) - len(changed_files)
+                                                     - len(touched_files) - error_count,
+            "errors": error_count
+        }
         
-        # First, find all chat files for the target year
-        for root, dirs, files in os.walk(os.path.join(CHATS_DIR, start_year)):
-            for file in files:
-                if file.startswith("WhatsApp") and file.endswith(".txt"):
-                    file_path = os.path.join(root, file)
-                    
-                    # Check if file is already indexed
-                    if file_already_indexed(conn, file_path):
-                        log_json("DEBUG", f"File already indexed, skipping: {file_path}")
-                        skipped_count += 1
-                        continue
-                    
-                    # Parse filename components
-                    file_data = extract_filename_data(file)
-                    if not file_data:
-                        log_json("WARNING", f"Could not parse filename, skipping: {file}")
-                        error_count += 1
-                        continue
-                    
-                    # Add to batch
-                    batch_files.append({
-                        "filename": file,
-                        "file_path": file_path,
-                        "file_date": file_data["file_date"],
-                        "phone_number": file_data["phone_number"],
-                        "customer_name": file_data["name_or_phone"],
-                        "reference_os": file_data["reference_os"]
-                    })
-                    
-                    # Process batch if it reaches the batch size
-                    if len(batch_files) >= BATCH_SIZE:
-                        process_batch(conn, batch_files, dry_run)
-                        indexed_count += len(batch_files)
-                        batch_files = []
-                        
-                        log_json("INFO", f"Processed batch of {BATCH_SIZE} files", 
-                                indexed=indexed_count, skipped=skipped_count, errors=error_count)
+        if dry_run:
+            for file in new_files[:20]:
+                log_json("INFO", f"[DRY RUN] Would index file: {file[0]}", file_date=file[2], phone=file[3], os_ref=file[5])
+            log_json("INFO", "[DRY RUN] No changes were made to the database", **counts)
+            return
         
-        # Process remaining files
-        if batch_files:
-            process_batch(conn, batch_files, dry_run)
-            indexed_count += len(batch_files)
+        cur = conn.cursor()
+        for start in range(0, len(new_files), BATCH_SIZE):
+            execute_values(cur, INSERT_FILES_SQL, new_files[start:start + BATCH_SIZE],
+                           template=INSERT_FILES_TEMPLATE, page_size=BATCH_SIZE)
+        if changed_files:
+            execute_values(cur, UPDATE_CHANGED_SQL, changed_files, page_size=BATCH_SIZE)
+        if touched_files:
+            execute_values(cur, UPDATE_TOUCHED_SQL, touched_files, page_size=BATCH_SIZE)
+        if deleted_ids:
+            cur.execute("UPDATE chat_files SET processing_status = 'deleted' WHERE id = ANY(%s)", (deleted_ids,))
+        conn.commit()
         
-        log_json("INFO", "Chat file indexing complete", 
-                indexed=indexed_count, skipped=skipped_count, errors=error_count)
+        log_json("INFO", "Chat file indexing complete",
+                elapsed_seconds=round(time.monotonic() - started, 1), **counts)
         
     except Exception as e:
-        if not dry_run:
-            conn.rollback()
+        conn.rollback()
         log_json("ERROR", f"Error indexing chat files: {e}")
     finally:
         close_db_connection(conn)
 
-def process_batch(conn, batch_files, dry_run):
-    """Process a batch of files by inserting them into the database."""
-    if dry_run:
-        for file in batch_files:
-            log_json("INFO", f"[DRY RUN] Would index file: {file['filename']}", 
-                    file_date=file['file_date'],
-                    phone=file['phone_number'],
-                    os_ref=file['reference_os'])
-        return
-    
-    # Insert files into database
-    cur = conn.cursor()
-    for file in batch_files:
-        try:
-            cur.execute("""
-                INSERT INTO chat_files
-                (filename, file_path, file_date, phone_number, customer_name, reference_os, processing_status)
-                VALUES (%s, %s, %s, %s, %s, %s, 'pending')
-                RETURNING id
-            """, (
-                file['filename'], 
-                file['file_path'], 
-                file['file_date'], 
-                file['phone_number'], 
-                file['customer_name'], 
-                file['reference_os']
-            ))
-            file_id = cur.fetchone()[0]
-            
-            log_json("DEBUG", f"Indexed chat file (ID: {file_id}): {file['filename']}")
-        except Exception as e:
-            log_json("ERROR", f"Error indexing file {file['filename']}: {e}")
-            # Continue with other files in batch
-    
-    # Commit the batch
-    conn.commit()
-
 def main():
     """Main entry point."""
     import argparse
     
     parser = argparse.ArgumentParser(description='Index WhatsApp chat files in the database')
-    parser.add_argument('--year', default=YEAR_FILTER, help='Year to filter for indexing (default: 2025)')
+    parser.add_argument('--year', help='Only index this year (default: all years)')
+    parser.add_argument('--month', help='Only index this month (01-12), across the selected years')
+    parser.add_argument('--setup', action='store_true', help='Add the manifest columns and unique path index, then exit')
     parser.add_argument('--dry-run', action='store_true', help='Simulate operations without modifying the database')
     args = parser.parse_args()
     
-    index_chat_files(start_year=args.year, dry_run=args.dry_run)
+    if args.setup:
+        setup_manifest(dry_run=args.dry_run)
+    else:
+        index_chat_files(year=args.year, month=args.month, dry_run=args.dry_run)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
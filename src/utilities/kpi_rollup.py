@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Monthly KPI rollup tables for ordens_servico.
+
+kpi_ordens_mensal holds one row per (mes, situacao, tecnico, origem_cliente) with
+order counts, summed totals, commission and turnaround days, so dashboards and
+check_existing_orders.py read precomputed numbers instead of GROUP BY over the
+whole table.
+
+Statement-level triggers on ordens_servico record which data_emissao months were
+touched in kpi_meses_pendentes. Loaders call refresh_kpi_rollups() after each
+batch and only those months are recomputed.
+
+Usage:
+    python kpi_rollup.py setup [--dry-run]   # tables, triggers and initial backfill
+    python kpi_rollup.py refresh             # recompute pending months
+    python kpi_rollup.py rebuild             # mark every month and recompute
+"""
+
+import json
+import argparse
+from datetime import datetime
+from db_utils import get_db_connection, close_db_connection
+
+SETUP_STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS kpi_ordens_mensal (
+        mes DATE NOT NULL,
+        situacao VARCHAR(10) NOT NULL DEFAULT '',
+        tecnico VARCHAR(255) NOT NULL DEFAULT '',
+        origem_cliente VARCHAR(255) NOT NULL DEFAULT '',
+        qtd_ordens INTEGER NOT NULL,
+        total_ordem_servico NUMERIC(14, 2) NOT NULL DEFAULT 0,
+        total_servicos NUMERIC(14, 2) NOT NULL DEFAULT 0,
+        total_pecas NUMERIC(14, 2) NOT NULL DEFAULT 0,
+        vlr_comissao NUMERIC(14, 2) NOT NULL DEFAULT 0,
+        qtd_concluidas INTEGER NOT NULL DEFAULT 0,
+        dias_conclusao_total BIGINT NOT NULL DEFAULT 0,
+        atualizado_em TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (mes, situacao, tecnico, origem_cliente)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS kpi_meses_pendentes (
+        mes DATE PRIMARY KEY,
+        marcado_em TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    # Month ranges are recomputed with range scans on data_emissao
+    "CREATE INDEX IF NOT EXISTS idx_ordens_servico_data_emissao ON ordens_servico (data_emissao)",
+    """
+    CREATE OR REPLACE FUNCTION kpi_marcar_meses_ordens() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO kpi_meses_pendentes (mes)
+            SELECT DISTINCT date_trunc('month', data_emissao)::date
+            FROM novas WHERE data_emissao IS NOT NULL
+            ON CONFLICT DO NOTHING;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            INSERT INTO kpi_meses_pendentes (mes)
+            SELECT DISTINCT date_trunc('month', data_emissao)::date
+            FROM antigas WHERE data_emissao IS NOT NULL
+            ON CONFLICT DO NOTHING;
+        END IF;
+        RETURN NULL;
+    END;
+    $$
+    """,
+    # Transition tables allow a single event per trigger, hence three triggers
+    "DROP TRIGGER IF EXISTS trg_kpi_ordens_insert ON ordens_servico",
+    """
+    CREATE TRIGGER trg_kpi_ordens_insert AFTER INSERT ON ordens_servico
+    REFERENCING NEW TABLE AS novas
+    FOR EACH STATEMENT EXECUTE FUNCTION kpi_marcar_meses_ordens()
+    """,
+    "DROP TRIGGER IF EXISTS trg_kpi_ordens_update ON ordens_servico",
+    """
+    CREATE TRIGGER trg_kpi_ordens_update AFTER UPDATE ON ordens_servico
+    REFERENCING OLD TABLE AS antigas NEW TABLE AS novas
+    FOR EACH STATEMENT EXECUTE FUNCTION kpi_marcar_meses_ordens()
+    """,
+    "DROP TRIGGER IF EXISTS trg_kpi_ordens_delete ON ordens_servico",
+    """
+    CREATE TRIGGER trg_kpi_ordens_delete AFTER DELETE ON ordens_servico
+    REFERENCING OLD TABLE AS antigas
+    FOR EACH STATEMENT EXECUTE FUNCTION kpi_marcar_meses_ordens()
+    """,
+]
+
+MARK_ALL_MONTHS_SQL = """
+    INSERT INTO kpi_meses_pendentes (mes)
+    SELECT DISTINCT date_trunc('month', data_emissao)::date
+    FROM ordens_servico WHERE data_emissao IS NOT NULL
+    ON CONFLICT DO NOTHING
+"""
+
+# Joining on month ranges keeps the scan on the data_emissao index / hot partitions
+RECOMPUTE_MONTHS_SQL = """
+    INSERT INTO kpi_ordens_mensal (
+        mes, situacao, tecnico, origem_cliente, qtd_ordens,
+        total_ordem_servico, total_servicos, total_pecas, vlr_comissao,
+        qtd_concluidas, dias_conclusao_total
+    )
+    SELECT
+        m.mes,
+        COALESCE(o.situacao, ''),
+        COALESCE(o.tecnico, ''),
+        COALESCE(o.origem_cliente, ''),
+        COUNT(*),
+        COALESCE(SUM(o.total_ordem_servico), 0),
+        COALESCE(SUM(o.total_servicos), 0),
+        COALESCE(SUM(o.total_pecas), 0),
+        COALESCE(SUM(o.vlr_comissao), 0),
+        COUNT(o.data_conclusao),
+        COALESCE(SUM(o.data_conclusao - o.data_emissao), 0)
+    FROM unnest(%s::date[]) AS m(mes)
+    JOIN ordens_servico o
+      ON o.data_emissao >= m.mes
+     AND o.data_emissao < (m.mes + INTERVAL '1 month')::date
+    GROUP BY 1, 2, 3, 4
+"""
+
+def log_json(level, message, **kwargs):
+    """Structured JSON logging function."""
+    log_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "level": level,
+        "message": message,
+        **kwargs
+    }
+    print(json.dumps(log_entry, ensure_ascii=False, default=str))
+
+def rollups_installed(conn):
+    """True if the rollup tables exist (setup has been run)."""
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('public.kpi_meses_pendentes') IS NOT NULL")
+    installed = cur.fetchone()[0]
+    cur.close()
+    return installed
+
+def refresh_kpi_rollups(conn):
+    """
+    Recompute the rollup rows of every month marked as pending.
+    Safe to call after each loader batch: it is a no-op when nothing changed or when
+    the rollup tables were never set up. Returns the number of refreshed months.
+    """
+    if not rollups_installed(conn):
+        return 0
+
+    previous_autocommit = conn.autocommit
+    conn.autocommit = False
+    try:
+        cur = conn.cursor()
+        # SKIP LOCKED lets concurrent loaders refresh disjoint months
+        cur.execute("""
+            DELETE FROM kpi_meses_pendentes
+            WHERE mes IN (SELECT mes FROM kpi_meses_pendentes FOR UPDATE SKIP LOCKED)
+            RETURNING mes
+        """)
+        months = [row[0] for row in cur.fetchall()]
+        if months:
+            cur.execute("DELETE FROM kpi_ordens_mensal WHERE mes = ANY(%s)", (months,))
+            cur.execute(RECOMPUTE_MONTHS_SQL, (months,))
+        conn.commit()
+        if months:
+            log_json("INFO", "KPI rollups refreshed", months=sorted(m.isoformat() for m in months))
+        return len(months)
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error refreshing KPI rollups: {e}")
+        return 0
+    finally:
+        conn.autocommit = previous_autocommit
+
+def setup_rollups(dry_run=False):
+    """Create rollup tables and triggers, then backfill every month."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        cur = conn.cursor()
+        for sql in SETUP_STATEMENTS + [MARK_ALL_MONTHS_SQL]:
+            if dry_run:
+                print(sql.strip() + ";")
+            else:
+                cur.execute(sql)
+        if dry_run:
+            log_json("INFO", "[DRY RUN] No changes were made to the database")
+            return
+        conn.commit()
+        log_json("INFO", "KPI rollup schema created, backfilling all months")
+        refresh_kpi_rollups(conn)
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error setting up KPI rollups: {e}")
+    finally:
+        close_db_connection(conn)
+
+def run_refresh(rebuild=False):
+    """Refresh pending months, optionally marking every month first."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        if not rollups_installed(conn):
+            log_json("ERROR", "KPI rollup tables not found, run 'setup' first")
+            return
+        if rebuild:
+            cur = conn.cursor()
+            cur.execute(MARK_ALL_MONTHS_SQL)
+            conn.commit()
+        refreshed = refresh_kpi_rollups(conn)
+        log_json("INFO", "KPI refresh complete", months_refreshed=refreshed)
+    finally:
+        close_db_connection(conn)
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Maintain monthly KPI rollups of ordens_servico')
+    parser.add_argument('command', choices=['setup', 'refresh', 'rebuild'], help='Action to run')
+    parser.add_argument('--dry-run', action='store_true', help='Print setup SQL without executing it')
+    args = parser.parse_args()
+
+    if args.command == 'setup':
+        setup_rollups(dry_run=args.dry_run)
+    else:
+        run_refresh(rebuild=args.command == 'rebuild')
+
+if __name__ == "__main__":
+    main()
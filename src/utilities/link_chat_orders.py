@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Link WhatsApp chats to the service order they are about, with a few set-based
+statements instead of per-chat queries.
+
+Candidate chats are gathered into a temporary table, then linked in order of
+evidence. Each step only considers chats the previous steps left unlinked:
+
+1. reference_os: the OS number in the filename equals numero_ordem_servico
+   (an order of the chat's own contact wins if the number repeats).
+2. message_os: an "OS 1234" mention in the chat's messages (chat_mencoes_os,
+   filled by extract_os_mentions.py) points to an order of the chat's contact
+   (the latest mention wins).
+3. temporal: the contact's order whose data_emissao is nearest to the chat's
+   first message (or file date), within --window-days.
+
+Runs are incremental. A chat is a candidate while it is unlinked and it was
+never checked, or its contact changed, or orders, messages or mentions arrived
+since its last check (order_checked_at). Links with order_match_method = 'manual' are
+never touched. --relink recomputes every other link.
+
+Usage:
+    python link_chat_orders.py setup [--dry-run]
+    python link_chat_orders.py link [--window-days 30] [--relink] [--dry-run]
+"""
+
+import json
+import time
+import argparse
+from datetime import datetime
+from db_utils import get_db_connection, close_db_connection
+from extract_os_mentions import SETUP_STATEMENTS as MENTION_SETUP_STATEMENTS
+from chat_dedup import SETUP_STATEMENTS as DEDUP_SETUP_STATEMENTS
+
+DEFAULT_WINDOW_DAYS = 30
+
+SETUP_STATEMENTS = [
+    "ALTER TABLE chat_files ADD COLUMN IF NOT EXISTS order_checked_at TIMESTAMP",
+    "ALTER TABLE chat_files ADD COLUMN IF NOT EXISTS order_checked_contato INTEGER",
+    # Also added by load_chat_messages.py setup
+    "ALTER TABLE chat_files ADD COLUMN IF NOT EXISTS messages_loaded_at TIMESTAMP",
+    "CREATE INDEX IF NOT EXISTS idx_ordens_servico_contato_emissao ON ordens_servico (id_contato, data_emissao)",
+    "CREATE INDEX IF NOT EXISTS idx_ordens_servico_numero ON ordens_servico (numero_ordem_servico)",
+]
+
+CANDIDATES_SQL = """
+    CREATE TEMP TABLE candidatos_vinculo ON COMMIT DROP AS
+    SELECT cf.id, cf.id_contato, cf.reference_os,
+           COALESCE(inicio.data_chat, cf.file_date) AS data_chat
+    FROM chat_files cf
+    LEFT JOIN LATERAL (
+        SELECT min(m.message_timestamp)::date AS data_chat
+        FROM mensagens_por_arquivo m WHERE m.id_chat_file = cf.id
+    ) AS inicio ON true
+    WHERE cf.order_match_method IS DISTINCT FROM 'manual'
+      AND (%(relink)s OR (cf.id_ordem_servico IS NULL AND (
+            cf.order_checked_at IS NULL
+            OR cf.id_contato IS DISTINCT FROM cf.order_checked_contato
+            OR cf.messages_loaded_at > cf.order_checked_at
+            OR cf.mentions_checked_at > cf.order_checked_at
+            OR EXISTS (
+                SELECT 1 FROM ordens_servico o
+                WHERE o.id_contato = cf.id_contato AND o.data_extracao > cf.order_checked_at
+            )
+            OR EXISTS (
+                SELECT 1 FROM ordens_servico o
+                WHERE o.numero_ordem_servico = cf.reference_os AND o.data_extracao > cf.order_checked_at
+            )
+      )))
+"""
+
+LINK_STEPS = [
+    ("reference_os", """
+        INSERT INTO vinculos_chat (id_chat_file, id_ordem_servico, metodo)
+        SELECT DISTINCT ON (c.id) c.id, o.id, 'reference_os'
+        FROM candidatos_vinculo c
+        JOIN ordens_servico o ON o.numero_ordem_servico = c.reference_os
+        WHERE c.reference_os IS NOT NULL
+        ORDER BY c.id, (o.id_contato = c.id_contato) DESC NULLS LAST,
+                 abs(o.data_emissao - c.data_chat) NULLS LAST, o.id
+    """),
+    ("message_os", """
+        INSERT INTO vinculos_chat (id_chat_file, id_ordem_servico, metodo)
+        SELECT DISTINCT ON (c.id) c.id, o.id, 'message_os'
+        FROM candidatos_vinculo c
+        -- Mentions are stored with the message, which may come from an older export
+        JOIN mensagens_por_arquivo pm ON pm.id_chat_file = c.id
+        JOIN chat_mencoes_os m ON m.id_mensagem = pm.id_mensagem
+        JOIN ordens_servico o ON o.numero_ordem_servico = m.numero_ordem_servico AND o.id_contato = c.id_contato
+        WHERE c.id_contato IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM vinculos_chat v WHERE v.id_chat_file = c.id)
+        ORDER BY c.id, m.message_timestamp DESC NULLS LAST, o.id
+    """),
+    ("temporal", """
+        INSERT INTO vinculos_chat (id_chat_file, id_ordem_servico, metodo)
+        SELECT DISTINCT ON (c.id) c.id, o.id, 'temporal'
+        FROM candidatos_vinculo c
+        JOIN ordens_servico o ON o.id_contato = c.id_contato
+         AND o.data_emissao BETWEEN c.data_chat - %(window_days)s AND c.data_chat + %(window_days)s
+        WHERE NOT EXISTS (SELECT 1 FROM vinculos_chat v WHERE v.id_chat_file = c.id)
+        -- Nearest first; on a tie, the order opened after the conversation
+        ORDER BY c.id, abs(o.data_emissao - c.data_chat), (o.data_emissao >= c.data_chat) DESC, o.id
+    """),
+]
+
+APPLY_SQL = """
+    UPDATE chat_files AS cf
+    SET id_ordem_servico = v.id_ordem_servico,
+        order_match_method = v.metodo,
+        order_checked_at = CURRENT_TIMESTAMP,
+        order_checked_contato = c.id_contato
+    FROM candidatos_vinculo c
+    LEFT JOIN vinculos_chat v ON v.id_chat_file = c.id
+    WHERE cf.id = c.id
+"""
+
+def log_json(level, message, **kwargs):
+    """Structured JSON logging function."""
+    log_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "level": level,
+        "message": message,
+        **kwargs
+    }
+    print(json.dumps(log_entry, ensure_ascii=False, default=str))
+
+def setup_chat_order_links(dry_run=False):
+    """Add the incremental-check columns, the mentions table and the order indexes the joins use."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        cur = conn.cursor()
+        for sql in DEDUP_SETUP_STATEMENTS + SETUP_STATEMENTS + MENTION_SETUP_STATEMENTS:
+            if dry_run:
+                print(sql.strip() + ";")
+            else:
+                cur.execute(sql)
+        if dry_run:
+            log_json("INFO", "[DRY RUN] No changes were made to the database")
+        else:
+            conn.commit()
+            log_json("INFO", "Chat/order linking columns and indexes ready")
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error setting up chat/order linking: {e}")
+    finally:
+        close_db_connection(conn)
+
+def link_chat_orders(window_days=DEFAULT_WINDOW_DAYS, relink=False, dry_run=False):
+    """Link the candidate chats to orders in one transaction (rolled back on dry run)."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    started = time.monotonic()
+    try:
+        cur = conn.cursor()
+        cur.execute(CANDIDATES_SQL, {"relink": relink})
+        cur.execute("SELECT count(*) FROM candidatos_vinculo")
+        candidates = cur.fetchone()[0]
+        cur.execute("ANALYZE candidatos_vinculo")
+        cur.execute("""
+            CREATE TEMP TABLE vinculos_chat (
+                id_chat_file INTEGER PRIMARY KEY,
+                id_ordem_servico INTEGER NOT NULL,
+                metodo VARCHAR(20) NOT NULL
+            ) ON COMMIT DROP
+        """)
+
+        linked = {}
+        for method, sql in LINK_STEPS:
+            cur.execute(sql, {"window_days": window_days})
+            linked[method] = cur.rowcount
+
+        cur.execute(APPLY_SQL)
+        counts = {"candidates": candidates, "unlinked": candidates - sum(linked.values()), **linked}
+        if dry_run:
+            conn.rollback()
+            log_json("INFO", "[DRY RUN] No changes were made to the database", window_days=window_days, **counts)
+            return
+
+        conn.commit()
+        log_json("INFO", "Chat/order linking complete", window_days=window_days,
+                 elapsed_seconds=round(time.monotonic() - started, 1), **counts)
+
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error linking chats to orders: {e}")
+    finally:
+        close_db_connection(conn)
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Link WhatsApp chat files to service orders')
+    parser.add_argument('command', choices=['setup', 'link'], help='Action to run')
+    parser.add_argument('--window-days', type=int, default=DEFAULT_WINDOW_DAYS,
+                        help=f'Max days between chat and data_emissao for temporal links (default: {DEFAULT_WINDOW_DAYS})')
+    parser.add_argument('--relink', action='store_true', help='Recompute every link not set by hand')
+    parser.add_argument('--dry-run', action='store_true', help='Compute the links and roll back')
+    args = parser.parse_args()
+
+    if args.command == 'setup':
+        setup_chat_order_links(dry_run=args.dry_run)
+    else:
+        link_chat_orders(window_days=args.window_days, relink=args.relink, dry_run=args.dry_run)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Parse the WhatsApp transcripts under organized_whatsapp_chats into chat_messages.
+
+Each transcript is a sequence of messages:
+
+    ----------------------------------------------------
+    <sender>
+    YYYY-MM-DD HH:MM:SS from|to|notification ...
+
+    <body, optionally starting with "➜ Respondendo para ..., <timestamp>: « quoted »">
+
+Files are read line by line and hashed while they are parsed. The messages of
+many files are bulk-loaded with a single COPY per batch. chat_files.content_hash
+records what was loaded, so unchanged files are skipped on the next run. Files
+not yet in chat_files are indexed on the way. Packed months are read from their
+archive (see chat_archive.py).
+
+Re-exports of a conversation repeat its earlier messages, so each message is
+stored once per conversation and every file records the position ranges it
+covers (see chat_dedup.py). Files are grouped into conversation buckets; with
+--workers N the buckets are spread over N processes, each with its own database
+connection, and the parent merges their counts into one progress and throughput
+report.
+
+Usage:
+    python load_chat_messages.py setup [--dry-run]
+    python load_chat_messages.py load [--year 2024] [--month 01] [--workers 4] [--force] [--dry-run]
+"""
+
+import io
+import os
+import re
+import json
+import time
+import hashlib
+import argparse
+from multiprocessing import Pool
+from datetime import datetime
+from psycopg2.extras import execute_values
+from db_utils import get_db_connection, close_db_connection
+from index_chat_files import CHATS_DIR, extract_filename_data, chat_shards, chat_file_names
+from chat_archive import open_transcript
+from chat_dedup import (
+    SETUP_STATEMENTS as DEDUP_SETUP_STATEMENTS, Conversation, conversation_bucket,
+    file_conversation, message_hashes
+)
+
+# Configuration
+BATCH_FILES = 500   # Files per COPY and transaction
+BUCKETS_PER_WORKER = 8
+
+SEPARATOR_RE = re.compile(r"^-{20,}$")
+HEADER_RE = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) (from|to|notification)\b")
+REPLY_PREFIX = "➜ Respondendo para "
+REPLY_RE = re.compile(r"^➜ Respondendo para .*?, \d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}: « ?(.*?) ?»?$", re.DOTALL)
+
+SETUP_STATEMENTS = [
+    "ALTER TABLE chat_files ADD COLUMN IF NOT EXISTS content_hash CHAR(64)",
+    "ALTER TABLE chat_files ADD COLUMN IF NOT EXISTS message_count INTEGER",
+    "ALTER TABLE chat_files ADD COLUMN IF NOT EXISTS messages_loaded_at TIMESTAMP",
+]
+
+COPY_SQL = """
+    COPY chat_messages (id_chat_file, message_timestamp, is_from_customer, message_text, responding_to,
+                        conversa, posicao, message_hash)
+    FROM STDIN
+"""
+
+INSERT_RANGES_SQL = """
+    INSERT INTO chat_file_trechos (id_chat_file, conversa, posicao_inicio, posicao_fim)
+    VALUES %s
+"""
+
+MARK_LOADED_SQL = """
+    UPDATE chat_files AS cf
+    SET content_hash = v.content_hash,
+        message_count = v.message_count,
+        processing_status = 'parsed',
+        messages_loaded_at = CURRENT_TIMESTAMP
+    FROM (VALUES %s) AS v(id, content_hash, message_count)
+    WHERE cf.id = v.id
+"""
+
+def log_json(level, message, **kwargs):
+    """Structured JSON logging function."""
+    log_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "level": level,
+        "message": message,
+        **kwargs
+    }
+    print(json.dumps(log_entry, ensure_ascii=False, default=str))
+
+def build_message(timestamp, direction, body):
+    """Message record from its header fields and body lines."""
+    while body and not body[0].strip():
+        body.pop(0)
+    while body and not body[-1].strip():
+        body.pop()
+
+    responding_to = None
+    if body and body[0].startswith(REPLY_PREFIX):
+        # The quote may span several lines and ends with »
+        end = next((index for index, line in enumerate(body) if line.rstrip().endswith("»")), 0)
+        quote = "\n".join(body[:end + 1])
+        match = REPLY_RE.match(quote)
+        responding_to = match.group(1) if match else quote
+        body = body[end + 1:]
+        while body and not body[0].strip():
+            body.pop(0)
+
+    return {
+        "timestamp": timestamp,
+        "is_from_customer": {"from": True, "to": False}.get(direction),
+        "text": "\n".join(body) or None,
+        "responding_to": responding_to,
+    }
+
+def parse_transcript(lines):
+    """
+    Yield the message records of a transcript from an iterator of lines
+    (without line endings). A separator only starts a message when it is followed
+    by a sender line and a timestamp header; otherwise it is part of the body.
+    """
+    lines = iter(lines)
+    current = None  # (timestamp, direction, body lines)
+    for line in lines:
+        if SEPARATOR_RE.match(line):
+            sender = next(lines, None)
+            header = next(lines, None)
+            match = HEADER_RE.match(header) if header is not None else None
+            if match:
+                if current:
+                    yield build_message(*current)
+                current = (match.group(1), match.group(2), [])
+                continue
+            if current:
+                current[2].extend(part for part in (line, sender, header) if part is not None)
+            continue
+        if current:
+            current[2].append(line)
+    if current:
+        yield build_message(*current)
+
+def read_transcript(file_path):
+    """(sha256 hex digest, message records) of a transcript, read in a single pass."""
+    digest = hashlib.sha256()
+
+    def lines(handle):
+        for raw in handle:
+            digest.update(raw)
+            yield raw.decode("utf-8", errors="replace").rstrip("\r\n")
+
+    with open_transcript(file_path) as handle:
+        messages = list(parse_transcript(lines(handle)))
+    return digest.hexdigest(), messages
+
+def copy_text_value(value):
+    """Value in COPY text format."""
+    if value is None:
+        return "\\N"
+    if value is True or value is False:
+        return "t" if value else "f"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+def index_chat_file(cur, file_path):
+    """Insert a chat_files row for a transcript that was never indexed; its id or None."""
+    filename = os.path.basename(file_path)
+    file_data = extract_filename_data(filename)
+    if not file_data:
+        log_json("WARNING", f"Could not parse filename, skipping: {filename}")
+        return None
+    cur.execute("""
+        INSERT INTO chat_files
+        (filename, file_path, file_date, phone_number, customer_name, reference_os, processing_status)
+        VALUES (%s, %s, %s, %s, %s, %s, 'pending')
+        RETURNING id
+    """, (
+        filename, file_path, file_data["file_date"], file_data["phone_number"],
+        file_data["name_or_phone"], file_data["reference_os"]
+    ))
+    return cur.fetchone()[0]
+
+def flush_batch(conn, batch):
+    """
+    Store the new messages of every file in the batch with one COPY, replace the
+    files' conversation ranges and mark them loaded, then commit.
+    """
+    cur = conn.cursor()
+    buffer = io.StringIO()
+    for item in batch:
+        for index, position in item["new_messages"]:
+            message = item["messages"][index]
+            buffer.write("\t".join(copy_text_value(value) for value in (
+                item["file_id"], message["timestamp"], message["is_from_customer"],
+                message["text"], message["responding_to"],
+                item["conversa"], position, item["hashes"][index]
+            )) + "\n")
+    buffer.seek(0)
+
+    file_ids = [item["file_id"] for item in batch]
+    # Rows of these files loaded before deduplication are replaced
+    cur.execute("DELETE FROM chat_messages WHERE id_chat_file = ANY(%s) AND conversa IS NULL", (file_ids,))
+    cur.execute("DELETE FROM chat_file_trechos WHERE id_chat_file = ANY(%s)", (file_ids,))
+    cur.copy_expert(COPY_SQL, buffer)
+    execute_values(cur, INSERT_RANGES_SQL, [
+        (item["file_id"], item["conversa"], start, end) for item in batch for start, end in item["ranges"]
+    ])
+    execute_values(cur, MARK_LOADED_SQL, [
+        (item["file_id"], item["content_hash"], len(item["messages"])) for item in batch
+    ])
+    conn.commit()
+    cur.close()
+
+def load_conversations(cur, keys):
+    """Conversation state (stored hashes and positions) of the given conversation keys."""
+    conversations = {key: Conversation() for key in keys}
+    cur.execute(
+        "SELECT conversa, message_hash, posicao FROM chat_messages WHERE conversa = ANY(%s)",
+        (list(keys),)
+    )
+    for key, message_hash, position in cur.fetchall():
+        conversations[key].add_stored(message_hash, position)
+    return conversations
+
+def load_bucket(bucket, file_paths, force=False, dry_run=False):
+    """
+    Parse the transcripts of one conversation bucket, oldest export first, and
+    store the messages their conversations do not have yet, skipping files whose
+    content hash matches the one recorded at their last load. Uses its own
+    connection, so buckets can run in separate processes. Returns the counts.
+    """
+    started = time.monotonic()
+    stats = {"bucket": bucket, "parsed": 0, "unchanged": 0, "errors": 0, "messages": 0, "stored": 0}
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database", bucket=bucket)
+        stats["errors"] += 1
+        return stats
+
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT file_path, id, content_hash FROM chat_files WHERE file_path = ANY(%s)", (file_paths,))
+        known = {file_path: (file_id, content_hash) for file_path, file_id, content_hash in cur.fetchall()}
+        keys = {file_path: file_conversation(file_path) for file_path in file_paths}
+        conversations = load_conversations(cur, set(keys.values()))
+
+        batch = []
+        for file_path in file_paths:
+            try:
+                content_hash, messages = read_transcript(file_path)
+            except OSError as e:
+                log_json("ERROR", f"Could not read transcript {file_path}: {e}")
+                stats["errors"] += 1
+                continue
+
+            file_id, loaded_hash = known.get(file_path, (None, None))
+            if loaded_hash == content_hash and not force:
+                stats["unchanged"] += 1
+                continue
+            hashes = message_hashes(messages)
+            new_messages, ranges = conversations[keys[file_path]].place(hashes)
+            stats["parsed"] += 1
+            stats["messages"] += len(messages)
+            stats["stored"] += len(new_messages)
+            if dry_run:
+                continue
+
+            if file_id is None:
+                file_id = index_chat_file(cur, file_path)
+                if file_id is None:
+                    stats["errors"] += 1
+                    continue
+            batch.append({
+                "file_id": file_id, "content_hash": content_hash, "messages": messages,
+                "hashes": hashes, "conversa": keys[file_path],
+                "new_messages": new_messages, "ranges": ranges,
+            })
+            if len(batch) >= BATCH_FILES:
+                flush_batch(conn, batch)
+                batch = []
+
+        if batch:
+            flush_batch(conn, batch)
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error loading chat messages: {e}", bucket=bucket)
+        stats["errors"] += 1
+    finally:
+        close_db_connection(conn)
+    stats["elapsed_seconds"] = round(time.monotonic() - started, 1)
+    return stats
+
+def _load_bucket_task(task):
+    """Pool entry point: load_bucket(*task)."""
+    return load_bucket(*task)
+
+def load_chat_messages(year=None, month=None, workers=1, force=False, dry_run=False):
+    """
+    Load the transcripts of the selected <year>/<month> directories. Files are
+    grouped into conversation buckets, so exports of the same conversation are
+    always deduplicated by a single worker. Buckets run in worker processes when
+    workers > 1, with merged progress and throughput logged as they complete.
+    """
+    shards = chat_shards(year, month)
+    if not shards:
+        log_json("ERROR", f"No chat directories found under {CHATS_DIR}", year=year, month=month)
+        return
+
+    workers = max(1, workers)
+    bucket_count = workers * BUCKETS_PER_WORKER
+    buckets = {}
+    for shard_dir in shards:
+        for filename in chat_file_names(shard_dir):
+            file_path = os.path.join(shard_dir, filename)
+            bucket = conversation_bucket(file_conversation(file_path), bucket_count)
+            buckets.setdefault(bucket, []).append(file_path)
+    # Filenames start with the export timestamp: older exports are placed first
+    tasks = [(bucket, sorted(paths, key=os.path.basename), force, dry_run) for bucket, paths in sorted(buckets.items())]
+
+    log_json("INFO", "Starting chat message load", year=year or "all", month=month or "all",
+             directories=len(shards), buckets=len(tasks), workers=workers, dry_run=dry_run)
+    started = time.monotonic()
+    totals = {"parsed": 0, "unchanged": 0, "errors": 0, "messages": 0, "stored": 0}
+
+    def report(done, bucket_stats):
+        for key in totals:
+            totals[key] += bucket_stats[key]
+        elapsed = time.monotonic() - started
+        log_json("INFO", "Bucket loaded", done=f"{done}/{len(tasks)}", **bucket_stats,
+                 total_messages=totals["messages"],
+                 messages_per_second=round(totals["messages"] / elapsed) if elapsed else None)
+
+    if workers == 1:
+        for done, task in enumerate(tasks, start=1):
+            report(done, _load_bucket_task(task))
+    else:
+        # Several buckets per worker and unordered results keep every worker busy
+        with Pool(processes=workers) as pool:
+            for done, bucket_stats in enumerate(pool.imap_unordered(_load_bucket_task, tasks), start=1):
+                report(done, bucket_stats)
+
+    elapsed = time.monotonic() - started
+    if dry_run:
+        log_json("INFO", "[DRY RUN] No changes were made to the database")
+    log_json("INFO", "Chat message load complete", elapsed_seconds=round(elapsed, 1),
+             files_per_second=round((totals["parsed"] + totals["unchanged"]) / elapsed, 1) if elapsed else None,
+             messages_per_second=round(totals["messages"] / elapsed) if elapsed else None,
+             duplicates_skipped=totals["messages"] - totals["stored"], **totals)
+
+def setup_chat_message_load(dry_run=False):
+    """Add the columns that record what was loaded from each transcript."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        cur = conn.cursor()
+        for sql in SETUP_STATEMENTS + DEDUP_SETUP_STATEMENTS:
+            if dry_run:
+                print(sql.strip() + ";")
+            else:
+                cur.execute(sql)
+        if dry_run:
+            log_json("INFO", "[DRY RUN] No changes were made to the database")
+        else:
+            conn.commit()
+            log_json("INFO", "chat_files load tracking columns ready")
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error setting up chat message load: {e}")
+    finally:
+        close_db_connection(conn)
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Parse WhatsApp transcripts and bulk-load chat_messages')
+    parser.add_argument('command', choices=['setup', 'load'], help='Action to run')
+    parser.add_argument('--year', help='Only load transcripts of this year (e.g. 2024)')
+    parser.add_argument('--month', help='Only load transcripts of this month (01-12)')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes, each loading one conversation bucket at a time')
+    parser.add_argument('--force', action='store_true', help='Reload files even if their hash is unchanged')
+    parser.add_argument('--dry-run', action='store_true', help='Parse and count without modifying the database')
+    args = parser.parse_args()
+
+    if args.command == 'setup':
+        setup_chat_message_load(dry_run=args.dry_run)
+    else:
+        load_chat_messages(year=args.year, month=args.month, workers=args.workers,
+                           force=args.force, dry_run=args.dry_run)
+
+if __name__ == "__main__":
+    main()
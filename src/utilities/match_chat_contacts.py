@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Match chat_files to contatos by phone number in one pass.
+
+All contact phones (telefone and celular) are loaded once and put in canonical
+form: digits only, without the 55 country code or trunk 0, and with the mobile 9th
+digit added to 10-digit numbers. Each chat phone is then looked up in memory:
+
+- phone_exact  (1.0):  same canonical number (area code + number)
+- phone_local  (0.85): same last 9 digits (the number, area code missing or different)
+- phone_suffix (0.7):  same last 8 digits
+
+A level only counts when it points to a single contact. A chat whose best level
+matches several contacts is marked phone_ambiguous; one with no match is
+marked no_match. The results are written back with one multi-row UPDATE per batch.
+Rows with match_method = 'manual' are never touched.
+
+A default run takes the unmatched files plus the no_match and phone_ambiguous
+ones, so contacts added or fixed since the last run are picked up. --all
+rematches every file not matched by hand.
+
+Usage:
+    python match_chat_contacts.py [--all] [--dry-run]
+"""
+
+import re
+import json
+import time
+import argparse
+from collections import Counter
+from datetime import datetime
+from psycopg2.extras import execute_values
+from db_utils import get_db_connection, close_db_connection
+
+# Configuration
+BATCH_SIZE = 1000   # Rows per multi-row UPDATE
+
+# Suffix lengths looked up after the exact match, with their method and confidence
+SUFFIX_LEVELS = [
+    (9, "phone_local", 0.85),
+    (8, "phone_suffix", 0.7),
+]
+
+WRITE_MATCHES_SQL = """
+    UPDATE chat_files AS cf
+    SET id_contato = v.id_contato,
+        match_method = v.match_method,
+        match_confidence = v.match_confidence
+    FROM (VALUES %s) AS v(id, id_contato, match_method, match_confidence)
+    WHERE cf.id = v.id
+"""
+WRITE_MATCHES_TEMPLATE = "(%s, %s::integer, %s, %s::float)"
+
+def log_json(level, message, **kwargs):
+    """Structured JSON logging function."""
+    log_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "level": level,
+        "message": message,
+        **kwargs
+    }
+    print(json.dumps(log_entry, ensure_ascii=False, default=str))
+
+def canonical_phone(phone):
+    """
+    Digits of a Brazilian phone without country code or trunk prefix, with the
+    mobile 9th digit restored. None if fewer than 8 digits remain.
+    """
+    if not phone:
+        return None
+    digits = re.sub(r"[^0-9]", "", phone)
+    if len(digits) in (12, 13) and digits.startswith("55"):
+        digits = digits[2:]
+    if len(digits) in (11, 12) and digits.startswith("0"):
+        digits = digits[1:]
+    # Mobile numbers registered before the 9th digit: (41) 9754-8841 -> (41) 99754-8841
+    if len(digits) == 10 and digits[2] in "6789":
+        digits = digits[:2] + "9" + digits[2:]
+    return digits if len(digits) >= 8 else None
+
+class PhoneIndex:
+    """
+    Contact ids by canonical phone and by reversed-digit suffix, so matching a
+    phone is a handful of dict lookups instead of LIKE scans over contatos.
+    """
+    def __init__(self):
+        self.exact = {}
+        self.suffixes = {}   # reversed last-N digits -> contact ids, for every N in SUFFIX_LEVELS
+
+    def add(self, contact_id, phone):
+        digits = canonical_phone(phone)
+        if not digits:
+            return
+        self.exact.setdefault(digits, set()).add(contact_id)
+        reversed_digits = digits[::-1]
+        for length, _, _ in SUFFIX_LEVELS:
+            if len(digits) >= length:
+                self.suffixes.setdefault(reversed_digits[:length], set()).add(contact_id)
+
+    def match(self, phone):
+        """(contact id or None, match_method, match_confidence) of one phone."""
+        digits = canonical_phone(phone)
+        if not digits:
+            return None, "no_phone", None
+        levels = [(self.exact.get(digits), "phone_exact", 1.0)]
+        reversed_digits = digits[::-1]
+        levels += [
+            (self.suffixes.get(reversed_digits[:length]), method, confidence)
+            for length, method, confidence in SUFFIX_LEVELS if len(digits) >= length
+        ]
+        for contact_ids, method, confidence in levels:
+            if not contact_ids:
+                continue
+            if len(contact_ids) == 1:
+                return next(iter(contact_ids)), method, confidence
+            # A shorter suffix can only match more contacts
+            return None, "phone_ambiguous", None
+        return None, "no_match", None
+
+def load_phone_index(cur):
+    """PhoneIndex over telefone and celular of every contact."""
+    index = PhoneIndex()
+    cur.execute("SELECT id, telefone, celular FROM contatos WHERE telefone IS NOT NULL OR celular IS NOT NULL")
+    for contact_id, telefone, celular in cur.fetchall():
+        index.add(contact_id, telefone)
+        if celular != telefone:
+            index.add(contact_id, celular)
+    return index
+
+def match_chat_contacts(rematch=False, dry_run=False):
+    """
+    Match the chat files that were never matched or found no single contact (or,
+    with rematch, every chat file not matched by hand) and write the results back in bulk.
+    """
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    started = time.monotonic()
+    try:
+        cur = conn.cursor()
+        index = load_phone_index(cur)
+        log_json("INFO", "Contact phone index loaded", phones=len(index.exact),
+                 suffixes=len(index.suffixes), elapsed_seconds=round(time.monotonic() - started, 1))
+
+        if rematch:
+            cur.execute("""
+                SELECT id, phone_number, id_contato, match_method FROM chat_files
+                WHERE match_method IS DISTINCT FROM 'manual'
+            """)
+        else:
+            cur.execute("""
+                SELECT id, phone_number, id_contato, match_method FROM chat_files
+                WHERE match_method IS NULL OR match_method IN ('no_match', 'phone_ambiguous')
+            """)
+
+        updates = []
+        methods = Counter()
+        for file_id, phone_number, current_contact, current_method in cur.fetchall():
+            contact_id, method, confidence = index.match(phone_number)
+            methods[method] += 1
+            if (contact_id, method) != (current_contact, current_method):
+                updates.append((file_id, contact_id, method, confidence))
+
+        if dry_run:
+            for file_id, contact_id, method, confidence in updates[:20]:
+                log_json("INFO", "[DRY RUN] Would set match", chat_file=file_id, contact=contact_id,
+                         method=method, confidence=confidence)
+            log_json("INFO", "[DRY RUN] No changes were made to the database", updates=len(updates), **methods)
+            return
+
+        for start in range(0, len(updates), BATCH_SIZE):
+            execute_values(cur, WRITE_MATCHES_SQL, updates[start:start + BATCH_SIZE],
+                           template=WRITE_MATCHES_TEMPLATE, page_size=BATCH_SIZE)
+        conn.commit()
+        log_json("INFO", "Chat contact matching complete", updates=len(updates),
+                 elapsed_seconds=round(time.monotonic() - started, 1), **methods)
+
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error matching chat contacts: {e}")
+    finally:
+        close_db_connection(conn)
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Match WhatsApp chat files to contacts by phone number')
+    parser.add_argument('--all', '--rematch', dest='rematch', action='store_true',
+                        help='Match again every chat file not matched by hand')
+    parser.add_argument('--dry-run', action='store_true', help='Report the matches without modifying the database')
+    args = parser.parse_args()
+
+    match_chat_contacts(rematch=args.rematch, dry_run=args.dry_run)
+
+if __name__ == "__main__":
+    main()
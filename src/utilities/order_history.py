@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Change history (CDC) of ordens_servico as compact per-field deltas.
+
+historico_ordens_servico is append-only: one row per changed field with
+(id_ordem_servico, campo, valor_anterior, valor_novo, observado_em). Rows are written
+by statement-level triggers using transition tables, so every loader feeds it with
+one set-based INSERT per upsert statement and no loader code changes. New orders
+record their first situacao with valor_anterior NULL.
+
+The table is partitioned by month on observado_em; old months can be detached and
+dropped with prune. periodos_situacao_ordens(data_inicio, data_fim, ids) turns the
+situacao deltas into (order, status, start, end) intervals, filtering by date and
+order before the window runs so only the matching partitions are read.
+tempo_em_situacao() aggregates them into time-in-status distributions.
+
+Usage:
+    python order_history.py setup [--dry-run]          # table, triggers, seed current status
+    python order_history.py ensure-partitions [--months-ahead N] [--dry-run]
+    python order_history.py time-in-status [--start YYYY-MM-DD] [--end YYYY-MM-DD]
+    python order_history.py prune --keep-months N [--dry-run]
+"""
+
+import json
+import argparse
+from datetime import date, datetime
+from db_utils import get_db_connection, close_db_connection
+
+HISTORY_TABLE = "historico_ordens_servico"
+DEFAULT_MONTHS_AHEAD = 3
+
+SETUP_STATEMENTS = [
+    f"""
+    CREATE TABLE IF NOT EXISTS {HISTORY_TABLE} (
+        id_ordem_servico INTEGER NOT NULL,
+        campo VARCHAR(30) NOT NULL,
+        valor_anterior TEXT,
+        valor_novo TEXT,
+        observado_em TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    ) PARTITION BY RANGE (observado_em)
+    """,
+    f"CREATE TABLE IF NOT EXISTS {HISTORY_TABLE}_default PARTITION OF {HISTORY_TABLE} DEFAULT",
+    # Serves both per-order history lookups and the window scan of time-in-status
+    f"""
+    CREATE INDEX IF NOT EXISTS idx_{HISTORY_TABLE}_campo_ordem
+    ON {HISTORY_TABLE} (campo, id_ordem_servico, observado_em)
+    """,
+    f"""
+    CREATE OR REPLACE FUNCTION historico_registrar_ordens() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO {HISTORY_TABLE} (id_ordem_servico, campo, valor_anterior, valor_novo)
+            SELECT n.id, 'situacao', NULL, n.situacao::text
+            FROM novas n;
+        ELSE
+            INSERT INTO {HISTORY_TABLE} (id_ordem_servico, campo, valor_anterior, valor_novo)
+            SELECT n.id, c.campo, c.anterior, c.novo
+            FROM novas n
+            JOIN antigas a ON a.id = n.id
+            -- Tracked fields; one row per field whose value changed
+            CROSS JOIN LATERAL (VALUES
+                ('situacao', a.situacao::text, n.situacao::text),
+                ('data_prevista', a.data_prevista::text, n.data_prevista::text),
+                ('data_conclusao', a.data_conclusao::text, n.data_conclusao::text),
+                ('total_servicos', a.total_servicos::text, n.total_servicos::text),
+                ('total_ordem_servico', a.total_ordem_servico::text, n.total_ordem_servico::text),
+                ('total_pecas', a.total_pecas::text, n.total_pecas::text),
+                ('tecnico', a.tecnico::text, n.tecnico::text)
+            ) AS c(campo, anterior, novo)
+            WHERE c.anterior IS DISTINCT FROM c.novo;
+        END IF;
+        RETURN NULL;
+    END;
+    $$
+    """,
+    "DROP TRIGGER IF EXISTS trg_historico_ordens_insert ON ordens_servico",
+    """
+    CREATE TRIGGER trg_historico_ordens_insert AFTER INSERT ON ordens_servico
+    REFERENCING NEW TABLE AS novas
+    FOR EACH STATEMENT EXECUTE FUNCTION historico_registrar_ordens()
+    """,
+    "DROP TRIGGER IF EXISTS trg_historico_ordens_update ON ordens_servico",
+    """
+    CREATE TRIGGER trg_historico_ordens_update AFTER UPDATE ON ordens_servico
+    REFERENCING OLD TABLE AS antigas NEW TABLE AS novas
+    FOR EACH STATEMENT EXECUTE FUNCTION historico_registrar_ordens()
+    """,
+    "DROP VIEW IF EXISTS periodos_situacao_ordens",
+    # Each situacao delta opens an interval that ends at the next one (or now, if current).
+    # Orders with a delta in [data_inicio, data_fim) get one look-back row (the period
+    # running at data_inicio) and one look-ahead row (which closes the last period),
+    # each found with a LIMIT 1 probe of the (campo, id_ordem_servico, observado_em) index.
+    f"""
+    CREATE OR REPLACE FUNCTION periodos_situacao_ordens(
+        data_inicio TIMESTAMP DEFAULT NULL,
+        data_fim TIMESTAMP DEFAULT NULL,
+        ids INTEGER[] DEFAULT NULL
+    )
+    RETURNS TABLE (
+        id_ordem_servico INTEGER,
+        situacao TEXT,
+        inicio TIMESTAMP,
+        fim TIMESTAMP,
+        duracao INTERVAL
+    )
+    LANGUAGE sql STABLE AS $$
+        WITH faixa AS (
+            SELECT h.id_ordem_servico AS ordem, h.valor_novo AS valor, h.observado_em AS em
+            FROM {HISTORY_TABLE} h
+            WHERE h.campo = 'situacao'
+              AND (data_inicio IS NULL OR h.observado_em >= data_inicio)
+              AND (data_fim IS NULL OR h.observado_em < data_fim)
+              AND (ids IS NULL OR h.id_ordem_servico = ANY(ids))
+        ),
+        ordens AS (
+            SELECT DISTINCT ordem FROM faixa
+        ),
+        linhas AS (
+            SELECT ordem, valor, em, FALSE AS posterior FROM faixa
+            UNION ALL
+            SELECT o.ordem, a.valor_novo, a.observado_em, FALSE
+            FROM ordens o
+            CROSS JOIN LATERAL (
+                SELECT h.valor_novo, h.observado_em FROM {HISTORY_TABLE} h
+                WHERE h.campo = 'situacao' AND h.id_ordem_servico = o.ordem AND h.observado_em < data_inicio
+                ORDER BY h.observado_em DESC LIMIT 1
+            ) a
+            UNION ALL
+            SELECT o.ordem, d.valor_novo, d.observado_em, TRUE
+            FROM ordens o
+            CROSS JOIN LATERAL (
+                SELECT h.valor_novo, h.observado_em FROM {HISTORY_TABLE} h
+                WHERE h.campo = 'situacao' AND h.id_ordem_servico = o.ordem AND h.observado_em >= data_fim
+                ORDER BY h.observado_em LIMIT 1
+            ) d
+        ),
+        periodos AS (
+            SELECT ordem, valor, em, posterior, lead(em) OVER (PARTITION BY ordem ORDER BY em) AS proximo
+            FROM linhas
+        )
+        SELECT ordem, valor, em, proximo, COALESCE(proximo, CURRENT_TIMESTAMP) - em
+        FROM periodos
+        WHERE NOT posterior
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION tempo_em_situacao(
+        data_inicio TIMESTAMP DEFAULT NULL,
+        data_fim TIMESTAMP DEFAULT NULL,
+        incluir_abertos BOOLEAN DEFAULT FALSE
+    )
+    RETURNS TABLE (
+        situacao TEXT,
+        qtd_periodos BIGINT,
+        media_horas NUMERIC,
+        mediana_horas NUMERIC,
+        p90_horas NUMERIC,
+        max_horas NUMERIC
+    )
+    LANGUAGE sql STABLE AS $$
+        SELECT p.situacao,
+               COUNT(*),
+               ROUND((AVG(extract(epoch FROM p.duracao)) / 3600)::numeric, 1),
+               ROUND((percentile_cont(0.5) WITHIN GROUP (ORDER BY extract(epoch FROM p.duracao)) / 3600)::numeric, 1),
+               ROUND((percentile_cont(0.9) WITHIN GROUP (ORDER BY extract(epoch FROM p.duracao)) / 3600)::numeric, 1),
+               ROUND((MAX(extract(epoch FROM p.duracao)) / 3600)::numeric, 1)
+        FROM periodos_situacao_ordens(data_inicio, data_fim) p
+        WHERE (data_inicio IS NULL OR p.inicio >= data_inicio)
+          AND (incluir_abertos OR p.fim IS NOT NULL)
+        GROUP BY p.situacao
+        ORDER BY p.situacao
+    $$
+    """,
+]
+
+# Orders that predate the triggers get their current status as the first observation.
+# It is stamped now, so it lands in the current month's partition (created just before)
+# rather than in the default partition, which prune never drops.
+SEED_CURRENT_STATUS_SQL = f"""
+    INSERT INTO {HISTORY_TABLE} (id_ordem_servico, campo, valor_anterior, valor_novo, observado_em)
+    SELECT o.id, 'situacao', NULL, o.situacao::text, CURRENT_TIMESTAMP
+    FROM ordens_servico o
+    WHERE NOT EXISTS (
+        SELECT 1 FROM {HISTORY_TABLE} h
+        WHERE h.campo = 'situacao' AND h.id_ordem_servico = o.id
+    )
+"""
+
+def log_json(level, message, **kwargs):
+    """Structured JSON logging function."""
+    log_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "level": level,
+        "message": message,
+        **kwargs
+    }
+    print(json.dumps(log_entry, ensure_ascii=False, default=str))
+
+def add_months(month_start, months):
+    """First day of the month `months` after month_start."""
+    index = month_start.year * 12 + month_start.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def partition_name(month_start):
+    """Monthly partition name, e.g. historico_ordens_servico_p202505."""
+    return f"{HISTORY_TABLE}_p{month_start:%Y%m}"
+
+def partition_ddl(month_start):
+    """CREATE statement of one monthly partition."""
+    return (
+        f"CREATE TABLE IF NOT EXISTS {partition_name(month_start)} PARTITION OF {HISTORY_TABLE} "
+        f"FOR VALUES FROM ('{month_start.isoformat()}') TO ('{add_months(month_start, 1).isoformat()}')"
+    )
+
+def partition_months(existing, months_ahead=DEFAULT_MONTHS_AHEAD):
+    """
+    Missing partition months up to months_ahead months in the future, starting after
+    the newest existing partition so months skipped by a missed run are covered too.
+    """
+    current = date.today().replace(day=1)
+    start = min(add_months(existing[-1][1], 1), current) if existing else current
+    have = {month for _, month in existing}
+    months = []
+    month = start
+    while month <= add_months(current, months_ahead):
+        if month not in have:
+            months.append(month)
+        month = add_months(month, 1)
+    return months
+
+def move_default_rows_ddl(month_start):
+    """
+    Statements that create a month's partition when the default partition already holds
+    rows of that month: build it standalone, move the rows out of the default and attach it.
+    """
+    name = partition_name(month_start)
+    lower, upper = month_start.isoformat(), add_months(month_start, 1).isoformat()
+    return [
+        f"CREATE TABLE {name} (LIKE {HISTORY_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)",
+        f"""
+        WITH movidos AS (
+            DELETE FROM {HISTORY_TABLE}_default
+            WHERE observado_em >= '{lower}' AND observado_em < '{upper}'
+            RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM movidos
+        """,
+        f"ALTER TABLE {HISTORY_TABLE} ATTACH PARTITION {name} FOR VALUES FROM ('{lower}') TO ('{upper}')",
+    ]
+
+def existing_partitions(cur):
+    """(name, lower bound) of the monthly partitions, oldest first."""
+    cur.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = %s AND c.relname ~ '_p[0-9]{6}$'
+        ORDER BY c.relname
+    """, (HISTORY_TABLE,))
+    result = []
+    for (name,) in cur.fetchall():
+        suffix = name.rsplit('_p', 1)[1]
+        result.append((name, date(int(suffix[:4]), int(suffix[4:]), 1)))
+    return result
+
+def run_statements(statements, dry_run=False, success_message="Done"):
+    """Execute statements in one transaction, or print them in dry-run mode. Returns True on success."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return False
+
+    try:
+        cur = conn.cursor()
+        for sql in statements:
+            if dry_run:
+                print(sql.strip() + ";")
+            else:
+                cur.execute(sql)
+        if dry_run:
+            log_json("INFO", "[DRY RUN] No changes were made to the database")
+        else:
+            conn.commit()
+            log_json("INFO", success_message)
+        return True
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error changing order history schema: {e}")
+        return False
+    finally:
+        close_db_connection(conn)
+
+def ensure_partitions(months_ahead=DEFAULT_MONTHS_AHEAD, dry_run=False):
+    """
+    Create the missing monthly partitions, each in its own transaction. Rows a missed
+    run left in the default partition are moved into their new month instead of making
+    the CREATE fail; a failing month is logged and the others still go ahead.
+    """
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return False
+
+    ok = True
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (f"{HISTORY_TABLE}_default",))
+        has_default = cur.fetchone()[0]
+        for month_start in partition_months(existing_partitions(cur), months_ahead):
+            name = partition_name(month_start)
+            try:
+                stray_rows = 0
+                if has_default:
+                    cur.execute(
+                        f"SELECT COUNT(*) FROM {HISTORY_TABLE}_default WHERE observado_em >= %s AND observado_em < %s",
+                        (month_start, add_months(month_start, 1))
+                    )
+                    stray_rows = cur.fetchone()[0]
+                statements = move_default_rows_ddl(month_start) if stray_rows else [partition_ddl(month_start)]
+                if dry_run:
+                    for sql in statements:
+                        print(sql.strip() + ";")
+                    conn.rollback()
+                    continue
+                for sql in statements:
+                    cur.execute(sql)
+                conn.commit()
+                log_json("INFO", f"Partition {name} created", moved_rows=stray_rows)
+            except Exception as e:
+                conn.rollback()
+                ok = False
+                log_json("ERROR", f"Error creating partition {name}: {e}")
+        if dry_run:
+            log_json("INFO", "[DRY RUN] No changes were made to the database")
+        elif ok:
+            log_json("INFO", "History partitions ensured")
+    finally:
+        close_db_connection(conn)
+    return ok
+
+def show_time_in_status(start=None, end=None, include_open=False):
+    """Print the time-in-status distribution of periods started in [start, end)."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM tempo_em_situacao(%s, %s, %s)", (start, end, include_open))
+        print(f"{'situacao':<10} {'periodos':>9} {'media_h':>9} {'mediana_h':>10} {'p90_h':>9} {'max_h':>9}")
+        for situacao, qtd, media, mediana, p90, maximo in cur.fetchall():
+            print(f"{situacao or '-':<10} {qtd:>9} {media:>9} {mediana:>10} {p90:>9} {maximo:>9}")
+    except Exception as e:
+        log_json("ERROR", f"Error computing time in status: {e}")
+    finally:
+        close_db_connection(conn)
+
+def prune_history(keep_months, dry_run=False):
+    """Detach and drop monthly partitions older than keep_months."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        cur = conn.cursor()
+        cutoff = add_months(date.today().replace(day=1), -keep_months)
+        old = [name for name, month_start in existing_partitions(cur) if month_start < cutoff]
+        for name in old:
+            statements = [
+                f"ALTER TABLE {HISTORY_TABLE} DETACH PARTITION {name}",
+                f"DROP TABLE {name}",
+            ]
+            for sql in statements:
+                if dry_run:
+                    print(sql + ";")
+                else:
+                    cur.execute(sql)
+        if not dry_run:
+            conn.commit()
+        log_json("INFO", "History pruned" if not dry_run else "[DRY RUN] Partitions that would be dropped",
+                 cutoff=cutoff, partitions=old)
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error pruning order history: {e}")
+    finally:
+        close_db_connection(conn)
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Maintain the change history of ordens_servico')
+    parser.add_argument('command', choices=['setup', 'ensure-partitions', 'time-in-status', 'prune'],
+                        help='Action to run')
+    parser.add_argument('--months-ahead', type=int, default=DEFAULT_MONTHS_AHEAD,
+                        help='Monthly partitions to create beyond the current month')
+    parser.add_argument('--start', help='Only periods started on or after this date (time-in-status)')
+    parser.add_argument('--end', help='Only periods started before this date (time-in-status)')
+    parser.add_argument('--include-open', action='store_true',
+                        help='Count current, still open periods up to now (time-in-status)')
+    parser.add_argument('--keep-months', type=int, help='Months of history to keep (prune)')
+    parser.add_argument('--dry-run', action='store_true', help='Print SQL without executing it')
+    args = parser.parse_args()
+
+    if args.command == 'setup':
+        # The seed is stamped with CURRENT_TIMESTAMP, so the partitions go in before it
+        if (run_statements(SETUP_STATEMENTS, args.dry_run, "Order history table and triggers created")
+                and ensure_partitions(args.months_ahead, args.dry_run)):
+            run_statements([SEED_CURRENT_STATUS_SQL], args.dry_run, "Current order status seeded")
+    elif args.command == 'ensure-partitions':
+        ensure_partitions(args.months_ahead, args.dry_run)
+    elif args.command == 'time-in-status':
+        show_time_in_status(args.start, args.end, args.include_open)
+    else:
+        if args.keep_months is None:
+            parser.error("prune requires --keep-months")
+        prune_history(args.keep_months, args.dry_run)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Raw API payloads of ordens_servico and set-based re-derivation of mapped columns.
+
+setup adds payload_bruto JSONB to ordens_servico (lz4 compressed when the server
+supports it) plus the SQL helpers used by re-derivation. Loaders add
+payload_column() to the columns of their upsert, so every field returned by Tiny is
+kept, including the ones no column maps (orcar/orcado, observacoesServico, ...).
+
+rederive recomputes dates, totals, orcar/orcado, linha_dispositivo and tipo_servico
+from the stored payloads with a single UPDATE inside PostgreSQL. Changing a mapping
+rule means editing DERIVATION_FUNCTIONS, running setup again and then rederive;
+no API calls are needed. Both payload shapes are understood: the camelCase detail
+(data, totalServicos, ...) and the snake_case v2 detail (data_emissao, total_servicos, ...).
+
+Usage:
+    python order_payloads.py setup [--gin-index] [--dry-run]
+    python order_payloads.py rederive [--year YEAR] [--dry-run]
+"""
+
+import json
+import argparse
+from datetime import datetime
+from psycopg2.extras import Json
+from db_utils import get_db_connection, close_db_connection
+
+PAYLOAD_COLUMN_STATEMENTS = [
+    "ALTER TABLE ordens_servico ADD COLUMN IF NOT EXISTS payload_bruto JSONB",
+    # lz4 needs PostgreSQL 14+ built --with-lz4; otherwise the default pglz is kept
+    """
+    DO $$
+    BEGIN
+        ALTER TABLE ordens_servico ALTER COLUMN payload_bruto SET COMPRESSION lz4;
+    EXCEPTION WHEN feature_not_supported OR syntax_error OR invalid_parameter_value THEN
+        RAISE NOTICE 'lz4 compression unavailable, keeping default TOAST compression';
+    END
+    $$
+    """,
+]
+
+# jsonb_path_ops is smaller and faster for @> containment, which is all we query with
+GIN_INDEX_STATEMENT = (
+    "CREATE INDEX IF NOT EXISTS idx_ordens_servico_payload_bruto "
+    "ON ordens_servico USING GIN (payload_bruto jsonb_path_ops)"
+)
+
+DERIVATION_FUNCTIONS = [
+    # Accepts YYYY-MM-DD[ HH:MM:SS] and DD/MM/YYYY; empty and 0000-00-00 become NULL
+    """
+    CREATE OR REPLACE FUNCTION payload_data(valor TEXT) RETURNS DATE
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT CASE
+            WHEN valor IS NULL OR btrim(valor) = '' OR valor LIKE '0000-00-00%' THEN NULL
+            WHEN valor ~ '^\\d{2}/\\d{2}/\\d{4}' THEN to_date(left(valor, 10), 'DD/MM/YYYY')
+            WHEN valor ~ '^\\d{4}-\\d{2}-\\d{2}' THEN to_date(left(valor, 10), 'YYYY-MM-DD')
+        END
+    $$
+    """,
+    # Accepts 1234.56 and the Brazilian 1.234,56; empty becomes NULL
+    """
+    CREATE OR REPLACE FUNCTION payload_numero(valor TEXT) RETURNS NUMERIC
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT CASE
+            WHEN valor IS NULL OR btrim(valor) !~ '^-?[0-9.,]+$' THEN NULL
+            WHEN valor LIKE '%,%' THEN replace(replace(valor, '.', ''), ',', '.')::numeric
+            ELSE valor::numeric
+        END
+    $$
+    """,
+    # Same keyword rules as process_data.py
+    """
+    CREATE OR REPLACE FUNCTION derivar_linha_dispositivo(equipamento TEXT) RETURNS TEXT
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT CASE
+            WHEN lower(equipamento) LIKE '%iphone%' THEN 'iphone'
+            WHEN lower(equipamento) LIKE '%mac%' THEN 'mac'
+            WHEN lower(equipamento) LIKE '%ipad%' THEN 'ipad'
+            WHEN lower(equipamento) LIKE '%apple watch%' THEN 'apple_watch'
+            ELSE 'outros'
+        END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION derivar_tipo_servico(descricao_problema TEXT) RETURNS TEXT
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT CASE
+            WHEN lower(descricao_problema) LIKE '%tela%' THEN 'troca_tela'
+            WHEN lower(descricao_problema) LIKE '%bateria%' THEN 'troca_bateria'
+            WHEN lower(descricao_problema) LIKE '%placa%' THEN 'reparo_placa'
+            WHEN lower(descricao_problema) LIKE '%vidro traseira%'
+              OR lower(descricao_problema) LIKE '%lente camera%' THEN 'troca_vidro_traseiro'
+            WHEN lower(descricao_problema) LIKE '%flex%'
+              OR lower(descricao_problema) LIKE '%carcaça%' THEN 'outros_perifericos'
+            ELSE 'outros'
+        END
+    $$
+    """,
+]
+
+# Only rows whose derived values actually differ are rewritten. data_emissao falls back
+# to the current value so a payload without a date never violates the partition key.
+REDERIVE_SQL = """
+    UPDATE ordens_servico o SET
+        data_emissao = d.data_emissao,
+        data_prevista = d.data_prevista,
+        data_conclusao = d.data_conclusao,
+        total_servicos = d.total_servicos,
+        total_ordem_servico = d.total_ordem_servico,
+        total_pecas = d.total_pecas,
+        orcar = d.orcar,
+        orcado = d.orcado,
+        linha_dispositivo = d.linha_dispositivo,
+        tipo_servico = d.tipo_servico
+    FROM (
+        SELECT
+            p.id,
+            p.data_emissao_atual,
+            COALESCE(payload_data(COALESCE(p.payload->>'data', p.payload->>'data_emissao')),
+                     p.data_emissao_atual) AS data_emissao,
+            payload_data(COALESCE(p.payload->>'dataPrevista', p.payload->>'data_prevista')) AS data_prevista,
+            payload_data(COALESCE(p.payload->>'dataConclusao', p.payload->>'data_conclusao')) AS data_conclusao,
+            payload_numero(COALESCE(p.payload->>'totalServicos', p.payload->>'total_servicos')) AS total_servicos,
+            payload_numero(COALESCE(p.payload->>'totalOrdemServico', p.payload->>'total_ordem_servico')) AS total_ordem_servico,
+            payload_numero(COALESCE(p.payload->>'totalPecas', p.payload->>'total_pecas')) AS total_pecas,
+            NULLIF(left(p.payload->>'orcar', 1), '') AS orcar,
+            NULLIF(left(p.payload->>'orcado', 1), '') AS orcado,
+            COALESCE(NULLIF(COALESCE(p.payload->>'linhaDispositivo', p.payload->>'linha_dispositivo'), ''),
+                     derivar_linha_dispositivo(p.payload->>'equipamento')) AS linha_dispositivo,
+            COALESCE(NULLIF(COALESCE(p.payload->>'tipoServico', p.payload->>'tipo_servico'), ''),
+                     derivar_tipo_servico(COALESCE(p.payload->>'descricaoProblema',
+                                                   p.payload->>'descricao_problema'))) AS tipo_servico
+        FROM (
+            SELECT id, data_emissao AS data_emissao_atual, payload_bruto AS payload
+            FROM ordens_servico
+            WHERE payload_bruto IS NOT NULL {filter}
+        ) p
+    ) d
+    WHERE o.id = d.id
+      AND o.data_emissao IS NOT DISTINCT FROM d.data_emissao_atual
+      AND (o.data_emissao, o.data_prevista, o.data_conclusao, o.total_servicos,
+           o.total_ordem_servico, o.total_pecas, o.orcar, o.orcado,
+           o.linha_dispositivo, o.tipo_servico)
+          IS DISTINCT FROM
+          (d.data_emissao, d.data_prevista, d.data_conclusao, d.total_servicos,
+           d.total_ordem_servico, d.total_pecas, d.orcar, d.orcado,
+           d.linha_dispositivo, d.tipo_servico)
+"""
+
+# Whether payload_bruto exists; it only changes when setup runs
+_payload_column_installed = None
+
+def log_json(level, message, **kwargs):
+    """Structured JSON logging function."""
+    log_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "level": level,
+        "message": message,
+        **kwargs
+    }
+    print(json.dumps(log_entry, ensure_ascii=False, default=str))
+
+def payload_column_exists(conn):
+    """True if ordens_servico has the payload_bruto column (cached per process)."""
+    global _payload_column_installed
+    if _payload_column_installed is None:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = 'public' AND table_name = 'ordens_servico'
+                  AND column_name = 'payload_bruto'
+            )
+        """)
+        _payload_column_installed = cur.fetchone()[0]
+        cur.close()
+    return _payload_column_installed
+
+def payload_column(conn, payload):
+    """
+    {"payload_bruto": payload} to merge into a loader's upsert columns, so the raw
+    API payload is written by the same statement. Empty until setup has added the column.
+    """
+    if not payload or not payload_column_exists(conn):
+        return {}
+    return {"payload_bruto": Json(payload)}
+
+def setup_payloads(gin_index=False, dry_run=False):
+    """Add the payload column and (re)create the derivation functions."""
+    statements = PAYLOAD_COLUMN_STATEMENTS + DERIVATION_FUNCTIONS
+    if gin_index:
+        statements = statements + [GIN_INDEX_STATEMENT]
+
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        cur = conn.cursor()
+        for sql in statements:
+            if dry_run:
+                print(sql.strip() + ";")
+            else:
+                cur.execute(sql)
+        if dry_run:
+            log_json("INFO", "[DRY RUN] No changes were made to the database")
+        else:
+            conn.commit()
+            log_json("INFO", "Order payload column and derivation functions are ready",
+                     gin_index=gin_index)
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error setting up order payloads: {e}")
+    finally:
+        close_db_connection(conn)
+
+def rederive_columns(year=None, dry_run=False):
+    """Recompute mapped columns from payload_bruto. With dry_run the UPDATE is rolled back."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        if not payload_column_exists(conn):
+            log_json("ERROR", "payload_bruto column not found, run 'setup' first")
+            return
+
+        cur = conn.cursor()
+        params = []
+        filter_sql = ""
+        if year:
+            # Range predicate so only that year's partition/index range is scanned
+            filter_sql = "AND data_emissao >= make_date(%s, 1, 1) AND data_emissao < make_date(%s + 1, 1, 1)"
+            params = [year, year]
+        cur.execute(REDERIVE_SQL.format(filter=filter_sql), params)
+        changed = cur.rowcount
+
+        if dry_run:
+            conn.rollback()
+            log_json("INFO", "[DRY RUN] Orders that would be updated", orders=changed, year=year)
+        else:
+            conn.commit()
+            log_json("INFO", "Mapped columns re-derived from payloads", orders=changed, year=year)
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error re-deriving columns: {e}")
+    finally:
+        close_db_connection(conn)
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Store raw order payloads and re-derive mapped columns from them')
+    parser.add_argument('command', choices=['setup', 'rederive'], help='Action to run')
+    parser.add_argument('--gin-index', action='store_true', help='Also create a GIN index on payload_bruto (setup)')
+    parser.add_argument('--year', type=int, help='Only re-derive orders emitted in this year (rederive)')
+    parser.add_argument('--dry-run', action='store_true', help='Print setup SQL / roll back the re-derivation')
+    args = parser.parse_args()
+
+    if args.command == 'setup':
+        setup_payloads(gin_index=args.gin_index, dry_run=args.dry_run)
+    else:
+        rederive_columns(year=args.year, dry_run=args.dry_run)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Pack the organized_whatsapp_chats/<year>/<month> directories into one
+<month>.chatpack archive each (format in chat_archive.py).
+
+pack writes the month's archive, merging any previous archive with the files
+now in the directory, then reads every transcript back and checks its SHA-256.
+With --remove-files, the packed .txt files are then deleted. The archive keeps
+each file's size and mtime, so index_chat_files.py sees no change after packing.
+unpack writes the archived transcripts back as files with their original mtime.
+
+Usage:
+    python pack_chat_archives.py pack [--year 2024] [--month 01] [--remove-files] [--dry-run]
+    python pack_chat_archives.py verify [--year 2024] [--month 01]
+    python pack_chat_archives.py unpack [--year 2024] [--month 01]
+"""
+
+import os
+import json
+import time
+import hashlib
+import argparse
+from datetime import datetime
+from chat_archive import ChatArchive, archive_path, open_transcript, transcript_stat, write_archive
+from index_chat_files import CHATS_DIR, extract_filename_data, chat_shards, chat_file_names
+from match_chat_contacts import canonical_phone
+
+def log_json(level, message, **kwargs):
+    """Structured JSON logging function."""
+    log_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "level": level,
+        "message": message,
+        **kwargs
+    }
+    print(json.dumps(log_entry, ensure_ascii=False, default=str))
+
+def verify_archive(path, expected=None):
+    """
+    Read every transcript of an archive sequentially and check it against its
+    stored SHA-256 (and against expected {name: sha256} when given).
+    Returns the names that failed.
+    """
+    failed = []
+    with ChatArchive(path) as archive:
+        for name, content in archive.scan():
+            digest = hashlib.sha256(content).hexdigest()
+            if digest != archive.entries[name]["sha256"] or (expected and expected.get(name) != digest):
+                failed.append(name)
+        if expected:
+            failed.extend(sorted(set(expected) - set(archive.entries)))
+    return failed
+
+def pack_shard(shard_dir, remove_files=False, dry_run=False):
+    """Pack one month (previous archive + directory) and verify it."""
+    started = time.monotonic()
+    names = chat_file_names(shard_dir)
+    loose = [name for name in names if os.path.exists(os.path.join(shard_dir, name))]
+    if not loose:
+        log_json("INFO", "Nothing to pack", shard=shard_dir, archived=len(names))
+        return
+    if dry_run:
+        log_json("INFO", "[DRY RUN] Would pack month", shard=shard_dir, files=len(names), loose_files=len(loose))
+        return
+
+    transcripts = []
+    expected = {}
+    for name in names:
+        file_path = os.path.join(shard_dir, name)
+        with open_transcript(file_path) as handle:
+            content = handle.read()
+        file_data = extract_filename_data(name) or {}
+        transcripts.append((name, content, transcript_stat(file_path)[1],
+                            canonical_phone(file_data.get("phone_number"))))
+        expected[name] = hashlib.sha256(content).hexdigest()
+
+    path = archive_path(shard_dir)
+    files, raw_bytes, archive_bytes = write_archive(path, transcripts)
+    failed = verify_archive(path, expected)
+    if failed:
+        log_json("ERROR", "Archive verification failed, files kept", shard=shard_dir, failed=failed[:20])
+        return
+
+    removed = 0
+    if remove_files:
+        for name in loose:
+            os.remove(os.path.join(shard_dir, name))
+            removed += 1
+        if not os.listdir(shard_dir):
+            os.rmdir(shard_dir)
+    log_json("INFO", "Month packed", shard=shard_dir, archive=path, files=files,
+             raw_bytes=raw_bytes, archive_bytes=archive_bytes,
+             ratio=round(raw_bytes / archive_bytes, 2) if archive_bytes else None,
+             removed_files=removed, elapsed_seconds=round(time.monotonic() - started, 1))
+
+def unpack_shard(shard_dir):
+    """Write the archived transcripts missing from the directory back to disk."""
+    path = archive_path(shard_dir)
+    if not os.path.exists(path):
+        return
+    os.makedirs(shard_dir, exist_ok=True)
+    written = 0
+    with ChatArchive(path) as archive:
+        for name, content in archive.scan():
+            file_path = os.path.join(shard_dir, name)
+            if os.path.exists(file_path):
+                continue
+            with open(file_path, "wb") as handle:
+                handle.write(content)
+            mtime_ns = archive.entries[name]["mtime_ns"]
+            os.utime(file_path, ns=(mtime_ns, mtime_ns))
+            written += 1
+    log_json("INFO", "Month unpacked", shard=shard_dir, files_written=written)
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Pack WhatsApp chat months into compressed archives')
+    parser.add_argument('command', choices=['pack', 'verify', 'unpack'], help='Action to run')
+    parser.add_argument('--year', help='Only this year (default: all years)')
+    parser.add_argument('--month', help='Only this month (01-12), across the selected years')
+    parser.add_argument('--remove-files', action='store_true', help='Delete the .txt files once packed and verified')
+    parser.add_argument('--dry-run', action='store_true', help='Report what would be packed without writing')
+    args = parser.parse_args()
+
+    if not os.path.isdir(CHATS_DIR):
+        log_json("ERROR", f"Chat directory {CHATS_DIR} does not exist")
+        return
+
+    started = time.monotonic()
+    shards = chat_shards(args.year, args.month)
+    for shard_dir in shards:
+        if args.command == 'pack':
+            pack_shard(shard_dir, remove_files=args.remove_files, dry_run=args.dry_run)
+        elif args.command == 'unpack':
+            unpack_shard(shard_dir)
+        elif os.path.exists(archive_path(shard_dir)):
+            failed = verify_archive(archive_path(shard_dir))
+            log_json("ERROR" if failed else "INFO", "Archive verified", shard=shard_dir, failed=failed[:20])
+    if args.dry_run:
+        log_json("INFO", "[DRY RUN] No files were written")
+    log_json("INFO", f"{args.command.capitalize()} complete", months=len(shards),
+             elapsed_seconds=round(time.monotonic() - started, 1))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,500 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Optional migration of ordens_servico (and its marker junction tables) to a
+declaratively partitioned layout, one RANGE partition per data_emissao year.
+
+Almost all reads and writes hit the last 18 months, while history goes back to
+2014. With yearly partitions, queries filtered by data_emissao are pruned to the
+hot years, autovacuum only has work on the partitions that actually change, and
+old years can be detached (metadata only) and archived.
+
+Layout after `migrate`:
+    ordens_servico                UNIQUE (id, data_emissao)
+    ordem_servico_marcadores      + data_emissao, FK (id_ordem_servico, data_emissao)
+    marcadores_ordem_servico      + data_emissao (legacy table, only if it exists)
+Each table gets <table>_y<YEAR> partitions and a <table>_default partition.
+The key is a unique constraint rather than a primary key, so data_emissao stays
+nullable and orders without it land in the default partitions.
+The original heap tables are kept as <table>_heap until dropped manually.
+
+Notes:
+- Loaders write through upsert_ordem_servico() from db_utils, which here locks
+  the id and updates by it first, so a changed data_emissao moves the order.
+  Before PostgreSQL 15 the move is a delete + insert and cascades to the marker
+  rows, which the tag loaders write again.
+- Other unique indexes get data_emissao appended to their key; the migration
+  stops on expression, partial or INCLUDE unique indexes, naming them.
+- Foreign keys from other tables to ordens_servico(id) (e.g. chat_files) are
+  dropped, since a partitioned table cannot expose a unique key on id alone.
+- Triggers are not copied; re-run the feature setup scripts after migrating.
+
+Usage:
+    python partition_ordens_servico.py migrate [--dry-run]
+    python partition_ordens_servico.py ensure-partitions [--years-ahead 1]
+    python partition_ordens_servico.py detach --year 2014 [--archive-schema archive]
+    python partition_ordens_servico.py vacuum [--hot-years 2]
+    python partition_ordens_servico.py status
+"""
+
+import json
+import argparse
+from datetime import datetime
+import psycopg2
+from db_utils import get_db_connection, close_db_connection
+
+ORDERS_TABLE = "ordens_servico"
+# Junction tables partitioned alongside the orders; order matters for detach
+JUNCTION_TABLES = ["ordem_servico_marcadores", "marcadores_ordem_servico"]
+DEFAULT_FIRST_YEAR = 2013
+
+def log_json(level, message, **kwargs):
+    """Structured JSON logging function."""
+    log_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "level": level,
+        "message": message,
+        **kwargs
+    }
+    print(json.dumps(log_entry, ensure_ascii=False, default=str))
+
+def table_exists(cur, table_name):
+    """Check if a table exists in the public schema."""
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (f"public.{table_name}",))
+    return cur.fetchone()[0]
+
+def is_partitioned(cur, table_name):
+    """Check if a table is declaratively partitioned."""
+    cur.execute("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_partitioned_table
+            WHERE partrelid = to_regclass(%s)
+        )
+    """, (f"public.{table_name}",))
+    return cur.fetchone()[0]
+
+def partition_name(table_name, year):
+    """Name of the yearly partition of a table."""
+    return f"{table_name}_y{year}"
+
+def partition_ddl(table_name, year, parent=None):
+    """DDL for the partition holding one data_emissao year."""
+    return (f"CREATE TABLE IF NOT EXISTS {partition_name(table_name, year)} "
+            f"PARTITION OF {parent or table_name} "
+            f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')")
+
+def partitioned_family(cur):
+    """Orders table plus the junction tables that exist and are partitioned."""
+    return [t for t in [ORDERS_TABLE] + JUNCTION_TABLES if table_exists(cur, t) and is_partitioned(cur, t)]
+
+def existing_partition_years(cur, table_name):
+    """Years that already have a partition attached to the table."""
+    cur.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+    """, (f"public.{table_name}",))
+    prefix = f"{table_name}_y"
+    return sorted(int(name[len(prefix):]) for (name,) in cur.fetchall()
+                  if name.startswith(prefix) and name[len(prefix):].isdigit())
+
+def unique_indexes(cur):
+    """Unique non-PK indexes of ordens_servico: ([(name, columns)] to recreate, [names] that cannot be)."""
+    cur.execute("""
+        SELECT i.indexrelid::regclass::text,
+               i.indexprs IS NULL AND i.indpred IS NULL AND i.indnatts = i.indnkeyatts,
+               ARRAY(SELECT a.attname FROM unnest(i.indkey) WITH ORDINALITY AS k(attnum, n)
+                     JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+                     ORDER BY k.n)
+        FROM pg_index i
+        WHERE i.indrelid = to_regclass('public.ordens_servico')
+          AND i.indisunique AND NOT i.indisprimary
+        ORDER BY 1
+    """)
+    rows = cur.fetchall()
+    return ([(name, list(columns)) for name, plain, columns in rows if plain],
+            [name for name, plain, _ in rows if not plain])
+
+def build_migration_statements(cur, first_year, last_year):
+    """
+    Build the DDL/DML that copies the heap tables into partitioned ones and swaps names.
+    Everything runs in a single transaction, so a failure leaves the heap layout intact.
+    """
+    statements = []
+    years = range(first_year, last_year + 1)
+
+    # Free the canonical index/constraint names on the heap table so the new table can take them
+    cur.execute("""
+        SELECT indexrelid::regclass::text, indisprimary
+        FROM pg_index WHERE indrelid = to_regclass('public.ordens_servico')
+    """)
+    heap_indexes = cur.fetchall()
+    cur.execute("""
+        SELECT pg_get_indexdef(indexrelid)
+        FROM pg_index
+        WHERE indrelid = to_regclass('public.ordens_servico')
+          AND NOT indisprimary AND NOT indisunique
+    """)
+    secondary_indexes = [row[0] for row in cur.fetchall()]
+    recreated_unique, _ = unique_indexes(cur)
+    for index_name, is_primary in heap_indexes:
+        if is_primary:
+            statements.append(f"ALTER TABLE {ORDERS_TABLE} RENAME CONSTRAINT {index_name} TO {ORDERS_TABLE}_heap_pkey")
+        else:
+            statements.append(f"ALTER INDEX {index_name} RENAME TO {index_name[:58]}_heap")
+
+    # Orders: same columns, defaults and checks; the key gains the partition key.
+    # A unique constraint instead of a PK keeps data_emissao nullable.
+    statements.append(f"""
+        CREATE TABLE {ORDERS_TABLE}_part (
+            LIKE {ORDERS_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS
+                INCLUDING GENERATED INCLUDING STORAGE INCLUDING COMMENTS,
+            CONSTRAINT {ORDERS_TABLE}_id_data_emissao_key UNIQUE (id, data_emissao)
+        ) PARTITION BY RANGE (data_emissao)
+    """)
+    cur.execute("""
+        SELECT conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid = to_regclass('public.ordens_servico') AND contype = 'f'
+    """)
+    for conname, definition in cur.fetchall():
+        statements.append(f"ALTER TABLE {ORDERS_TABLE}_part ADD CONSTRAINT {conname} {definition}")
+    for index_def in secondary_indexes:
+        statements.append(index_def.replace(f" ON public.{ORDERS_TABLE} ", f" ON public.{ORDERS_TABLE}_part "))
+    # Unique indexes on a partitioned table must include the partition key
+    for index_name, columns in recreated_unique:
+        if "data_emissao" not in columns:
+            columns = columns + ["data_emissao"]
+        statements.append(f"CREATE UNIQUE INDEX {index_name} ON {ORDERS_TABLE}_part ({', '.join(columns)})")
+
+    # Foreign keys from outside the family cannot point at (id) anymore
+    cur.execute("""
+        SELECT conrelid::regclass::text, conname
+        FROM pg_constraint
+        WHERE confrelid = to_regclass('public.ordens_servico') AND contype = 'f'
+          AND conrelid::regclass::text <> ALL(%s)
+    """, (JUNCTION_TABLES,))
+    for table_name, conname in cur.fetchall():
+        statements.append(f"ALTER TABLE {table_name} DROP CONSTRAINT {conname}")
+
+    # Junction tables carry data_emissao so they can be pruned together with the orders
+    junctions = [t for t in JUNCTION_TABLES if table_exists(cur, t)]
+    if "ordem_servico_marcadores" in junctions:
+        statements.append("""
+            CREATE TABLE ordem_servico_marcadores_part (
+                id_ordem_servico INTEGER NOT NULL,
+                id_marcador INTEGER NOT NULL,
+                data_emissao DATE,
+                CONSTRAINT ordem_servico_marcadores_part_key
+                    UNIQUE (id_ordem_servico, id_marcador, data_emissao),
+                CONSTRAINT fk_os_marcadores_os_part
+                    FOREIGN KEY (id_ordem_servico, data_emissao)
+                    REFERENCES ordens_servico_part (id, data_emissao)
+                    ON UPDATE CASCADE ON DELETE CASCADE,
+                CONSTRAINT fk_os_marcadores_marcadores_part
+                    FOREIGN KEY (id_marcador)
+                    REFERENCES marcadores (id)
+            ) PARTITION BY RANGE (data_emissao)
+        """)
+    if "marcadores_ordem_servico" in junctions:
+        statements.append("""
+            CREATE TABLE marcadores_ordem_servico_part (
+                id INTEGER NOT NULL DEFAULT nextval('marcadores_ordem_servico_id_seq'::regclass),
+                id_ordem_servico INTEGER NOT NULL,
+                descricao VARCHAR(255) NOT NULL,
+                data_emissao DATE,
+                CONSTRAINT marcadores_ordem_servico_part_key UNIQUE (id, data_emissao),
+                CONSTRAINT fk_marcadores_os_part
+                    FOREIGN KEY (id_ordem_servico, data_emissao)
+                    REFERENCES ordens_servico_part (id, data_emissao)
+                    ON UPDATE CASCADE ON DELETE CASCADE
+            ) PARTITION BY RANGE (data_emissao)
+        """)
+
+    for table_name in [ORDERS_TABLE] + junctions:
+        for year in years:
+            statements.append(partition_ddl(table_name, year, parent=f"{table_name}_part"))
+        statements.append(f"CREATE TABLE {table_name}_default PARTITION OF {table_name}_part DEFAULT")
+
+    # Copy rows; generated columns (e.g. busca_tsv) are recomputed by the new table
+    cur.execute("""
+        SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum)
+        FROM pg_attribute
+        WHERE attrelid = to_regclass('public.ordens_servico')
+          AND attnum > 0 AND NOT attisdropped AND attgenerated = ''
+    """)
+    columns = cur.fetchone()[0]
+    statements.append(f"INSERT INTO {ORDERS_TABLE}_part ({columns}) SELECT {columns} FROM {ORDERS_TABLE}")
+    # Junction rows take data_emissao from their order
+    if "ordem_servico_marcadores" in junctions:
+        statements.append("""
+            INSERT INTO ordem_servico_marcadores_part (id_ordem_servico, id_marcador, data_emissao)
+            SELECT m.id_ordem_servico, m.id_marcador, o.data_emissao
+            FROM ordem_servico_marcadores m
+            JOIN ordens_servico o ON o.id = m.id_ordem_servico
+        """)
+    if "marcadores_ordem_servico" in junctions:
+        statements.append("""
+            INSERT INTO marcadores_ordem_servico_part (id, id_ordem_servico, descricao, data_emissao)
+            SELECT m.id, m.id_ordem_servico, m.descricao, o.data_emissao
+            FROM marcadores_ordem_servico m
+            JOIN ordens_servico o ON o.id = m.id_ordem_servico
+        """)
+        # Keep the id sequence alive if the heap table is dropped later
+        statements.append("""
+            ALTER SEQUENCE marcadores_ordem_servico_id_seq OWNED BY marcadores_ordem_servico_part.id
+        """)
+
+    # Swap names: heap tables stay available as <table>_heap
+    for table_name in junctions + [ORDERS_TABLE]:
+        statements.append(f"ALTER TABLE {table_name} RENAME TO {table_name}_heap")
+        statements.append(f"ALTER TABLE {table_name}_part RENAME TO {table_name}")
+    return statements
+
+def migrate(dry_run=False, years_ahead=1):
+    """Migrate the heap tables to the partitioned layout in one transaction."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        cur = conn.cursor()
+        if is_partitioned(cur, ORDERS_TABLE):
+            log_json("INFO", "ordens_servico is already partitioned, nothing to migrate")
+            return
+
+        # Block writers while rows are copied; readers of the old table keep working until the swap
+        if not dry_run:
+            cur.execute(f"LOCK TABLE {ORDERS_TABLE} IN SHARE ROW EXCLUSIVE MODE")
+
+        # Unique indexes must include the partition key; expressions and predicates cannot be widened
+        recreated_unique, unsupported = unique_indexes(cur)
+        if unsupported:
+            log_json("ERROR", "Drop or rewrite these unique indexes before partitioning", indexes=unsupported)
+            conn.rollback()
+            return
+        log_json("INFO", "Unique indexes recreated with data_emissao in their key",
+                 indexes=[name for name, columns in recreated_unique if "data_emissao" not in columns])
+        cur.execute("SHOW server_version_num")
+        if int(cur.fetchone()[0]) < 150000:
+            log_json("WARNING", "Before PostgreSQL 15, an order moved to another year loses its marker rows until the tag loaders run")
+
+        cur.execute(f"SELECT EXTRACT(YEAR FROM MIN(data_emissao))::int, EXTRACT(YEAR FROM MAX(data_emissao))::int FROM {ORDERS_TABLE}")
+        min_year, max_year = cur.fetchone()
+        first_year = min(min_year or DEFAULT_FIRST_YEAR, DEFAULT_FIRST_YEAR)
+        last_year = max(max_year or datetime.now().year, datetime.now().year) + years_ahead
+
+        statements = build_migration_statements(cur, first_year, last_year)
+        log_json("INFO", f"Partitioning ordens_servico by year {first_year}-{last_year} (dry_run={dry_run})",
+                 statements=len(statements))
+
+        for sql in statements:
+            if dry_run:
+                print(sql.strip() + ";")
+            else:
+                cur.execute(sql)
+
+        if dry_run:
+            conn.rollback()
+            log_json("INFO", "[DRY RUN] No changes were made to the database")
+            return
+
+        conn.commit()
+        log_json("INFO", "Migration completed; heap tables kept as *_heap. Run ANALYZE on the new tables.")
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error partitioning ordens_servico: {e}")
+    finally:
+        close_db_connection(conn)
+
+def ensure_partitions(years_ahead=1, dry_run=False):
+    """Create the yearly partitions up to current year + years_ahead (meant for cron)."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        cur = conn.cursor()
+        family = partitioned_family(cur)
+        if ORDERS_TABLE not in family:
+            log_json("WARNING", "ordens_servico is not partitioned, run 'migrate' first")
+            return
+
+        target_year = datetime.now().year + years_ahead
+        for table_name in family:
+            years = existing_partition_years(cur, table_name)
+            for year in range((years[-1] + 1) if years else datetime.now().year, target_year + 1):
+                # A default partition holding rows for the new range would make CREATE fail
+                cur.execute(f"""
+                    SELECT COUNT(*) FROM {table_name}_default
+                    WHERE data_emissao >= %s AND data_emissao < %s
+                """, (f"{year}-01-01", f"{year + 1}-01-01"))
+                stray_rows = cur.fetchone()[0]
+                if stray_rows:
+                    log_json("ERROR", f"Default partition of {table_name} has rows for {year}; move them before creating the partition",
+                             rows=stray_rows)
+                    continue
+                if dry_run:
+                    log_json("INFO", f"[DRY RUN] Would create {partition_name(table_name, year)}")
+                else:
+                    cur.execute(partition_ddl(table_name, year))
+                    log_json("INFO", f"Created partition {partition_name(table_name, year)}")
+
+        if not dry_run:
+            conn.commit()
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error creating partitions: {e}")
+    finally:
+        close_db_connection(conn)
+
+def detach_year(year, archive_schema=None, dry_run=False):
+    """
+    Detach one year from every table of the family (metadata-only operation).
+    Junction partitions are detached first and lose their FK to ordens_servico, so the
+    detached tables form a self-contained archive that can be dumped or dropped.
+    """
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        cur = conn.cursor()
+        family = partitioned_family(cur)
+        statements = []
+        for table_name in [t for t in JUNCTION_TABLES if t in family] + [ORDERS_TABLE]:
+            part = partition_name(table_name, year)
+            if year not in existing_partition_years(cur, table_name):
+                log_json("WARNING", f"Partition {part} is not attached, skipping")
+                continue
+            statements.append(f"ALTER TABLE {table_name} DETACH PARTITION {part}")
+            if table_name != ORDERS_TABLE:
+                cur.execute("""
+                    SELECT conname FROM pg_constraint
+                    WHERE conrelid = to_regclass(%s) AND contype = 'f'
+                      AND confrelid = to_regclass('public.ordens_servico')
+                """, (f"public.{part}",))
+                for (conname,) in cur.fetchall():
+                    statements.append(f"ALTER TABLE {part} DROP CONSTRAINT {conname}")
+            if archive_schema:
+                statements.append(f"ALTER TABLE {part} SET SCHEMA {archive_schema}")
+
+        if archive_schema and statements:
+            statements.insert(0, f"CREATE SCHEMA IF NOT EXISTS {archive_schema}")
+
+        for sql in statements:
+            if dry_run:
+                print(sql + ";")
+            else:
+                cur.execute(sql)
+
+        if dry_run:
+            conn.rollback()
+            log_json("INFO", "[DRY RUN] No changes were made to the database")
+        else:
+            conn.commit()
+            log_json("INFO", f"Year {year} detached", archive_schema=archive_schema)
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error detaching year {year}: {e}")
+    finally:
+        close_db_connection(conn)
+
+def vacuum_hot_partitions(hot_years=2):
+    """VACUUM (ANALYZE) only the partitions of the most recent years."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        conn.autocommit = True  # VACUUM cannot run inside a transaction block
+        cur = conn.cursor()
+        first_hot_year = datetime.now().year - hot_years + 1
+        for table_name in partitioned_family(cur):
+            for year in existing_partition_years(cur, table_name):
+                if first_hot_year <= year <= datetime.now().year:
+                    log_json("INFO", f"Vacuuming {partition_name(table_name, year)}")
+                    cur.execute(f"VACUUM (ANALYZE) {partition_name(table_name, year)}")
+    except Exception as e:
+        log_json("ERROR", f"Error vacuuming partitions: {e}")
+    finally:
+        close_db_connection(conn)
+
+def show_status():
+    """Print partition sizes and orders whose id appears in more than one year."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        cur = conn.cursor()
+        family = partitioned_family(cur)
+        if not family:
+            log_json("INFO", "ordens_servico uses the heap layout (not partitioned)")
+            return
+        for table_name in family:
+            cur.execute("""
+                SELECT c.relname, c.reltuples::bigint, pg_size_pretty(pg_total_relation_size(c.oid))
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = to_regclass(%s)
+                ORDER BY c.relname
+            """, (f"public.{table_name}",))
+            for relname, estimated_rows, size in cur.fetchall():
+                log_json("INFO", "Partition", table=table_name, partition=relname,
+                         estimated_rows=estimated_rows, size=size)
+
+        # Uniqueness of id is only enforced together with data_emissao
+        cur.execute(f"SELECT id FROM {ORDERS_TABLE} GROUP BY id HAVING COUNT(*) > 1 LIMIT 20")
+        duplicated = [row[0] for row in cur.fetchall()]
+        if duplicated:
+            log_json("WARNING", "Orders stored under more than one data_emissao", sample_ids=duplicated)
+    except psycopg2.Error as e:
+        log_json("ERROR", f"Error reading partition status: {e}")
+    finally:
+        close_db_connection(conn)
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Partition ordens_servico by data_emissao year')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser('migrate', help='Copy the heap tables into the partitioned layout')
+    migrate_parser.add_argument('--years-ahead', type=int, default=1, help='Future years to pre-create (default: 1)')
+    migrate_parser.add_argument('--dry-run', action='store_true', help='Print SQL statements without executing them')
+
+    ensure_parser = subparsers.add_parser('ensure-partitions', help='Create partitions for upcoming years')
+    ensure_parser.add_argument('--years-ahead', type=int, default=1, help='Future years to pre-create (default: 1)')
+    ensure_parser.add_argument('--dry-run', action='store_true', help='Print actions without executing them')
+
+    detach_parser = subparsers.add_parser('detach', help='Detach one year for archiving')
+    detach_parser.add_argument('--year', type=int, required=True, help='data_emissao year to detach')
+    detach_parser.add_argument('--archive-schema', help='Schema to move the detached tables into')
+    detach_parser.add_argument('--dry-run', action='store_true', help='Print SQL statements without executing them')
+
+    vacuum_parser = subparsers.add_parser('vacuum', help='VACUUM (ANALYZE) the recent partitions only')
+    vacuum_parser.add_argument('--hot-years', type=int, default=2, help='Number of recent years to vacuum (default: 2)')
+
+    subparsers.add_parser('status', help='Show partitions and duplicated ids')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        migrate(dry_run=args.dry_run, years_ahead=args.years_ahead)
+    elif args.command == 'ensure-partitions':
+        ensure_partitions(years_ahead=args.years_ahead, dry_run=args.dry_run)
+    elif args.command == 'detach':
+        detach_year(args.year, archive_schema=args.archive_schema, dry_run=args.dry_run)
+    elif args.command == 'vacuum':
+        vacuum_hot_partitions(hot_years=args.hot_years)
+    else:
+        show_status()
+
+if __name__ == "__main__":
+    main()
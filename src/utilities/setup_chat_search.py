@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Portuguese full-text search over chat_messages, filtered by customer and device.
+
+Creates:
+- busca_tsv, a stored generated tsvector of message_text in the pt_unaccent
+  configuration shared with setup_order_search.py (created here if missing),
+  and a GIN index on it;
+- pg_trgm GIN indexes for partial matches: contact and chat names, the digits
+  of contact and chat phones, and ordens_servico.equipamento;
+- buscar_mensagens_chat(termo, filtro_cliente, filtro_equipamento, limite,
+  deslocamento, data_inicio, data_fim), which ranks the matching messages with
+  ts_rank_cd, joins the page to contatos and the linked ordens_servico row and
+  builds ts_headline snippets only for the returned page.
+
+filtro_cliente matches part of a name, or at least 4 digits of a phone.
+filtro_equipamento keeps the customers with any order whose equipamento
+contains it, so "garantia" + "iphone 13" finds the warranty conversations of
+iPhone 13 owners.
+
+Usage:
+    python setup_chat_search.py [--dry-run]
+    python setup_chat_search.py --check garantia [--equipamento "iphone 13"]   # time one search
+"""
+
+import json
+import time
+import argparse
+from datetime import datetime
+from db_utils import get_db_connection, close_db_connection
+
+SEARCH_STATEMENTS = [
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_ts_config WHERE cfgname = 'pt_unaccent') THEN
+            CREATE TEXT SEARCH CONFIGURATION public.pt_unaccent (COPY = pg_catalog.portuguese);
+            ALTER TEXT SEARCH CONFIGURATION public.pt_unaccent
+                ALTER MAPPING FOR hword, hword_part, word WITH unaccent, portuguese_stem;
+        END IF;
+    END
+    $$
+    """,
+    # Quoted replies (responding_to) are left out, so a quote does not repeat the hit
+    """
+    ALTER TABLE chat_messages ADD COLUMN IF NOT EXISTS busca_tsv tsvector
+    GENERATED ALWAYS AS (to_tsvector('public.pt_unaccent', coalesce(message_text, ''))) STORED
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_chat_messages_busca_tsv ON chat_messages USING GIN (busca_tsv)",
+    "CREATE INDEX IF NOT EXISTS idx_contatos_nome_trgm ON contatos USING GIN (nome gin_trgm_ops)",
+    """
+    CREATE INDEX IF NOT EXISTS idx_contatos_fones_trgm ON contatos USING GIN (
+        (regexp_replace(coalesce(celular, '') || ' ' || coalesce(telefone, ''), '[^0-9 ]', '', 'g')) gin_trgm_ops
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_chat_files_nome_trgm ON chat_files USING GIN (customer_name gin_trgm_ops)",
+    """
+    CREATE INDEX IF NOT EXISTS idx_chat_files_fone_trgm ON chat_files USING GIN (
+        (regexp_replace(coalesce(phone_number, ''), '[^0-9]', '', 'g')) gin_trgm_ops
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_ordens_servico_equipamento_trgm ON ordens_servico USING GIN (equipamento gin_trgm_ops)",
+    # Filter parameters are prefixed so they never collide with the column names used in the body
+    """
+    CREATE OR REPLACE FUNCTION buscar_mensagens_chat(
+        termo TEXT,
+        filtro_cliente TEXT DEFAULT NULL,
+        filtro_equipamento TEXT DEFAULT NULL,
+        limite INTEGER DEFAULT 20,
+        deslocamento INTEGER DEFAULT 0,
+        data_inicio DATE DEFAULT NULL,
+        data_fim DATE DEFAULT NULL
+    )
+    RETURNS TABLE (
+        id INTEGER,
+        id_chat_file INTEGER,
+        message_timestamp TIMESTAMP,
+        is_from_customer BOOLEAN,
+        id_contato INTEGER,
+        nome_cliente TEXT,
+        telefone TEXT,
+        id_ordem_servico INTEGER,
+        numero_ordem_servico VARCHAR,
+        equipamento VARCHAR,
+        situacao VARCHAR,
+        relevancia REAL,
+        trecho TEXT
+    )
+    LANGUAGE sql STABLE AS $$
+        WITH consulta AS (
+            SELECT websearch_to_tsquery('public.pt_unaccent', termo) AS q,
+                   '%' || nullif(btrim(filtro_cliente), '') || '%' AS nome,
+                   '%' || substring(regexp_replace(coalesce(filtro_cliente, ''), '[^0-9]', '', 'g') FROM '\\d{4,}') || '%' AS digitos,
+                   '%' || nullif(btrim(filtro_equipamento), '') || '%' AS aparelho
+        ),
+        -- Contacts matching the customer / device filters, resolved through the trigram indexes
+        contatos_filtro AS (
+            SELECT ct.id
+            FROM contatos ct, consulta c
+            WHERE c.nome IS NOT NULL
+              AND (ct.nome ILIKE c.nome
+                   OR regexp_replace(coalesce(ct.celular, '') || ' ' || coalesce(ct.telefone, ''), '[^0-9 ]', '', 'g') LIKE c.digitos)
+        ),
+        contatos_aparelho AS (
+            SELECT DISTINCT o.id_contato AS id
+            FROM ordens_servico o, consulta c
+            WHERE c.aparelho IS NOT NULL AND o.equipamento ILIKE c.aparelho
+        ),
+        pagina AS (
+            SELECT cm.id, cm.id_chat_file, cm.message_timestamp, cm.is_from_customer, cm.message_text,
+                   cf.id_contato, cf.customer_name, cf.phone_number, cf.id_ordem_servico,
+                   ts_rank_cd(cm.busca_tsv, c.q) AS relevancia
+            FROM chat_messages cm
+            JOIN chat_files cf ON cf.id = cm.id_chat_file
+            CROSS JOIN consulta c
+            WHERE cm.busca_tsv @@ c.q
+              AND (data_inicio IS NULL OR cm.message_timestamp >= data_inicio)
+              AND (data_fim IS NULL OR cm.message_timestamp < data_fim + 1)
+              AND (c.nome IS NULL
+                   OR cf.id_contato IN (SELECT f.id FROM contatos_filtro f)
+                   OR cf.customer_name ILIKE c.nome
+                   OR regexp_replace(coalesce(cf.phone_number, ''), '[^0-9]', '', 'g') LIKE c.digitos)
+              AND (c.aparelho IS NULL OR cf.id_contato IN (SELECT a.id FROM contatos_aparelho a))
+            ORDER BY relevancia DESC, cm.message_timestamp DESC, cm.id DESC
+            LIMIT limite OFFSET deslocamento
+        )
+        SELECT p.id, p.id_chat_file, p.message_timestamp, p.is_from_customer, p.id_contato,
+               coalesce(ct.nome, p.customer_name)::text, coalesce(ct.celular, p.phone_number)::text,
+               p.id_ordem_servico, o.numero_ordem_servico, o.equipamento, o.situacao,
+               p.relevancia,
+               ts_headline('public.pt_unaccent', coalesce(p.message_text, ''), c.q,
+                           'StartSel=<mark>, StopSel=</mark>, MaxFragments=2, MaxWords=20, MinWords=5')
+        FROM pagina p
+        CROSS JOIN consulta c
+        LEFT JOIN contatos ct ON ct.id = p.id_contato
+        LEFT JOIN ordens_servico o ON o.id = p.id_ordem_servico
+        ORDER BY p.relevancia DESC, p.message_timestamp DESC, p.id DESC
+    $$
+    """,
+]
+
+def log_json(level, message, **kwargs):
+    """Structured JSON logging function."""
+    log_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "level": level,
+        "message": message,
+        **kwargs
+    }
+    print(json.dumps(log_entry, ensure_ascii=False, default=str))
+
+def setup_chat_search(dry_run=False):
+    """Create the search column, indexes and function."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        cur = conn.cursor()
+        for sql in SEARCH_STATEMENTS:
+            if dry_run:
+                print(sql.strip() + ";")
+            else:
+                cur.execute(sql)
+
+        if dry_run:
+            log_json("INFO", "[DRY RUN] No changes were made to the database")
+        else:
+            conn.commit()
+            cur.execute("ANALYZE chat_messages")
+            cur.execute("ANALYZE chat_files")
+            conn.commit()
+            log_json("INFO", "Chat message search setup completed successfully")
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error setting up chat search: {e}")
+    finally:
+        close_db_connection(conn)
+
+def check_chat_search(term, client=None, device=None, limit=20):
+    """Run one search and log its first page size and elapsed time."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        cur = conn.cursor()
+        started = time.monotonic()
+        cur.execute("SELECT * FROM buscar_mensagens_chat(%s, %s, %s, %s)", (term, client, device, limit))
+        rows = cur.fetchall()
+        log_json("INFO", "Chat search timed", q=term, cliente=client, equipamento=device,
+                 results=len(rows), elapsed_ms=round((time.monotonic() - started) * 1000, 1))
+    except Exception as e:
+        log_json("ERROR", f"Error running chat search: {e}")
+    finally:
+        close_db_connection(conn)
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Set up Portuguese full-text search on chat_messages')
+    parser.add_argument('--dry-run', action='store_true', help='Print SQL statements without executing them')
+    parser.add_argument('--check', metavar='TERM', help='Time one search instead of running the setup')
+    parser.add_argument('--cliente', help='Customer name or phone filter for --check')
+    parser.add_argument('--equipamento', help='Device filter for --check')
+    args = parser.parse_args()
+
+    if args.check:
+        check_chat_search(args.check, args.cliente, args.equipamento)
+    else:
+        setup_chat_search(dry_run=args.dry_run)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Portuguese full-text search over the free-text fields of ordens_servico.
+
+Creates:
+- the pt_unaccent text search configuration (Portuguese stemming + unaccent),
+  so "tela", "telas" and "Têla" match the same lexeme;
+- busca_tsv, a stored generated tsvector column weighted
+  equipamento (A) > descricao_problema (B) > observacoes (C) > observacoes_internas (D).
+  PostgreSQL keeps it up to date on every INSERT/UPDATE, no loader changes needed;
+- a GIN index on busca_tsv;
+- buscar_ordens_servico(termo, limite, deslocamento, data_inicio, data_fim), which
+  ranks matches with ts_rank_cd and builds ts_headline snippets only for the
+  returned page, so highlighting cost does not grow with the table.
+
+Usage:
+    python setup_order_search.py [--dry-run]
+"""
+
+import json
+import argparse
+from datetime import datetime
+from db_utils import get_db_connection, close_db_connection
+
+SEARCH_STATEMENTS = [
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_ts_config WHERE cfgname = 'pt_unaccent') THEN
+            CREATE TEXT SEARCH CONFIGURATION public.pt_unaccent (COPY = pg_catalog.portuguese);
+            ALTER TEXT SEARCH CONFIGURATION public.pt_unaccent
+                ALTER MAPPING FOR hword, hword_part, word WITH unaccent, portuguese_stem;
+        END IF;
+    END
+    $$
+    """,
+    # to_tsvector with a constant configuration is immutable, so it can back a generated column
+    """
+    ALTER TABLE ordens_servico ADD COLUMN IF NOT EXISTS busca_tsv tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('public.pt_unaccent', coalesce(equipamento, '')), 'A') ||
+        setweight(to_tsvector('public.pt_unaccent', coalesce(descricao_problema, '')), 'B') ||
+        setweight(to_tsvector('public.pt_unaccent', coalesce(observacoes, '')), 'C') ||
+        setweight(to_tsvector('public.pt_unaccent', coalesce(observacoes_internas, '')), 'D')
+    ) STORED
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_ordens_servico_busca_tsv ON ordens_servico USING GIN (busca_tsv)",
+    """
+    CREATE OR REPLACE FUNCTION buscar_ordens_servico(
+        termo TEXT,
+        limite INTEGER DEFAULT 20,
+        deslocamento INTEGER DEFAULT 0,
+        data_inicio DATE DEFAULT NULL,
+        data_fim DATE DEFAULT NULL
+    )
+    RETURNS TABLE (
+        id INTEGER,
+        numero_ordem_servico VARCHAR,
+        data_emissao DATE,
+        situacao VARCHAR,
+        equipamento VARCHAR,
+        relevancia REAL,
+        trecho TEXT
+    )
+    LANGUAGE sql STABLE AS $$
+        WITH consulta AS (
+            SELECT websearch_to_tsquery('public.pt_unaccent', termo) AS q
+        ),
+        pagina AS (
+            SELECT o.id, o.numero_ordem_servico, o.data_emissao, o.situacao, o.equipamento,
+                   o.descricao_problema, o.observacoes, o.observacoes_internas,
+                   ts_rank_cd(o.busca_tsv, c.q) AS relevancia
+            FROM ordens_servico o, consulta c
+            WHERE o.busca_tsv @@ c.q
+              AND (data_inicio IS NULL OR o.data_emissao >= data_inicio)
+              AND (data_fim IS NULL OR o.data_emissao <= data_fim)
+            ORDER BY relevancia DESC, o.data_emissao DESC, o.id DESC
+            LIMIT limite OFFSET deslocamento
+        )
+        SELECT p.id, p.numero_ordem_servico, p.data_emissao, p.situacao, p.equipamento,
+               p.relevancia,
+               ts_headline('public.pt_unaccent',
+                           concat_ws(' | ', p.equipamento, p.descricao_problema,
+                                     p.observacoes, p.observacoes_internas),
+                           c.q,
+                           'StartSel=<mark>, StopSel=</mark>, MaxFragments=2, MaxWords=20, MinWords=5')
+        FROM pagina p, consulta c
+        ORDER BY p.relevancia DESC, p.data_emissao DESC, p.id DESC
+    $$
+    """,
+]
+
+def log_json(level, message, **kwargs):
+    """Structured JSON logging function."""
+    log_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "level": level,
+        "message": message,
+        **kwargs
+    }
+    print(json.dumps(log_entry, ensure_ascii=False))
+
+def setup_order_search(dry_run=False):
+    """Create the search configuration, column, index and function."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        cur = conn.cursor()
+        for sql in SEARCH_STATEMENTS:
+            if dry_run:
+                print(sql.strip() + ";")
+            else:
+                cur.execute(sql)
+
+        if dry_run:
+            log_json("INFO", "[DRY RUN] No changes were made to the database")
+        else:
+            conn.commit()
+            cur.execute("ANALYZE ordens_servico")
+            conn.commit()
+            log_json("INFO", "Order full-text search setup completed successfully")
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error setting up order search: {e}")
+    finally:
+        close_db_connection(conn)
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Set up Portuguese full-text search on ordens_servico')
+    parser.add_argument('--dry-run', action='store_true', help='Print SQL statements without executing them')
+    args = parser.parse_args()
+
+    setup_order_search(dry_run=args.dry_run)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Per-table change counters used as cheap HTTP cache validators by web_api.
+
+tabelas_versao holds one row per watched table with a version number and the time
+of the last change. Statement-level triggers bump it on every INSERT, UPDATE or
+DELETE, so every loader keeps it current without code changes, and the API can
+build ETag/Last-Modified from a primary-key lookup instead of scanning the data.
+
+Usage:
+    python table_versions.py setup [--dry-run]
+    python table_versions.py show
+"""
+
+import json
+import argparse
+from datetime import datetime
+from db_utils import get_db_connection, close_db_connection
+
+# Tables whose changes invalidate API responses
+WATCHED_TABLES = [
+    "ordens_servico", "kpi_ordens_mensal", "contatos", "enderecos", "chat_files",
+    "chat_messages", "chat_file_trechos", "chat_mencoes_os", "ordem_servico_marcadores",
+    "marcadores_ordem_servico"
+]
+
+SETUP_STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS tabelas_versao (
+        tabela VARCHAR(63) PRIMARY KEY,
+        versao BIGINT NOT NULL DEFAULT 1,
+        alterado_em TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """,
+    # Tables created before alterado_em was time zone aware; naive values were session local time
+    """
+    DO $$
+    BEGIN
+        IF (SELECT data_type FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = 'tabelas_versao'
+              AND column_name = 'alterado_em') = 'timestamp without time zone' THEN
+            ALTER TABLE tabelas_versao
+                ALTER COLUMN alterado_em TYPE TIMESTAMPTZ USING alterado_em::timestamptz,
+                ALTER COLUMN alterado_em SET DEFAULT now();
+        END IF;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION tabelas_versao_incrementar() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO tabelas_versao (tabela) VALUES (TG_TABLE_NAME)
+        ON CONFLICT (tabela) DO UPDATE
+            SET versao = tabelas_versao.versao + 1,
+                alterado_em = now();
+        RETURN NULL;
+    END;
+    $$
+    """,
+]
+
+def trigger_statements(table_name):
+    """Trigger DDL for one watched table (skipped by PostgreSQL if the table is missing)."""
+    return [f"""
+    DO $$
+    BEGIN
+        IF to_regclass('public.{table_name}') IS NOT NULL THEN
+            DROP TRIGGER IF EXISTS trg_versao_{table_name} ON {table_name};
+            CREATE TRIGGER trg_versao_{table_name}
+                AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table_name}
+                FOR EACH STATEMENT EXECUTE FUNCTION tabelas_versao_incrementar();
+            INSERT INTO tabelas_versao (tabela) VALUES ('{table_name}') ON CONFLICT DO NOTHING;
+        END IF;
+    END
+    $$
+    """]
+
+def log_json(level, message, **kwargs):
+    """Structured JSON logging function."""
+    log_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "level": level,
+        "message": message,
+        **kwargs
+    }
+    print(json.dumps(log_entry, ensure_ascii=False, default=str))
+
+def setup_table_versions(dry_run=False):
+    """Create the counter table, trigger function and one trigger per watched table."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        cur = conn.cursor()
+        statements = list(SETUP_STATEMENTS)
+        for table_name in WATCHED_TABLES:
+            statements += trigger_statements(table_name)
+        for sql in statements:
+            if dry_run:
+                print(sql.strip() + ";")
+            else:
+                cur.execute(sql)
+        if dry_run:
+            log_json("INFO", "[DRY RUN] No changes were made to the database")
+        else:
+            conn.commit()
+            log_json("INFO", "Table version counters created", tables=WATCHED_TABLES)
+    except Exception as e:
+        conn.rollback()
+        log_json("ERROR", f"Error setting up table versions: {e}")
+    finally:
+        close_db_connection(conn)
+
+def show_table_versions():
+    """Print the current version of each watched table."""
+    conn = get_db_connection()
+    if not conn:
+        log_json("ERROR", "Failed to connect to database")
+        return
+
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT tabela, versao, alterado_em FROM tabelas_versao ORDER BY tabela")
+        for tabela, versao, alterado_em in cur.fetchall():
+            log_json("INFO", "Table version", table=tabela, version=versao, changed_at=alterado_em)
+    except Exception as e:
+        log_json("ERROR", f"Error reading table versions: {e}")
+    finally:
+        close_db_connection(conn)
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Maintain per-table change counters used for API caching')
+    parser.add_argument('command', choices=['setup', 'show'], help='Action to run')
+    parser.add_argument('--dry-run', action='store_true', help='Print setup SQL without executing it')
+    args = parser.parse_args()
+
+    if args.command == 'setup':
+        setup_table_versions(dry_run=args.dry_run)
+    else:
+        show_table_versions()
+
+if __name__ == "__main__":
+    main()
@@ -1,121 +1,431 @@
-from flask import Flask, request, jsonify
-import psycopg2
+from flask import Flask, Response, request, jsonify
+from datetime import date
 import os
 from flask_cors import CORS
+from db_pool import get_db_connection, release_db_connection, execute_prepared
+from order_queries import (
+    ORDER_FILTERS, ORDERS_DEFAULT_PAGE_SIZE, ORDERS_MAX_PAGE_SIZE, orders_query_shape,
+    orders_count_shape, orders_validator_shape, orders_stats_shape, parse_order_columns,
+    parse_order_filters, parse_dimension_list, encode_cursor, decode_cursor,
+    order_detail_shape, STATS_GROUP_BY, STATS_FACETS
+)
+from order_export import CopyCsvStream, NdjsonStream
+from http_cache import ResponseCache, data_version, make_etag, cached_or_not_modified, store_response
+from fast_json import FastJSONProvider
+from compression import compress_response
+from request_control import SingleFlight, TokenBucketThrottle, coalesced
+from search_routes import register_search_routes
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 # Enable CORS for the frontend origin
 CORS(app, origins="http://localhost:5173")
 
-# Database connection details based on your existing db_utils.py
-DB_HOST = os.environ.get("DB_HOST", "localhost")
-DB_NAME = os.environ.get("DB_NAME", "tiny_os_data")
-DB_USER = os.environ.get("DB_USER", "marcelo") # Default user from db_utils.py
-DB_PASSWORD = os.environ.get("DB_PASSWORD", "") # Default empty password from db_utils.py
-DB_PORT = os.environ.get("DB_PORT", "5432")
-
-def get_db_connection():
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        database=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        port=DB_PORT
-    )
-    return conn
+STATS_MAX_FACET_VALUES = 100
+ORDER_BATCH_MAX_IDS = 100
+
+# Tables the order detail document reads only when they exist
+DETAIL_OPTIONAL_TABLES = [
+    "ordem_servico_marcadores", "marcadores_ordem_servico", "chat_files", "chat_messages", "chat_file_trechos",
+    "chat_mencoes_os"
+]
+_detail_tables = None
+
+def detail_tables(cur):
+    """Which optional detail tables exist (checked once per process)."""
+    global _detail_tables
+    if _detail_tables is None:
+        cur.execute(
+            "SELECT t FROM unnest(%s::text[]) AS t WHERE to_regclass('public.' || t) IS NOT NULL",
+            (DETAIL_OPTIONAL_TABLES,)
+        )
+        _detail_tables = tuple(row[0] for row in cur.fetchall())
+    return _detail_tables
+
+def fetch_order_documents(order_ids):
+    """
+    Detail documents of order_ids, built in one query, behind the same ETag/304
+    validators as the list endpoints. Returns (cached or 304 response, None, None)
+    or (None, {id: document}, (etag, last_modified) or None).
+    """
+    conn = None
+    cur = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        optional_tables = detail_tables(cur)
+        version_tables = ("contatos", "enderecos", "ordens_servico") + optional_tables
+        version = data_version(cur, tuple(sorted(version_tables)))
+        etag = make_etag(request, version[0]) if version else None
+        if version:
+            cached = cached_or_not_modified(request, response_cache, etag, version[1])
+            if cached:
+                return cached, None, None
+
+        statement_name, query = order_detail_shape(optional_tables)
+        execute_prepared(cur, statement_name, query, [list(order_ids)])
+        documents = {order_id: document for order_id, document in cur.fetchall()}
+        return None, documents, (etag, version[1]) if version else None
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            release_db_connection(conn)
+
+# In-process response cache, bounded by total body size (0 disables it)
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRY_BYTES", str(2 * 1024 * 1024)))
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_MAX_ENTRY_BYTES)
+
+# Identical concurrent GETs share one execution; followers wait at most this long
+single_flight = SingleFlight(float(os.environ.get("COALESCE_WAIT_TIMEOUT", "30")))
+
+# Per-client token bucket: sustained requests per second and burst size (rate 0 disables it)
+THROTTLE_RATE = float(os.environ.get("THROTTLE_RATE", "10"))
+THROTTLE_BURST = float(os.environ.get("THROTTLE_BURST", "30"))
+throttle = TokenBucketThrottle(THROTTLE_RATE, THROTTLE_BURST)
+
+@app.before_request
+def throttle_client():
+    if request.path == '/api/metrics':
+        return None
+    allowed, retry_after = throttle.acquire(request.remote_addr)
+    if not allowed:
+        response = jsonify({"error": "Too many requests", "details": "Slow down and retry later"})
+        response.status_code = 429
+        response.headers["Retry-After"] = str(max(1, round(retry_after)))
+        return response
+    return None
+
+@app.after_request
+def compress(response):
+    return compress_response(request, response)
 
 @app.route('/')
 def index():
     return "Web Interface Backend is running."
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Counters of request coalescing, throttling and the response cache."""
+    return jsonify({
+        "coalescing": single_flight.stats(),
+        "throttle": throttle.stats(),
+        "response_cache": response_cache.stats(),
+    })
+
 @app.route('/api/orders', methods=['GET'])
+@coalesced(single_flight)
 def get_orders():
     conn = None
     cur = None
     try:
+        # Get requested columns from query parameters
+        try:
+            columns = parse_order_columns(request.args)
+        except ValueError as e:
+            return jsonify({"error": "Invalid columns", "details": str(e)}), 400
+
+        try:
+            limit = min(max(int(request.args.get('limit', ORDERS_DEFAULT_PAGE_SIZE)), 1), ORDERS_MAX_PAGE_SIZE)
+            cursor_token = request.args.get('cursor')
+            cursor = decode_cursor(cursor_token) if cursor_token else None
+        except ValueError as e:
+            return jsonify({"error": "Invalid pagination", "details": str(e)}), 400
+        layout = request.args.get('layout', 'objects')
+        if layout not in ('objects', 'rows'):
+            return jsonify({"error": "Invalid layout", "details": "Use 'objects' or 'rows'"}), 400
+
+        filters, filter_params = parse_order_filters(request.args)
+        # The keyset columns are always read, even when not requested
+        query_columns = columns + tuple(col for col in ("data_emissao", "id") if col not in columns)
+
         conn = get_db_connection()
         cur = conn.cursor()
 
-        # Get requested columns from query parameters
-        columns_param = request.args.get('columns')
-        if columns_param:
-            # Basic sanitization: split by comma and strip whitespace
-            # In a real application, you'd want more robust validation
-            columns = [col.strip() for col in columns_param.split(',')]
-            # Ensure only valid column names are used to prevent SQL injection
-            # For now, we'll use the provided columns directly, but this is a risk
-            # A better approach would be to have a predefined list of allowed columns
-            select_columns = ", ".join(columns)
+        # Validator: table change counter, or latest data_extracao + row count over the filter
+        version = data_version(cur, ("ordens_servico",))
+        if version is None:
+            statement_name, query = orders_validator_shape(filters)
+            execute_prepared(cur, statement_name, query, filter_params)
+            max_extracao, total = cur.fetchone()
+            version = (f"{max_extracao}:{total}", max_extracao)
+        etag = make_etag(request, version[0])
+        cached = cached_or_not_modified(request, response_cache, etag, version[1])
+        if cached:
+            return cached
+
+        # One row beyond the page tells whether there is a next page
+        rows = []
+        if cursor is None or cursor[0] is not None:
+            cursor_params = list(cursor) if cursor else []
+            statement_name, query = orders_query_shape(query_columns, filters, False, cursor is not None)
+            execute_prepared(cur, statement_name, query, filter_params + cursor_params + [limit + 1])
+            rows = cur.fetchall()
+        # Undated orders cannot match a date range, so they are only paged without one
+        if len(rows) <= limit and "start_date" not in filters and "end_date" not in filters:
+            after_id = cursor[1] if cursor and cursor[0] is None else None
+            cursor_params = [after_id] if after_id is not None else []
+            statement_name, query = orders_query_shape(query_columns, filters, True, after_id is not None)
+            execute_prepared(cur, statement_name, query, filter_params + cursor_params + [limit + 1 - len(rows)])
+            rows += cur.fetchall()
+
+        page = rows[:limit]
+        next_cursor = None
+        if len(rows) > limit:
+            last = page[-1]
+            next_cursor = encode_cursor(last[query_columns.index("data_emissao")], last[query_columns.index("id")])
+
+        # Keyset columns that were not requested sit at the end of each row
+        if len(query_columns) > len(columns):
+            page = [row[:len(columns)] for row in page]
+        if layout == "rows":
+            # Rows straight from the cursor, under a single column header
+            response = {"columns": list(columns), "rows": page}
+        else:
+            response = {"results": [dict(zip(columns, row)) for row in page]}
+        response.update({"limit": limit, "next_cursor": next_cursor})
+
+        # Planner estimate instead of COUNT(*), so the cost does not grow with the range
+        if request.args.get('count') == 'estimate':
+            statement_name, query = orders_count_shape(filters)
+            execute_prepared(cur, statement_name, query, filter_params, explain=True)
+            response["estimated_total"] = int(cur.fetchone()[0][0]["Plan"]["Plan Rows"])
+
+        return store_response(jsonify(response), response_cache, etag, version[1])
+
+    except Exception as e:
+        print(f"Database error: {e}")
+        return jsonify({"error": "Could not fetch data", "details": str(e)}), 500
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            release_db_connection(conn)
+
+@app.route('/api/orders/stats', methods=['GET'])
+@coalesced(single_flight)
+def get_order_stats():
+    """Totals, grouped sums/counts and facet counts for the /api/orders filters, in one SQL scan."""
+    conn = None
+    cur = None
+    try:
+        try:
+            group_by = parse_dimension_list(request.args, 'group_by', STATS_GROUP_BY, [])
+            facets = parse_dimension_list(request.args, 'facets', STATS_FACETS, STATS_FACETS)
+        except ValueError as e:
+            return jsonify({"error": "Invalid dimensions", "details": str(e)}), 400
+        filters, filter_params = parse_order_filters(request.args)
+        statement_name, query, dimensions, masks = orders_stats_shape(filters, group_by, facets)
+
+        conn = get_db_connection()
+        cur = conn.cursor()
+        version = data_version(cur, ("ordens_servico",))
+        if version:
+            etag = make_etag(request, version[0])
+            cached = cached_or_not_modified(request, response_cache, etag, version[1])
+            if cached:
+                return cached
+
+        execute_prepared(cur, statement_name, query, filter_params)
+        column_names = [desc[0] for desc in cur.description]
+        metric_names = column_names[1 + len(dimensions):]
+        rows_by_set = {}
+        for row in cur.fetchall():
+            rows_by_set.setdefault(row[0], []).append(dict(zip(column_names[1:], row[1:])))
+
+        def metrics(record):
+            return {name: record[name] for name in metric_names}
+
+        totals = rows_by_set.get(masks["totals"], [{}])[0]
+        result = {"totals": metrics(totals) if totals else None}
+        if group_by:
+            groups = [{**{name: record[name] for name in group_by}, **metrics(record)}
+                      for record in rows_by_set.get(masks["groups"], [])]
+            groups.sort(key=lambda item: tuple("" if item[name] is None else str(item[name]) for name in group_by))
+            result["groups"] = groups
+        result["facets"] = {}
+        for name in facets:
+            values = sorted(rows_by_set.get(masks[f"facet:{name}"], []), key=lambda record: -record["qtd_ordens"])
+            result["facets"][name] = [{"value": record[name], "count": record["qtd_ordens"]}
+                                      for record in values[:STATS_MAX_FACET_VALUES]]
+
+        return store_response(jsonify(result), response_cache, etag, version[1]) if version else jsonify(result)
+
+    except Exception as e:
+        print(f"Database error: {e}")
+        return jsonify({"error": "Could not compute order stats", "details": str(e)}), 500
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            release_db_connection(conn)
+
+@app.route('/api/orders/<int:order_id>', methods=['GET'])
+@coalesced(single_flight)
+def get_order_detail(order_id):
+    """Full document of one order: contact, address, markers and linked chats."""
+    try:
+        cached, documents, validators = fetch_order_documents([order_id])
+        if cached:
+            return cached
+        if order_id not in documents:
+            return jsonify({"error": "Order not found", "details": f"No order with id {order_id}"}), 404
+        response = jsonify(documents[order_id])
+        return store_response(response, response_cache, *validators) if validators else response
+    except Exception as e:
+        print(f"Database error: {e}")
+        return jsonify({"error": "Could not fetch order", "details": str(e)}), 500
+
+@app.route('/api/orders/batch', methods=['GET'])
+@coalesced(single_flight)
+def get_order_batch():
+    """Full documents of up to ORDER_BATCH_MAX_IDS orders (ids=1,2,3) in one query."""
+    try:
+        try:
+            order_ids = list(dict.fromkeys(int(item) for item in request.args.get('ids', '').split(',') if item.strip()))
+        except ValueError:
+            return jsonify({"error": "Invalid ids", "details": "ids must be comma-separated integers"}), 400
+        if not order_ids or len(order_ids) > ORDER_BATCH_MAX_IDS:
+            return jsonify({"error": "Invalid ids", "details": f"Provide between 1 and {ORDER_BATCH_MAX_IDS} ids"}), 400
+
+        cached, documents, validators = fetch_order_documents(order_ids)
+        if cached:
+            return cached
+        response = jsonify({
+            "results": [documents[order_id] for order_id in order_ids if order_id in documents],
+            "missing": [order_id for order_id in order_ids if order_id not in documents],
+        })
+        return store_response(response, response_cache, *validators) if validators else response
+    except Exception as e:
+        print(f"Database error: {e}")
+        return jsonify({"error": "Could not fetch orders", "details": str(e)}), 500
+
+@app.route('/api/orders/export', methods=['GET'])
+def export_orders():
+    """
+    Stream every order matching the /api/orders filters as CSV (COPY TO STDOUT)
+    or NDJSON (named cursor). Rows are unordered so the scan can start at once.
+    """
+    conn = None
+    try:
+        export_format = request.args.get('format', 'csv')
+        if export_format not in ('csv', 'ndjson'):
+            return jsonify({"error": "Invalid format", "details": "Use 'csv' or 'ndjson'"}), 400
+        try:
+            columns = parse_order_columns(request.args, default_fields="detail")
+        except ValueError as e:
+            return jsonify({"error": "Invalid columns", "details": str(e)}), 400
+
+        filters, filter_params = parse_order_filters(request.args)
+        query = f"SELECT {', '.join(columns)} FROM ordens_servico"
+        if filters:
+            query += " WHERE " + " AND ".join(ORDER_FILTERS[name].format("%s") for name in filters)
+
+        conn = get_db_connection()
+        filename = f"ordens_servico_{date.today():%Y%m%d}.{export_format}"
+        if export_format == 'csv':
+            # COPY takes no bind parameters, so the values are inlined by psycopg2
+            cur = conn.cursor()
+            copy_sql = f"COPY ({cur.mogrify(query, filter_params).decode()}) TO STDOUT WITH (FORMAT csv, HEADER true)"
+            cur.close()
+            body = CopyCsvStream(conn, copy_sql, release_db_connection)
+            mimetype = "text/csv"
         else:
-            # Default columns if none are specified
-            select_columns = "*" # Select all columns by default
+            body = NdjsonStream(conn, f"SELECT row_to_json(t)::text FROM ({query}) t", filter_params, release_db_connection)
+            mimetype = "application/x-ndjson"
+
+        # From here on the stream owns the connection and releases it when the response closes
+        conn = None
+        return Response(body, mimetype=mimetype, headers={
+            "Content-Disposition": f"attachment; filename={filename}",
+            "X-Accel-Buffering": "no",
+        })
+
+    except Exception as e:
+        print(f"Database error: {e}")
+        return jsonify({"error": "Could not export data", "details": str(e)}), 500
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+# /api/orders/search and /api/chats/search (search_routes.py)
+register_search_routes(app, response_cache, single_flight)
 
-        # Build the base query
-        query = f"SELECT {select_columns} FROM ordens_servico"
+# Dimensions of kpi_ordens_mensal that can be requested in group_by
+KPI_DIMENSIONS = ["situacao", "tecnico", "origem_cliente"]
+
+@app.route('/api/kpis/monthly', methods=['GET'])
+@coalesced(single_flight)
+def get_monthly_kpis():
+    """Monthly totals read from the precomputed kpi_ordens_mensal rollup (see src/utilities/kpi_rollup.py)."""
+    conn = None
+    cur = None
+    try:
+        group_by_param = request.args.get('group_by', '')
+        group_by = [col.strip() for col in group_by_param.split(',') if col.strip()]
+        invalid = [col for col in group_by if col not in KPI_DIMENSIONS]
+        if invalid:
+            return jsonify({"error": "Invalid group_by", "details": f"Allowed: {', '.join(KPI_DIMENSIONS)}"}), 400
+
+        select_dims = ", ".join(["to_char(mes, 'YYYY-MM') AS mes"] + group_by)
+        query = f"""
+            SELECT {select_dims},
+                   SUM(qtd_ordens) AS qtd_ordens,
+                   SUM(total_ordem_servico) AS total_ordem_servico,
+                   SUM(total_servicos) AS total_servicos,
+                   SUM(total_pecas) AS total_pecas,
+                   SUM(vlr_comissao) AS vlr_comissao,
+                   SUM(qtd_concluidas) AS qtd_concluidas,
+                   ROUND(SUM(dias_conclusao_total)::numeric / NULLIF(SUM(qtd_concluidas), 0), 1) AS media_dias_conclusao
+            FROM kpi_ordens_mensal
+        """
         where_clauses = []
         query_params = []
 
-        # Add filtering based on query parameters
-        # Date filtering
-        start_date = request.args.get('start_date')
-        end_date = request.args.get('end_date')
-        if start_date and end_date:
-            where_clauses.append("data_emissao BETWEEN %s AND %s")
-            query_params.extend([start_date, end_date])
-        elif start_date:
-            where_clauses.append("data_emissao >= %s")
-            query_params.append(start_date)
-        elif end_date:
-            where_clauses.append("data_emissao <= %s")
-            query_params.append(end_date)
-
-        # Status filtering
-        status = request.args.get('status')
-        if status:
-            where_clauses.append("situacao = %s")
-            query_params.append(status)
-
-        # Dynamic field filtering (example for a few fields)
-        # This part needs to be expanded based on the fields chosen for dynamic filtering
-        # Example: Filter by tecnico
-        tecnico = request.args.get('tecnico')
-        if tecnico:
-             where_clauses.append("tecnico ILIKE %s") # Case-insensitive search
-             query_params.append(f"%{tecnico}%")
-
-        # Add other dynamic filters here based on user selection...
-        # Example: Filter by numero_ordem_servico
-        numero_ordem_servico = request.args.get('numero_ordem_servico')
-        if numero_ordem_servico:
-             where_clauses.append("numero_ordem_servico = %s")
-             query_params.append(numero_ordem_servico)
-
-        # Combine where clauses
+        # Month range filtering (YYYY-MM)
+        start_month = request.args.get('start_month')
+        end_month = request.args.get('end_month')
+        if start_month:
+            where_clauses.append("mes >= to_date(%s, 'YYYY-MM')")
+            query_params.append(start_month)
+        if end_month:
+            where_clauses.append("mes <= to_date(%s, 'YYYY-MM')")
+            query_params.append(end_month)
+
+        # Dimension filtering
+        for dimension in KPI_DIMENSIONS:
+            value = request.args.get(dimension)
+            if value is not None:
+                where_clauses.append(f"{dimension} = %s")
+                query_params.append(value)
+
         if where_clauses:
             query += " WHERE " + " AND ".join(where_clauses)
+        query += " GROUP BY " + ", ".join(["mes"] + group_by) + " ORDER BY mes"
 
-        # Execute the query
-        cur.execute(query, query_params)
-        rows = cur.fetchall()
+        conn = get_db_connection()
+        cur = conn.cursor()
+        version = data_version(cur, ("kpi_ordens_mensal",))
+        if version:
+            etag = make_etag(request, version[0])
+            cached = cached_or_not_modified(request, response_cache, etag, version[1])
+            if cached:
+                return cached
 
-        # Get column names from cursor description
+        cur.execute(query, query_params)
         column_names = [desc[0] for desc in cur.description]
-
-        # Format results as a list of dictionaries
-        result = []
-        for row in rows:
-            result.append(dict(zip(column_names, row)))
-
-        return jsonify(result)
+        response = jsonify([dict(zip(column_names, row)) for row in cur.fetchall()])
+        return store_response(response, response_cache, etag, version[1]) if version else response
 
     except Exception as e:
         print(f"Database error: {e}")
-        return jsonify({"error": "Could not fetch data", "details": str(e)}), 500
+        return jsonify({"error": "Could not fetch KPIs", "details": str(e)}), 500
     finally:
         if cur:
             cur.close()
         if conn:
-            conn.close()
+            release_db_connection(conn)
 
 if __name__ == '__main__':
     # In a production environment, use a production-ready WSGI server like Gunicorn or uWSGI
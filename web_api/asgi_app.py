@@ -0,0 +1,254 @@
+"""
+Async (ASGI) variant of the order read endpoints, on Starlette and asyncpg.
+
+It serves the same /api/orders, /api/orders/<id> and /api/orders/export as
+app.py, with the same parameters, filters, cursors and response shapes. Query
+shapes and parameter parsing come from order_queries.py. Each request awaits its
+queries on the asyncpg pool (async_db_pool.py) instead of holding a worker thread.
+One process can then keep DB_POOL_MAX slow queries and any number of streaming
+exports in flight.
+
+There are no ETag validators or response cache here: this variant is for the
+slow, uncached reads. Run it next to the Flask app:
+
+    cd web_api
+    uvicorn asgi_app:app --port 5001
+"""
+
+import asyncio
+from contextlib import asynccontextmanager, suppress
+from datetime import date
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from async_db_pool import open_pool, close_pool, acquire_connection, take_connection, give_back_connection
+from order_queries import (
+    ORDERS_DEFAULT_PAGE_SIZE, ORDERS_MAX_PAGE_SIZE, orders_query_shape, orders_count_shape,
+    order_detail_shape, filter_clauses, parse_order_columns, parse_order_filters,
+    typed_filter_params, encode_cursor, decode_cursor
+)
+from order_export import EXPORT_QUEUE_CHUNKS, EXPORT_FETCH_SIZE
+from fast_json import dumps_bytes
+
+# Tables the order detail document reads only when they exist (same list as app.py)
+DETAIL_OPTIONAL_TABLES = [
+    "ordem_servico_marcadores", "marcadores_ordem_servico", "chat_files", "chat_messages", "chat_file_trechos",
+    "chat_mencoes_os"
+]
+_detail_tables = None
+
+class JSONResponse(Response):
+    """JSON response serialized by fast_json.dumps_bytes (orjson when installed)."""
+    media_type = "application/json"
+
+    def render(self, content):
+        return dumps_bytes(content)
+
+def error_response(error, details, status_code):
+    return JSONResponse({"error": error, "details": details}, status_code=status_code)
+
+async def detail_tables(conn):
+    """Which optional detail tables exist (checked once per process)."""
+    global _detail_tables
+    if _detail_tables is None:
+        rows = await conn.fetch(
+            "SELECT t FROM unnest($1::text[]) AS t WHERE to_regclass('public.' || t) IS NOT NULL",
+            DETAIL_OPTIONAL_TABLES
+        )
+        _detail_tables = tuple(row[0] for row in rows)
+    return _detail_tables
+
+async def index(request):
+    return Response("Web Interface Backend (ASGI) is running.", media_type="text/plain")
+
+async def get_orders(request):
+    """Keyset-paginated orders; same parameters and response as GET /api/orders of app.py."""
+    args = request.query_params
+    try:
+        columns = parse_order_columns(args)
+    except ValueError as e:
+        return error_response("Invalid columns", str(e), 400)
+    try:
+        limit = min(max(int(args.get('limit', ORDERS_DEFAULT_PAGE_SIZE)), 1), ORDERS_MAX_PAGE_SIZE)
+        cursor_token = args.get('cursor')
+        cursor = decode_cursor(cursor_token) if cursor_token else None
+    except ValueError as e:
+        return error_response("Invalid pagination", str(e), 400)
+    layout = args.get('layout', 'objects')
+    if layout not in ('objects', 'rows'):
+        return error_response("Invalid layout", "Use 'objects' or 'rows'", 400)
+    filters, filter_params = parse_order_filters(args)
+    try:
+        filter_params = typed_filter_params(filters, filter_params)
+    except ValueError as e:
+        return error_response("Invalid filter", str(e), 400)
+    # The keyset columns are always read, even when not requested
+    query_columns = columns + tuple(col for col in ("data_emissao", "id") if col not in columns)
+
+    try:
+        async with acquire_connection() as conn:
+            # One row beyond the page tells whether there is a next page
+            rows = []
+            if cursor is None or cursor[0] is not None:
+                cursor_params = list(cursor) if cursor else []
+                _, query = orders_query_shape(query_columns, filters, False, cursor is not None)
+                rows = await conn.fetch(query, *filter_params, *cursor_params, limit + 1)
+            # Undated orders cannot match a date range, so they are only paged without one
+            if len(rows) <= limit and "start_date" not in filters and "end_date" not in filters:
+                after_id = cursor[1] if cursor and cursor[0] is None else None
+                cursor_params = [after_id] if after_id is not None else []
+                _, query = orders_query_shape(query_columns, filters, True, after_id is not None)
+                rows += await conn.fetch(query, *filter_params, *cursor_params, limit + 1 - len(rows))
+
+            estimated_total = None
+            if args.get('count') == 'estimate':
+                _, query = orders_count_shape(filters)
+                plan = await conn.fetchval("EXPLAIN (FORMAT JSON) " + query, *filter_params)
+                estimated_total = int(plan[0]["Plan"]["Plan Rows"])
+    except Exception as e:
+        print(f"Database error: {e}")
+        return error_response("Could not fetch data", str(e), 500)
+
+    page = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        last = page[-1]
+        next_cursor = encode_cursor(last["data_emissao"], last["id"])
+
+    # Keyset columns that were not requested sit at the end of each row
+    page = [tuple(row)[:len(columns)] for row in page]
+    if layout == "rows":
+        response = {"columns": list(columns), "rows": page}
+    else:
+        response = {"results": [dict(zip(columns, row)) for row in page]}
+    response.update({"limit": limit, "next_cursor": next_cursor})
+    if estimated_total is not None:
+        response["estimated_total"] = estimated_total
+    return JSONResponse(response)
+
+async def get_order_detail(request):
+    """Full document of one order: contact, address, markers and linked chats."""
+    order_id = request.path_params["order_id"]
+    try:
+        async with acquire_connection() as conn:
+            _, query = order_detail_shape(await detail_tables(conn))
+            row = await conn.fetchrow(query, [order_id])
+    except Exception as e:
+        print(f"Database error: {e}")
+        return error_response("Could not fetch order", str(e), 500)
+    if row is None:
+        return error_response("Order not found", f"No order with id {order_id}", 404)
+    return JSONResponse(row["documento"])
+
+async def copy_csv_chunks(conn, query, params):
+    """
+    CSV chunks of COPY (query) TO STDOUT. The COPY runs in its own task and feeds a
+    bounded queue, so a slow client pauses it instead of buffering the result.
+    """
+    chunks = asyncio.Queue(maxsize=EXPORT_QUEUE_CHUNKS)
+    failure = []
+
+    async def run_copy():
+        try:
+            await conn.copy_from_query(query, *params, output=chunks.put, format="csv", header=True)
+        except Exception as e:
+            failure.append(e)
+        await chunks.put(None)
+
+    task = asyncio.ensure_future(run_copy())
+    finished = False
+    try:
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+        finished = not failure
+        if failure:
+            print(f"Export error: {failure[0]}")
+    finally:
+        if not task.done():
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+        # An interrupted COPY leaves the session in an unknown state
+        await give_back_connection(conn, discard=not finished)
+
+async def cursor_ndjson_chunks(conn, query, params):
+    """NDJSON lines of (query) read from a server-side cursor in EXPORT_FETCH_SIZE batches."""
+    try:
+        # Cursors only live inside a transaction
+        async with conn.transaction():
+            cursor = await conn.cursor(f"SELECT row_to_json(t)::text FROM ({query}) t", *params)
+            while True:
+                rows = await cursor.fetch(EXPORT_FETCH_SIZE)
+                if not rows:
+                    break
+                yield "".join(row[0] + "\n" for row in rows).encode()
+    finally:
+        await give_back_connection(conn)
+
+async def export_orders(request):
+    """
+    Stream every order matching the /api/orders filters as CSV (COPY TO STDOUT)
+    or NDJSON (server-side cursor). Rows are unordered so the scan can start at once.
+    """
+    args = request.query_params
+    export_format = args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        return error_response("Invalid format", "Use 'csv' or 'ndjson'", 400)
+    try:
+        columns = parse_order_columns(args, default_fields="detail")
+    except ValueError as e:
+        return error_response("Invalid columns", str(e), 400)
+    filters, filter_params = parse_order_filters(args)
+    try:
+        filter_params = typed_filter_params(filters, filter_params)
+    except ValueError as e:
+        return error_response("Invalid filter", str(e), 400)
+    query = f"SELECT {', '.join(columns)} FROM ordens_servico"
+    if filters:
+        query += " WHERE " + " AND ".join(filter_clauses(filters))
+
+    try:
+        conn = await take_connection()
+    except Exception as e:
+        print(f"Database error: {e}")
+        return error_response("Could not export data", str(e), 500)
+
+    # From here on the stream owns the connection and gives it back when it ends or is cancelled
+    if export_format == 'csv':
+        body = copy_csv_chunks(conn, query, filter_params)
+        media_type = "text/csv"
+    else:
+        body = cursor_ndjson_chunks(conn, query, filter_params)
+        media_type = "application/x-ndjson"
+    filename = f"ordens_servico_{date.today():%Y%m%d}.{export_format}"
+    return StreamingResponse(body, media_type=media_type, headers={
+        "Content-Disposition": f"attachment; filename={filename}",
+        "X-Accel-Buffering": "no",
+    })
+
+@asynccontextmanager
+async def lifespan(app):
+    await open_pool()
+    yield
+    await close_pool()
+
+app = Starlette(
+    routes=[
+        Route('/', index),
+        Route('/api/orders', get_orders, methods=['GET']),
+        Route('/api/orders/export', export_orders, methods=['GET']),
+        Route('/api/orders/{order_id:int}', get_order_detail, methods=['GET']),
+    ],
+    middleware=[
+        # Enable CORS for the frontend origin
+        Middleware(CORSMiddleware, allow_origins=["http://localhost:5173"]),
+        Middleware(GZipMiddleware, minimum_size=1024),
+    ],
+    lifespan=lifespan,
+)
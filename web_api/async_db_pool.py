@@ -0,0 +1,72 @@
+"""
+asyncpg connection pool of the ASGI variant of the API (asgi_app.py).
+
+It reads the same DB_* and DB_POOL_* settings as db_pool.py. asyncpg prepares every
+query it runs and keeps a statement cache per connection, so the $n query shapes
+of order_queries.py are parsed once per connection, like execute_prepared() does
+for the Flask app. Waiting for a connection suspends the request instead of
+holding a thread, so one process can keep many slow queries in flight.
+"""
+
+import os
+import json
+import asyncpg
+
+# Same variables as db_pool.py
+DB_HOST = os.environ.get("DB_HOST", "localhost")
+DB_NAME = os.environ.get("DB_NAME", "tiny_os_data")
+DB_USER = os.environ.get("DB_USER", "marcelo")
+DB_PASSWORD = os.environ.get("DB_PASSWORD", "")
+DB_PORT = os.environ.get("DB_PORT", "5432")
+
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "5")) # Seconds to wait for a free connection
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", "15000"))
+# Prepared statements kept per connection (asyncpg's default is 100)
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", "256"))
+
+_pool = None
+
+async def init_connection(conn):
+    """Decode json/jsonb into Python objects, as psycopg2 does."""
+    for type_name in ("json", "jsonb"):
+        await conn.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
+async def open_pool():
+    """Create the process-wide pool; called once at application startup."""
+    global _pool
+    _pool = await asyncpg.create_pool(
+        host=DB_HOST,
+        port=int(DB_PORT),
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD or None,
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        server_settings={"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)},
+        init=init_connection
+    )
+    return _pool
+
+async def close_pool():
+    """Close every pooled connection; called at application shutdown."""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+def acquire_connection():
+    """`async with acquire_connection() as conn:` borrows a connection for one request."""
+    return _pool.acquire(timeout=DB_POOL_TIMEOUT)
+
+async def take_connection():
+    """Borrow a connection that outlives the handler (streams); give it back with give_back_connection()."""
+    return await _pool.acquire(timeout=DB_POOL_TIMEOUT)
+
+async def give_back_connection(conn, discard=False):
+    """Return a connection taken with take_connection(), closing it first if its session state is unknown."""
+    if discard:
+        conn.terminate()
+    await _pool.release(conn)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Compare the Flask (app.py) and ASGI (asgi_app.py) APIs under concurrent load.
+
+Every request carries a unique `_bench` parameter, so the Flask app can neither
+coalesce it nor answer from its response cache. Start the Flask app with
+THROTTLE_RATE=0, otherwise most requests end in 429. Only the standard library is used.
+
+Usage:
+    python benchmark_api.py [--flask-url http://localhost:5000] [--asgi-url http://localhost:5001]
+                            [--path "/api/orders?fields=list&limit=100"] [--concurrency 1,8,32,64]
+                            [--requests 400]
+"""
+
+import json
+import time
+import argparse
+import statistics
+import urllib.error
+import urllib.request
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+def log_json(level, message, **kwargs):
+    """Structured JSON logging function."""
+    log_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "level": level,
+        "message": message,
+        **kwargs
+    }
+    print(json.dumps(log_entry, ensure_ascii=False, default=str))
+
+def timed_get(url):
+    """(status code, seconds, body bytes) of one GET, reading the whole body."""
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=120) as response:
+            size = len(response.read())
+            status = response.status
+    except urllib.error.HTTPError as e:
+        size, status = 0, e.code
+    except Exception:
+        size, status = 0, None
+    return status, time.perf_counter() - started, size
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+def run_level(base_url, path, concurrency, total_requests):
+    """Send total_requests GETs with `concurrency` in flight; latency and throughput summary."""
+    separator = "&" if "?" in path else "?"
+    urls = [f"{base_url}{path}{separator}_bench={time.time_ns()}-{n}" for n in range(total_requests)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed_get, urls))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(seconds for status, seconds, _ in results if status == 200)
+    statuses = {}
+    for status, _, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "ok": len(latencies),
+        "statuses": statuses,
+        "requests_per_second": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        "mean_ms": round(statistics.mean(latencies) * 1000, 1) if latencies else None,
+        "bytes": sum(size for _, _, size in results),
+    }
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Benchmark the Flask and ASGI order APIs under concurrency')
+    parser.add_argument('--flask-url', default='http://localhost:5000', help='Base URL of app.py (empty to skip)')
+    parser.add_argument('--asgi-url', default='http://localhost:5001', help='Base URL of asgi_app.py (empty to skip)')
+    parser.add_argument('--path', default='/api/orders?fields=list&limit=100', help='Request path and query string')
+    parser.add_argument('--concurrency', default='1,8,32,64', help='Comma-separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=400, help='Requests per concurrency level')
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.concurrency.split(',') if level.strip()]
+    targets = [("flask", args.flask_url), ("asgi", args.asgi_url)]
+    for name, base_url in targets:
+        if not base_url:
+            continue
+        # Warm up the pool and the prepared statements before measuring
+        run_level(base_url.rstrip('/'), args.path, min(levels), min(levels))
+        for concurrency in levels:
+            summary = run_level(base_url.rstrip('/'), args.path, concurrency, args.requests)
+            log_json("INFO", "Benchmark result", server=name, path=args.path, **summary)
+            if summary["statuses"].get("429"):
+                log_json("WARNING", "Requests were throttled; start the Flask app with THROTTLE_RATE=0", server=name)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Negotiated response compression for the web API.
+
+compress_response() runs after every request and encodes JSON bodies with brotli
+(when the brotli package is installed and the client accepts br) or gzip. Small
+bodies, streamed exports and already-encoded responses are left untouched. The
+ETag of a compressed response is marked weak, since the bytes differ per encoding
+while the content is the same.
+"""
+
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 5      # Most of the size win at a fraction of level 9's CPU
+BROTLI_QUALITY = 5
+
+def negotiate_encoding(request):
+    """Best encoding accepted by the client among the available ones, or None."""
+    available = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return request.accept_encodings.best_match(available)
+
+def compress_response(request, response):
+    """Compress the response body in place if worthwhile and accepted."""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    encoding = negotiate_encoding(request)
+    if encoding == "br":
+        body = brotli.compress(body, quality=BROTLI_QUALITY)
+    elif encoding == "gzip":
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+    else:
+        return response
+
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    etag, _ = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
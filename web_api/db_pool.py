@@ -0,0 +1,92 @@
+"""
+Process-wide PostgreSQL connection pool of the web API.
+
+Connections are borrowed per request with get_db_connection() and returned with
+release_db_connection(). Each one carries the statement_timeout setting and the
+set of statements already PREPAREd on its server session, so execute_prepared()
+prepares a query shape only once per connection.
+"""
+
+import os
+import threading
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+
+# Database connection details based on your existing db_utils.py
+DB_HOST = os.environ.get("DB_HOST", "localhost")
+DB_NAME = os.environ.get("DB_NAME", "tiny_os_data")
+DB_USER = os.environ.get("DB_USER", "marcelo") # Default user from db_utils.py
+DB_PASSWORD = os.environ.get("DB_PASSWORD", "") # Default empty password from db_utils.py
+DB_PORT = os.environ.get("DB_PORT", "5432")
+
+# Connection pool settings
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "5")) # Seconds to wait for a free connection
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", "15000"))
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Connection that remembers which statements were prepared on its server session."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+
+_pool = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises when exhausted; the semaphore makes requests wait instead
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+def get_pool():
+    """Create the process-wide connection pool on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX,
+                    host=DB_HOST,
+                    database=DB_NAME,
+                    user=DB_USER,
+                    password=DB_PASSWORD,
+                    port=DB_PORT,
+                    options=f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}",
+                    connection_factory=PooledConnection
+                )
+    return _pool
+
+def get_db_connection():
+    """Borrow a connection from the pool; give it back with release_db_connection()."""
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise PoolError("Timed out waiting for a database connection")
+    try:
+        conn = get_pool().getconn()
+        # The API only reads, so skip the BEGIN/ROLLBACK round trips
+        conn.autocommit = True
+        return conn
+    except Exception:
+        _pool_slots.release()
+        raise
+
+def release_db_connection(conn, discard=False):
+    """Return a connection to the pool, discarding it if asked to or if the server side is gone."""
+    try:
+        get_pool().putconn(conn, close=discard or bool(conn.closed))
+    finally:
+        _pool_slots.release()
+
+def execute_prepared(cur, statement_name, query, params, explain=False):
+    """
+    EXECUTE a server-side prepared statement, preparing it once per connection.
+    With explain=True the JSON plan is returned instead of the rows.
+    """
+    conn = cur.connection
+    if statement_name not in conn.prepared_statements:
+        cur.execute(f"PREPARE {statement_name} AS {query}")
+        conn.prepared_statements.add(statement_name)
+    command = f"EXECUTE {statement_name}"
+    if params:
+        command += f" ({', '.join(['%s'] * len(params))})"
+    if explain:
+        command = "EXPLAIN (FORMAT JSON) " + command
+    cur.execute(command, params or None)
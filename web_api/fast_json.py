@@ -0,0 +1,48 @@
+"""
+Fast JSON serialization for the web API.
+
+FastJSONProvider replaces Flask's default provider, so every jsonify() call uses
+orjson when it is installed (pip install orjson) and a compact stdlib encoder
+otherwise. Decimal values are emitted as JSON numbers and date/datetime values
+as ISO 8601 strings, instead of Flask's strings and RFC 822 dates.
+"""
+
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _default(value):
+    """Types the encoders do not handle natively."""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, memoryview):
+        return value.tobytes().decode()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps_bytes(obj):
+    """Serialize obj to UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by dumps_bytes()."""
+    def dumps(self, obj, **kwargs):
+        return dumps_bytes(obj).decode()
+
+    def response(self, *args, **kwargs):
+        if args and kwargs:
+            raise TypeError("jsonify() behavior undefined when passed both args and kwargs")
+        if len(args) == 1:
+            obj = args[0]
+        else:
+            obj = list(args) if args else kwargs or None
+        return self._app.response_class(dumps_bytes(obj), mimetype=self.mimetype)
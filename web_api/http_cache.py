@@ -0,0 +1,118 @@
+"""
+Conditional GET support for the read endpoints.
+
+Each response gets an ETag built from the request (path and query string) and a
+data version token: the tabelas_versao counter of the tables it reads (see
+src/utilities/table_versions.py) or, for /api/orders without counters, the max
+data_extracao and row count over the filter. Matching If-None-Match or
+If-Modified-Since requests are answered with 304, and fresh responses are kept in
+a bounded in-process LRU cache keyed by that ETag, so a repeated request skips
+the query entirely until the data version moves.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import timezone
+from flask import Response
+
+_versions_installed = False
+
+class ResponseCache:
+    """Thread-safe LRU of response bodies bounded by total size in bytes."""
+    def __init__(self, max_bytes, max_entry_bytes):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body, mimetype):
+        if self.max_bytes <= 0 or len(body) > self.max_entry_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (body, mimetype)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (old_body, _) = self.entries.popitem(last=False)
+                self.size -= len(old_body)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes}
+
+def utc(moment):
+    """Aware UTC datetime for HTTP dates; naive values are taken as UTC."""
+    if moment.tzinfo is None:
+        return moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc)
+
+def data_version(cur, tables):
+    """
+    (version token, last change time in UTC) of the given tables from tabelas_versao,
+    or None while the counters are not installed for all of them.
+    """
+    global _versions_installed
+    if not _versions_installed:
+        cur.execute("SELECT to_regclass('public.tabelas_versao') IS NOT NULL")
+        _versions_installed = cur.fetchone()[0]
+        if not _versions_installed:
+            return None
+    cur.execute(
+        "SELECT tabela, versao, alterado_em FROM tabelas_versao WHERE tabela = ANY(%s) ORDER BY tabela",
+        (list(tables),)
+    )
+    rows = cur.fetchall()
+    if len(rows) != len(tables):
+        return None
+    token = ",".join(f"{tabela}:{versao}" for tabela, versao, _ in rows)
+    return token, utc(max(alterado_em for _, _, alterado_em in rows))
+
+def make_etag(request, version_token):
+    """Strong ETag for this request URL at this data version."""
+    digest = hashlib.sha1(f"{request.full_path}|{version_token}".encode()).hexdigest()
+    return digest[:32]
+
+def apply_validators(response, etag, last_modified):
+    """Attach ETag/Last-Modified and ask clients to revalidate on every use."""
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = utc(last_modified)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+def cached_or_not_modified(request, cache, etag, last_modified):
+    """A 304 or cached response for this request, or None if it must be built."""
+    if request.if_none_match:
+        # Weak comparison: compression marks the ETag weak (see compression.py)
+        matches = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified is not None:
+        matches = utc(last_modified).replace(microsecond=0) <= utc(request.if_modified_since)
+    else:
+        matches = False
+    if matches:
+        return apply_validators(Response(status=304), etag, last_modified)
+
+    entry = cache.get(etag)
+    if entry is not None:
+        body, mimetype = entry
+        response = apply_validators(Response(body, mimetype=mimetype), etag, last_modified)
+        response.headers["X-Cache"] = "HIT"
+        return response
+    return None
+
+def store_response(response, cache, etag, last_modified):
+    """Add validators to a freshly built 200 response and keep its body in the cache."""
+    if response.status_code == 200:
+        cache.put(etag, response.get_data(), response.mimetype)
+        response.headers["X-Cache"] = "MISS"
+    return apply_validators(response, etag, last_modified)
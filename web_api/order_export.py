@@ -0,0 +1,112 @@
+"""
+Streaming bodies for /api/orders/export.
+
+Both streams own a pooled connection and give it back through the release callback
+when the HTTP response is closed, whether the client read everything or went away.
+
+- CopyCsvStream runs COPY ... TO STDOUT (FORMAT csv) in a worker thread and hands
+  the chunks to the response through a small bounded queue, so memory stays
+  constant and the first bytes leave as soon as PostgreSQL produces them.
+- NdjsonStream reads row_to_json() lines from a server-side named cursor in
+  fixed-size batches.
+"""
+
+import queue
+import threading
+
+EXPORT_QUEUE_CHUNKS = 64    # Chunks buffered between COPY and the client
+EXPORT_FETCH_SIZE = 2000    # Rows per round trip of the named cursor
+
+class _Cancelled(Exception):
+    """Raised inside COPY when the client disconnected."""
+
+class _QueueWriter:
+    """File-like target of copy_expert that forwards chunks into a bounded queue."""
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+
+    def write(self, data):
+        if not put_unless_cancelled(self.chunks, data, self.cancelled):
+            raise _Cancelled()
+
+def put_unless_cancelled(chunks, item, cancelled):
+    """Blocking put that gives up once the stream is cancelled."""
+    while not cancelled.is_set():
+        try:
+            chunks.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+class CopyCsvStream:
+    """Iterable response body streaming a COPY TO STDOUT statement."""
+    def __init__(self, conn, copy_sql, release):
+        self.conn = conn
+        self.copy_sql = copy_sql
+        self.release = release
+        self.chunks = queue.Queue(maxsize=EXPORT_QUEUE_CHUNKS)
+        self.cancelled = threading.Event()
+        self.error = None
+        self.worker = None
+        self.closed = False
+
+    def _run(self):
+        try:
+            cur = self.conn.cursor()
+            cur.copy_expert(self.copy_sql, _QueueWriter(self.chunks, self.cancelled))
+            cur.close()
+        except Exception as e:
+            self.error = e
+        finally:
+            put_unless_cancelled(self.chunks, None, self.cancelled)
+
+    def __iter__(self):
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+        if self.error:
+            print(f"Export error: {self.error}")
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.cancelled.set()
+        if self.worker:
+            self.worker.join()
+        # An interrupted COPY leaves the session in an unknown state
+        self.release(self.conn, discard=self.error is not None)
+
+class NdjsonStream:
+    """Iterable response body reading one JSON document per row from a named cursor."""
+    def __init__(self, conn, query, params, release):
+        self.conn = conn
+        self.query = query
+        self.params = params
+        self.release = release
+        self.closed = False
+
+    def __iter__(self):
+        # Named cursors only live inside a transaction
+        self.conn.autocommit = False
+        cur = self.conn.cursor(name="orders_export")
+        cur.execute(self.query, self.params)
+        while True:
+            rows = cur.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            yield "".join(row[0] + "\n" for row in rows)
+        cur.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # The pool rolls back the open transaction, which also drops the cursor
+        self.release(self.conn)
@@ -0,0 +1,314 @@
+"""
+Validated SQL building blocks of the /api/orders endpoints: known columns and
+named field sets, filters, cached keyset-page query shapes and cursor tokens.
+"""
+
+import json
+import base64
+import hashlib
+from datetime import date
+from functools import lru_cache
+
+# Columns of ordens_servico returned by default (excludes the busca_tsv search vector)
+ORDER_COLUMNS = [
+    "id", "numero_ordem_servico", "situacao", "data_emissao", "data_prevista",
+    "data_conclusao", "total_servicos", "total_ordem_servico", "total_pecas",
+    "equipamento", "equipamento_serie", "descricao_problema", "observacoes",
+    "observacoes_internas", "orcar", "orcado", "alq_comissao", "vlr_comissao",
+    "desconto", "id_lista_preco", "tecnico", "id_contato", "id_vendedor",
+    "id_categoria_os", "id_forma_pagamento", "id_conta_contabil", "data_extracao",
+    "linha_dispositivo", "tipo_servico", "origem_cliente"
+]
+
+# Named projections of ordens_servico. "list" leaves out the large TEXT columns
+# (descricao_problema, observacoes, ...) that the table screen never shows.
+ORDER_FIELD_SETS = {
+    "list": [
+        "id", "numero_ordem_servico", "situacao", "data_emissao", "data_prevista",
+        "data_conclusao", "equipamento", "tecnico", "total_ordem_servico", "id_contato",
+        "linha_dispositivo", "tipo_servico", "origem_cliente"
+    ],
+    "detail": ORDER_COLUMNS,
+    "finance": [
+        "id", "numero_ordem_servico", "situacao", "data_emissao", "data_conclusao",
+        "total_servicos", "total_pecas", "total_ordem_servico", "desconto", "alq_comissao",
+        "vlr_comissao", "id_forma_pagamento", "id_conta_contabil", "id_vendedor", "tecnico"
+    ],
+}
+
+# /api/orders page size (keyset pagination)
+ORDERS_DEFAULT_PAGE_SIZE = 100
+ORDERS_MAX_PAGE_SIZE = 500
+
+# Filters of /api/orders in the order their placeholders appear in the query
+ORDER_FILTERS = {
+    "start_date": "data_emissao >= {}",
+    "end_date": "data_emissao <= {}",
+    "status": "situacao = {}",
+    "tecnico": "tecnico ILIKE {}", # Case-insensitive search
+    "numero_ordem_servico": "numero_ordem_servico = {}",
+}
+
+# Dimensions of /api/orders/stats and the SQL expression of each
+STATS_DIMENSIONS = {
+    "situacao": "situacao",
+    "tecnico": "tecnico",
+    "origem_cliente": "origem_cliente",
+    "linha_dispositivo": "linha_dispositivo",
+    "tipo_servico": "tipo_servico",
+    "month": "to_char(date_trunc('month', data_emissao), 'YYYY-MM')",
+}
+STATS_GROUP_BY = ["situacao", "tecnico", "origem_cliente", "linha_dispositivo", "month"]
+STATS_FACETS = ["situacao", "tecnico", "origem_cliente", "linha_dispositivo", "tipo_servico"]
+STATS_METRICS = [
+    "COUNT(*) AS qtd_ordens",
+    "SUM(total_ordem_servico) AS total_ordem_servico",
+    "SUM(total_servicos) AS total_servicos",
+    "SUM(total_pecas) AS total_pecas",
+    "SUM(vlr_comissao) AS vlr_comissao",
+]
+
+def statement_name_for(query):
+    """Stable prepared-statement name derived from the SQL text."""
+    return "orders_" + hashlib.sha1(query.encode()).hexdigest()[:16]
+
+def filter_clauses(filters):
+    """WHERE clauses of the given filter names, numbered $1..$n."""
+    return [ORDER_FILTERS[name].format(f"${index}") for index, name in enumerate(filters, start=1)]
+
+@lru_cache(maxsize=256)
+def orders_query_shape(columns, filters, undated=False, after_cursor=False):
+    """
+    Validated keyset-page SQL for one combination of selected columns and filters,
+    plus the name it is prepared under. Cached, so repeated shapes skip string building.
+
+    Pages walk (data_emissao, id) through the index on those columns; orders
+    without data_emissao follow afterwards, ordered by id (undated=True).
+    Parameters: the filter values, then the cursor values if after_cursor, then the limit.
+    """
+    where_clauses = filter_clauses(filters)
+    next_param = len(filters) + 1
+    if undated:
+        where_clauses.append("data_emissao IS NULL")
+        if after_cursor:
+            where_clauses.append(f"id > ${next_param}")
+            next_param += 1
+        order_by = "id"
+    else:
+        where_clauses.append("data_emissao IS NOT NULL")
+        if after_cursor:
+            where_clauses.append(f"(data_emissao, id) > (${next_param}::date, ${next_param + 1}::integer)")
+            next_param += 2
+        order_by = "data_emissao, id"
+    query = (
+        f"SELECT {', '.join(columns)} FROM ordens_servico"
+        f" WHERE {' AND '.join(where_clauses)}"
+        f" ORDER BY {order_by} LIMIT ${next_param}"
+    )
+    return statement_name_for(query), query
+
+@lru_cache(maxsize=64)
+def orders_count_shape(filters):
+    """Query whose planner row estimate is the number of orders matching the filters."""
+    where_clauses = filter_clauses(filters)
+    query = "SELECT 1 FROM ordens_servico"
+    if where_clauses:
+        query += " WHERE " + " AND ".join(where_clauses)
+    return statement_name_for(query), query
+
+@lru_cache(maxsize=64)
+def orders_validator_shape(filters):
+    """Fallback cache validator of a filter: latest data_extracao (time zone aware) and row count."""
+    where_clauses = filter_clauses(filters)
+    # data_extracao is naive session time; the cast makes it an absolute time for Last-Modified
+    query = "SELECT max(data_extracao)::timestamptz, count(*) FROM ordens_servico"
+    if where_clauses:
+        query += " WHERE " + " AND ".join(where_clauses)
+    return statement_name_for(query), query
+
+@lru_cache(maxsize=128)
+def orders_stats_shape(filters, group_by, facets):
+    """
+    One-scan aggregation of the filtered orders: GROUPING SETS for the overall totals,
+    the requested grouping and each facet. Returns the statement name, the SQL, the
+    dimension order and the GROUPING() bitmask of each set.
+    """
+    dimensions = list(dict.fromkeys(group_by + facets))
+    def bitmask(grouping_set):
+        return sum(1 << (len(dimensions) - 1 - index)
+                   for index, name in enumerate(dimensions) if name not in grouping_set)
+
+    grouping_sets = {"totals": (), "groups": group_by}
+    grouping_sets.update({f"facet:{name}": (name,) for name in facets})
+    masks = {key: bitmask(value) for key, value in grouping_sets.items()}
+
+    expressions = [STATS_DIMENSIONS[name] for name in dimensions]
+    select_list = [f"GROUPING({', '.join(expressions)}) AS conjunto"] if expressions else ["0 AS conjunto"]
+    select_list += [f"{expression} AS {name}" for expression, name in zip(expressions, dimensions)]
+    select_list += STATS_METRICS
+    # Identical sets (e.g. no group_by and the totals) are listed once
+    unique_sets = list(dict.fromkeys(grouping_sets.values()))
+    sets_sql = ", ".join(
+        "(" + ", ".join(STATS_DIMENSIONS[name] for name in grouping_set) + ")" for grouping_set in unique_sets
+    )
+
+    where_clauses = filter_clauses(filters)
+    query = f"SELECT {', '.join(select_list)} FROM ordens_servico"
+    if where_clauses:
+        query += " WHERE " + " AND ".join(where_clauses)
+    query += f" GROUP BY GROUPING SETS ({sets_sql})"
+    return statement_name_for(query), query, tuple(dimensions), masks
+
+@lru_cache(maxsize=8)
+def order_detail_shape(optional_tables):
+    """
+    One query returning the full document of each requested order id ($1 int[]):
+    order columns, contact with address, category, payment method, markers,
+    linked WhatsApp chats and the chat messages that mention the order number,
+    assembled with lateral joins and jsonb_agg.
+    optional_tables lists which of the marker/chat tables exist in this database.
+    """
+    detail_columns = ", ".join(f"o.{col}" for col in ORDER_FIELD_SETS["detail"])
+
+    marker_sources = []
+    if "ordem_servico_marcadores" in optional_tables:
+        marker_sources.append(
+            "SELECT mk.nome FROM ordem_servico_marcadores om "
+            "JOIN marcadores mk ON mk.id = om.id_marcador WHERE om.id_ordem_servico = o.id"
+        )
+    if "marcadores_ordem_servico" in optional_tables:
+        marker_sources.append("SELECT descricao FROM marcadores_ordem_servico WHERE id_ordem_servico = o.id")
+    if marker_sources:
+        markers_sql = (
+            "SELECT jsonb_agg(DISTINCT t.nome ORDER BY t.nome) AS lista FROM ("
+            + " UNION ALL ".join(marker_sources) + ") AS t(nome) WHERE t.nome IS NOT NULL"
+        )
+    else:
+        markers_sql = "SELECT NULL::jsonb AS lista"
+
+    if "chat_files" in optional_tables:
+        if "chat_file_trechos" in optional_tables:
+            # Messages are stored once per conversation, so count what the file covers
+            message_count = "(SELECT count(*) FROM mensagens_por_arquivo m WHERE m.id_chat_file = cf.id)"
+        elif "chat_messages" in optional_tables:
+            message_count = "(SELECT count(*) FROM chat_messages cm WHERE cm.id_chat_file = cf.id)"
+        else:
+            message_count = "NULL"
+        chats_sql = f"""
+            SELECT jsonb_agg(jsonb_build_object(
+                       'id', cf.id, 'filename', cf.filename, 'file_date', cf.file_date,
+                       'phone_number', cf.phone_number, 'customer_name', cf.customer_name,
+                       'order_match_method', cf.order_match_method,
+                       'mensagens', {message_count}
+                   ) ORDER BY cf.file_date) AS lista
+            FROM chat_files cf WHERE cf.id_ordem_servico = o.id
+        """
+    else:
+        chats_sql = "SELECT NULL::jsonb AS lista"
+
+    # Exact join on the numbers extracted by src/utilities/extract_os_mentions.py
+    if "chat_mencoes_os" in optional_tables:
+        mentions_sql = """
+            SELECT jsonb_agg(jsonb_build_object(
+                       'id_chat_file', m.id_chat_file, 'id_mensagem', m.id_mensagem,
+                       'message_timestamp', m.message_timestamp
+                   ) ORDER BY m.message_timestamp) AS lista
+            FROM chat_mencoes_os m WHERE m.numero_ordem_servico = o.numero_ordem_servico
+        """
+    else:
+        mentions_sql = "SELECT NULL::jsonb AS lista"
+
+    query = f"""
+        SELECT o.id,
+               to_jsonb(d) || jsonb_build_object(
+                   'contato', contato.documento,
+                   'categoria', cat.descricao,
+                   'forma_pagamento', fp.nome,
+                   'marcadores', COALESCE(marcadores.lista, '[]'::jsonb),
+                   'chats', COALESCE(chats.lista, '[]'::jsonb),
+                   'mencoes_chat', COALESCE(mencoes.lista, '[]'::jsonb)
+               ) AS documento
+        FROM ordens_servico o
+        CROSS JOIN LATERAL (SELECT {detail_columns}) AS d
+        LEFT JOIN LATERAL (
+            SELECT to_jsonb(ct) || jsonb_build_object('endereco', to_jsonb(e)) AS documento
+            FROM contatos ct LEFT JOIN enderecos e ON e.id = ct.id_endereco
+            WHERE ct.id = o.id_contato
+        ) AS contato ON true
+        LEFT JOIN categorias_os cat ON cat.id = o.id_categoria_os
+        LEFT JOIN formas_pagamento fp ON fp.id = o.id_forma_pagamento
+        LEFT JOIN LATERAL ({markers_sql}) AS marcadores ON true
+        LEFT JOIN LATERAL ({chats_sql}) AS chats ON true
+        LEFT JOIN LATERAL ({mentions_sql}) AS mencoes ON true
+        WHERE o.id = ANY($1::integer[])
+    """
+    return statement_name_for(query), query
+
+def parse_dimension_list(args, name, allowed, default):
+    """Validated tuple of dimension names from a comma-separated parameter. Raises ValueError."""
+    value = args.get(name)
+    if value is None:
+        return tuple(default)
+    items = tuple(dict.fromkeys(item.strip() for item in value.split(',') if item.strip()))
+    invalid = [item for item in items if item not in allowed]
+    if invalid:
+        raise ValueError(f"Invalid {name}: {', '.join(invalid)}. Allowed: {', '.join(allowed)}")
+    return items
+
+def parse_order_columns(args, default_fields="list"):
+    """
+    Validated tuple of columns to select: the explicit `columns` list if given,
+    otherwise the `fields` set (default_fields when absent). Raises ValueError.
+    """
+    columns_param = args.get('columns')
+    if not columns_param:
+        field_set = args.get('fields', default_fields)
+        if field_set not in ORDER_FIELD_SETS:
+            raise ValueError(f"Unknown field set '{field_set}'. Allowed: {', '.join(ORDER_FIELD_SETS)}")
+        return tuple(ORDER_FIELD_SETS[field_set])
+    columns = tuple(col.strip() for col in columns_param.split(',') if col.strip())
+    # Only known column names may reach the SQL text
+    invalid = [col for col in columns if col not in ORDER_COLUMNS]
+    if invalid or not columns:
+        raise ValueError(f"Unknown columns: {', '.join(invalid)}")
+    return columns
+
+def parse_order_filters(args):
+    """Filters present in the request, in ORDER_FILTERS order, and their parameter values."""
+    filters = []
+    params = []
+    for name in ORDER_FILTERS:
+        value = args.get(name)
+        if value:
+            filters.append(name)
+            params.append(f"%{value}%" if name == "tecnico" else value)
+    return tuple(filters), params
+
+def typed_filter_params(filters, params):
+    """
+    Filter values with the date filters parsed into dates, for drivers that bind
+    typed parameters (asyncpg) instead of sending text. Raises ValueError.
+    """
+    typed = []
+    for name, value in zip(filters, params):
+        if name in ("start_date", "end_date"):
+            try:
+                value = date.fromisoformat(value)
+            except ValueError:
+                raise ValueError(f"Invalid {name} '{value}', expected YYYY-MM-DD")
+        typed.append(value)
+    return typed
+
+def encode_cursor(data_emissao, order_id):
+    """Opaque next-page token for the last row of a page."""
+    payload = json.dumps([data_emissao.isoformat() if data_emissao else None, order_id])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(token):
+    """(data_emissao or None, id) from a cursor token. Raises ValueError if it is malformed."""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        data_emissao, order_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return (date.fromisoformat(data_emissao) if data_emissao else None), int(order_id)
+    except Exception:
+        raise ValueError("Malformed cursor")
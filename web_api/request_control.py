@@ -0,0 +1,125 @@
+"""
+Request coalescing and per-client throttling for the web API.
+
+- SingleFlight runs concurrent identical GET requests (same path and query string)
+  once: the first caller executes the view, the others wait and receive a copy of
+  its response. Conditional requests bypass it, they are already cheap.
+- TokenBucketThrottle gives each client (remote address) a bucket refilled at a
+  fixed rate; requests beyond it get 429 with Retry-After, so one runaway script
+  cannot hold every pooled connection.
+
+Both keep counters that /api/metrics reports.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request
+
+class _Call:
+    """One in-flight execution shared by the callers of the same key."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """Deduplicates concurrent executions of the same key."""
+    def __init__(self, wait_timeout):
+        self.wait_timeout = wait_timeout
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+                self.executed += 1
+
+        if not leader:
+            # A follower that waited too long runs the work itself
+            if not call.done.wait(self.wait_timeout):
+                return fn()
+            with self.lock:
+                self.coalesced += 1
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self.lock:
+            return {"executed": self.executed, "coalesced": self.coalesced, "in_flight": len(self.calls)}
+
+def _freeze(response):
+    """Immutable copy of a response that every waiting caller can rebuild."""
+    return response.get_data(), response.status_code, list(response.headers.items())
+
+def _thaw(frozen):
+    body, status, headers = frozen
+    return current_app.response_class(body, status=status, headers=headers)
+
+def coalesced(single_flight):
+    """Decorator sharing one execution of a GET view among identical concurrent requests."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != "GET" or request.if_none_match or request.if_modified_since:
+                return view(*args, **kwargs)
+            frozen = single_flight.do(
+                request.full_path,
+                lambda: _freeze(current_app.make_response(view(*args, **kwargs)))
+            )
+            return _thaw(frozen)
+        return wrapper
+    return decorator
+
+class TokenBucketThrottle:
+    """Per-client token buckets, at most max_clients of them (least recently seen evicted)."""
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()  # client -> (tokens, last refill time)
+        self.allowed = 0
+        self.rejected = 0
+
+    def acquire(self, client):
+        """(True, 0) if the request may proceed, else (False, seconds until a token is available)."""
+        if self.rate <= 0:
+            return True, 0
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                self.allowed += 1
+                allowed, retry_after = True, 0
+            else:
+                self.rejected += 1
+                allowed, retry_after = False, (1 - tokens) / self.rate
+            self.buckets[client] = (tokens, now)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        return allowed, retry_after
+
+    def stats(self):
+        with self.lock:
+            return {"allowed": self.allowed, "rejected": self.rejected, "clients": len(self.buckets)}
@@ -0,0 +1,97 @@
+"""
+Full-text search endpoints: /api/orders/search and /api/chats/search.
+
+Both call a ranked SQL search function (src/utilities/setup_order_search.py and
+setup_chat_search.py) and share one request path in run_search: q/limit/offset
+parsing, the ETag/304 validators and response cache of http_cache, and the
+escaping of the ts_headline snippets.
+"""
+
+import re
+import html
+from flask import request, jsonify
+from db_pool import get_db_connection, release_db_connection
+from http_cache import data_version, make_etag, cached_or_not_modified, store_response
+from request_control import coalesced
+
+SEARCH_MAX_LIMIT = 100
+
+def escape_snippet(snippet):
+    """HTML-escape a ts_headline snippet while keeping its <mark> highlight tags."""
+    if snippet is None:
+        return None
+    parts = re.split(r'(</?mark>)', snippet)
+    return "".join(part if part in ("<mark>", "</mark>") else html.escape(part) for part in parts)
+
+def run_search(response_cache, version_tables, query, build_params, error_message):
+    """
+    Validate q/limit/offset, answer from the cache while version_tables are unchanged,
+    otherwise run query with build_params(term, limit, offset) and return the page.
+    """
+    conn = None
+    cur = None
+    try:
+        term = (request.args.get('q') or '').strip()
+        if not term:
+            return jsonify({"error": "Missing search term", "details": "Use the 'q' parameter"}), 400
+        try:
+            limit = max(1, min(int(request.args.get('limit', 20)), SEARCH_MAX_LIMIT))
+            offset = max(int(request.args.get('offset', 0)), 0)
+        except ValueError:
+            return jsonify({"error": "Invalid pagination", "details": "limit and offset must be integers"}), 400
+
+        conn = get_db_connection()
+        cur = conn.cursor()
+        version = data_version(cur, version_tables)
+        if version:
+            etag = make_etag(request, version[0])
+            cached = cached_or_not_modified(request, response_cache, etag, version[1])
+            if cached:
+                return cached
+
+        cur.execute(query, build_params(term, limit, offset))
+        column_names = [desc[0] for desc in cur.description]
+        results = []
+        for row in cur.fetchall():
+            item = dict(zip(column_names, row))
+            item["trecho"] = escape_snippet(item["trecho"])
+            results.append(item)
+
+        response = jsonify({"q": term, "limit": limit, "offset": offset, "results": results})
+        return store_response(response, response_cache, etag, version[1]) if version else response
+
+    except Exception as e:
+        print(f"Database error: {e}")
+        return jsonify({"error": error_message, "details": str(e)}), 500
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            release_db_connection(conn)
+
+def register_search_routes(app, response_cache, single_flight):
+    """Add the search endpoints to app, sharing its response cache and request coalescing."""
+
+    @app.route('/api/orders/search', methods=['GET'])
+    @coalesced(single_flight)
+    def search_orders():
+        """Ranked Portuguese full-text search with highlighted snippets (see src/utilities/setup_order_search.py)."""
+        return run_search(
+            response_cache, ("ordens_servico",),
+            "SELECT * FROM buscar_ordens_servico(%s, %s, %s, %s, %s)",
+            lambda term, limit, offset: (term, limit, offset,
+                                         request.args.get('start_date'), request.args.get('end_date')),
+            "Could not search orders"
+        )
+
+    @app.route('/api/chats/search', methods=['GET'])
+    @coalesced(single_flight)
+    def search_chats():
+        """Ranked search over WhatsApp messages, joined to the contact and linked order (see src/utilities/setup_chat_search.py)."""
+        return run_search(
+            response_cache, ("chat_messages", "chat_files", "chat_file_trechos", "contatos", "ordens_servico"),
+            "SELECT * FROM buscar_mensagens_chat(%s, %s, %s, %s, %s, %s, %s)",
+            lambda term, limit, offset: (term, request.args.get('cliente'), request.args.get('equipamento'),
+                                         limit, offset, request.args.get('start_date'), request.args.get('end_date')),
+            "Could not search chats"
+        )